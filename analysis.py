@@ -0,0 +1,329 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import numpy as np
+
+import dyn_model  as dm
+import control    as ctl
+import params     as prm
+import recorder   as rec
+import trace_io
+
+'''
+Trace analysis
+@brief:
+    KPIs of a run computed from its recorded arrays (time, X, U, V_arr as
+    returned by sim_1.simulate) in whole-array numpy passes, no per sample
+    python loop. The same Accumulator reduces an in-memory trace, the chunks of
+    an on-disk trace (trace_io) or the chunks of a running simulation
+    (KpiRecorder), so a long run or a sweep point is summarized without keeping
+    its trace.
+    Trace KPIs are the sample means over the samples recorded, with a
+    decimated trace (stride) the commutation instants are only known to a
+    stride.
+'''
+
+# Rise time from / to these fractions of the final speed (see Accumulator)
+RISE_LOW, RISE_HIGH = 0.1, 0.9
+
+# (N,) electromagnetic torque pole_pairs * sum(emf * i) / omega, zero where omega is
+def electromagnetic_torque(X, V_arr, pole_pairs):
+    p_em = np.sum(V_arr[:, dm.dv_eu:dm.dv_ew+1] * X[:, dm.sv_iu:dm.sv_iw+1], axis=1)
+    omega = X[:, dm.sv_omega]
+    return np.divide(pole_pairs * p_em, omega, out=np.zeros_like(p_em), where=omega != 0)
+
+# (N,) electrical input power sum(v * i) and electromagnetic power sum(emf * i)
+def powers(X, V_arr):
+    i_ph = X[:, dm.sv_iu:dm.sv_iw+1]
+    return (np.sum(V_arr[:, dm.dv_ph_U:dm.dv_ph_W+1] * i_ph, axis=1),
+            np.sum(V_arr[:, dm.dv_eu:dm.dv_ew+1] * i_ph, axis=1))
+
+# (N,) copper losses R * sum(i^2)
+def copper_losses(X, R):
+    return R * np.sum(X[:, dm.sv_iu:dm.sv_iw+1] ** 2, axis=1)
+
+# (N,) power past the friction, omega * (torque - B * omega - T_fstatic), to the load and the inertia
+def shaft_power(X, torque, motor):
+    omega = X[:, dm.sv_omega]
+    return omega * (torque - (motor.B * omega) - (motor.T_fstatic * np.sign(omega)))
+
+'''
+Efficiency
+@brief:
+    Of the conversion between the electrical input power p_in and the shaft
+    power p_out (W, mean values): p_out / p_in when motoring, p_in / p_out when
+    generating (both negative, the shaft drives the motor and power goes back
+    to the supply), 0 when the supply and the shaft both feed the losses
+    (braking against the supply, or a rotor held by the static friction).
+'''
+def efficiency(p_in, p_out):
+    if p_in > 0 and p_out >= 0:
+        return p_out / p_in
+    if p_in < 0 and p_out < 0:
+        return p_in / p_out
+    return 0.
+
+'''
+Commutation states
+@brief:
+    (N,) commutation state of a six step switch trace U (N, 6): low side leg * 3
+    + high side leg, -1 while no low side or no high side switch has been on.
+    The high side leg is held through the off time of its PWM (H-PWM-L-ON),
+    last_high is the high side leg before the first sample. Returns the states
+    and the high side leg of the last sample.
+'''
+def commutation_states(U, last_high=-1):
+    low_on = U[:, 0::2] > 0
+    high_on = U[:, 1::2] > 0
+    low = np.where(low_on.any(axis=1), np.argmax(low_on, axis=1), -1)
+    high = np.where(high_on.any(axis=1), np.argmax(high_on, axis=1), -1)
+    # Index of the last sample with a high side switch on, forward filled
+    last = np.where(high >= 0, np.arange(len(high)), -1)
+    np.maximum.accumulate(last, out=last)
+    high = np.where(last >= 0, high[last], last_high)
+    states = np.where((low >= 0) & (high >= 0), (low * 3) + high, -1)
+    return states, int(high[-1]) if len(high) else last_high
+
+'''
+Commutation angle error
+@brief:
+    (N,) electrical angle of the rotor from the nearest ideal commutation
+    boundary of the six step table (the sectors of control.CommutationTable,
+    elec_angle + SECTOR_OFFSET a multiple of SECTOR), in [-SECTOR / 2, SECTOR / 2).
+    Divided by the electrical speed it is the commutation timing error, positive
+    when the commutation comes after the boundary in the direction of rotation.
+'''
+def boundary_error(elec_angle, offset=ctl.SECTOR_OFFSET):
+    return np.mod(elec_angle + offset + (ctl.SECTOR / 2.), ctl.SECTOR) - (ctl.SECTOR / 2.)
+
+'''
+KPI accumulator
+@brief:
+    Reduces a trace chunk by chunk: add(time, X, U, V_arr) with consecutive
+    chunks (U and V_arr optional), result() once at the end. Sums and extrema
+    over the samples at or after t_start (the steady part of a run):
+    - omega_final, omega_mean (rad/s), i_rms, i_peak (A)
+    - with V_arr: p_in sum(v * i), p_em sum(emf * i), p_copper R * sum(i^2),
+      p_out (shaft_power) in W, efficiency (of p_in vs p_out), torque_mean (Nm) and
+      torque_ripple (peak to peak over the mean)
+    - with U: commutations counted, commutation_error (mean absolute angle from
+      the ideal boundary, electrical rad), commutation_error_max and
+      commutation_timing_error (RMS, s)
+    - rise_time (s) over the whole run, to the mean |omega| of the samples at
+      or after t_start, or to `target` (rad/s) when given
+    With a target memory is O(1) in the run length. Without one the levels are
+    only known at the end, so every sample that sets a new |omega| maximum is
+    kept (time and speed): the whole run for a speed that keeps rising, a
+    spin-up followed by a steady run only keeps the spin-up. Pass the target to
+    bound it.
+'''
+class Accumulator:
+    def __init__(self, params=None, t_start=0., sector_offset=ctl.SECTOR_OFFSET, target=None):
+        self.params = params or prm.SimConfig()
+        self.t_start = t_start
+        self.sector_offset = sector_offset
+        self.target = None if target is None else abs(target)
+        self.n = 0
+        self.sums = dict.fromkeys(('omega', 'speed', 'i2', 'p_in', 'p_em', 'p_copper', 'p_out', 'torque'), 0.)
+        self.i_peak = 0.
+        self.torque_min, self.torque_max = math.inf, -math.inf
+        self.has_V = False
+        self.has_U = False
+        self.omega_final = 0.
+        # Rise time: first crossings of the levels, or the |omega| record highs (time, speed)
+        self.crossings = [None, None]
+        self.peak = -math.inf
+        self.peaks = []
+        # Commutation detection carried across chunks
+        self.last_high = -1
+        self.last_state = -1
+        self.comm_count = 0
+        self.comm_abs = 0.
+        self.comm_max = 0.
+        self.comm_time2 = 0.
+
+    def add(self, time, X, U=None, V_arr=None):
+        time = np.asarray(time)
+        X = np.asarray(X, dtype=float)
+        if len(time) == 0:
+            return
+        motor = self.params.motor
+        omega = X[:, dm.sv_omega]
+        self.omega_final = float(omega[-1])
+        self._rise(time, np.abs(omega))
+
+        if U is not None:
+            self.has_U = True
+            states, self.last_high = commutation_states(np.asarray(U), self.last_high)
+            prev = np.empty_like(states)
+            prev[0] = self.last_state
+            prev[1:] = states[:-1]
+            self.last_state = int(states[-1])
+            at = (states != prev) & (states >= 0) & (prev >= 0) & (time >= self.t_start)
+            if np.any(at):
+                error = boundary_error(X[at, dm.sv_theta] * motor.pole_pairs, self.sector_offset)
+                omega_e = omega[at] * motor.pole_pairs
+                timing = np.divide(error, omega_e, out=np.zeros_like(error), where=omega_e != 0)
+                self.comm_count += int(error.size)
+                self.comm_abs += float(np.sum(np.abs(error)))
+                self.comm_max = max(self.comm_max, float(np.max(np.abs(error))))
+                self.comm_time2 += float(np.sum(timing ** 2))
+
+        window = time >= self.t_start
+        if not np.any(window):
+            return
+        X = X[window]
+        i_ph = X[:, dm.sv_iu:dm.sv_iw+1]
+        self.n += len(X)
+        self.sums['omega'] += float(np.sum(X[:, dm.sv_omega]))
+        self.sums['speed'] += float(np.sum(np.abs(X[:, dm.sv_omega])))
+        self.sums['i2'] += float(np.sum(i_ph ** 2))
+        self.i_peak = max(self.i_peak, float(np.max(np.abs(i_ph))))
+        if V_arr is not None:
+            self.has_V = True
+            V_arr = np.asarray(V_arr, dtype=float)[window]
+            p_in, p_em = powers(X, V_arr)
+            torque = electromagnetic_torque(X, V_arr, motor.pole_pairs)
+            self.sums['p_in'] += float(np.sum(p_in))
+            self.sums['p_em'] += float(np.sum(p_em))
+            self.sums['p_copper'] += float(np.sum(copper_losses(X, motor.R)))
+            self.sums['p_out'] += float(np.sum(shaft_power(X, torque, motor)))
+            self.sums['torque'] += float(np.sum(torque))
+            self.torque_min = min(self.torque_min, float(np.min(torque)))
+            self.torque_max = max(self.torque_max, float(np.max(torque)))
+
+    def _rise(self, time, speed):
+        if self.target is not None:
+            for k, level in enumerate((RISE_LOW, RISE_HIGH)):
+                if self.crossings[k] is None:
+                    reached = np.flatnonzero(speed >= level * self.target)
+                    if reached.size:
+                        self.crossings[k] = float(time[reached[0]])
+            return
+        before = np.maximum.accumulate(np.concatenate(([self.peak], speed[:-1])))
+        new = speed > before
+        if np.any(new):
+            self.peaks.append((time[new], speed[new]))
+            self.peak = float(speed[new][-1])
+
+    def _rise_time(self, target):
+        if target == 0:
+            return math.nan
+        if self.target is not None:
+            low, high = self.crossings
+        else:
+            # Record highs increase, the first one over a level is its first crossing
+            time = np.concatenate([t for t, _ in self.peaks])
+            speed = np.concatenate([s for _, s in self.peaks])
+            low, high = (float(time[j]) if j < len(speed) else None
+                         for j in np.searchsorted(speed, [RISE_LOW * target, RISE_HIGH * target]))
+        if low is None or high is None:
+            return math.nan
+        return high - low
+
+    def result(self):
+        n = max(self.n, 1)
+        mean = {k: v / n for k, v in self.sums.items()}
+        result = {
+            'omega_final': self.omega_final,
+            'omega_mean': mean['omega'],
+            'i_rms': math.sqrt(mean['i2'] / 3.),
+            'i_peak': self.i_peak,
+        }
+        if self.has_V:
+            torque_mean = mean['torque']
+            result['p_in'] = mean['p_in']
+            result['p_em'] = mean['p_em']
+            result['p_copper'] = mean['p_copper']
+            result['p_out'] = mean['p_out']
+            result['efficiency'] = efficiency(mean['p_in'], mean['p_out'])
+            result['torque_mean'] = torque_mean
+            result['torque_ripple'] = ((self.torque_max - self.torque_min) / abs(torque_mean)
+                                       if torque_mean != 0 else 0.)
+        if self.has_U:
+            count = max(self.comm_count, 1)
+            result['commutations'] = self.comm_count
+            result['commutation_error'] = self.comm_abs / count
+            result['commutation_error_max'] = self.comm_max
+            result['commutation_timing_error'] = math.sqrt(self.comm_time2 / count)
+        if self.peaks or self.target is not None:
+            result['rise_time'] = self._rise_time(mean['speed'] if self.target is None else self.target)
+        return result
+
+'''
+KPIs of an in-memory trace
+@brief:
+    See Accumulator, params (params.SimConfig) gives the motor (config preset
+    when None).
+'''
+def kpis(time, X, U=None, V_arr=None, params=None, t_start=0.):
+    acc = Accumulator(params, t_start)
+    acc.add(time, X, U, V_arr)
+    return acc.result()
+
+# Run parameters back from the metadata of a trace
+def trace_params(trace):
+    values = trace.meta['config']
+    names = set(prm.SimConfig().as_dict())
+    return prm.SimConfig(**{k: (tuple(v) if isinstance(v, list) else v) for k, v in values.items() if k in names})
+
+'''
+KPIs of an on-disk trace
+@brief:
+    trace: trace_io.Trace or its path. Reads chunk_size samples at a time, so
+    traces larger than RAM reduce like in-memory ones. params defaults to the
+    parameters stored in the trace metadata.
+'''
+def trace_kpis(trace, params=None, t_start=0., chunk_size=65536):
+    opened = not isinstance(trace, trace_io.Trace)
+    if opened:
+        trace = trace_io.load(trace)
+    try:
+        acc = Accumulator(params or trace_params(trace), t_start)
+        channels = ['time'] + [name for name in ('X', 'U', 'V') if name in trace]
+        for _, block in trace.chunks(chunk_size, channels):
+            U = rec.unpack_switches(block['U']) if 'U' in block else None
+            acc.add(block['time'], block['X'], U, block.get('V'))
+        return acc.result()
+    finally:
+        if opened:
+            trace.close()
+
+'''
+KPI recorder
+@brief:
+    A recorder.ChunkedRecorder whose chunks go to an Accumulator instead of
+    being kept, so a simulation returns its KPIs without its trace (sweep
+    workers use it). RAM is flat in the run length apart from the |omega|
+    record highs of the rise time when there is no `target`, see Accumulator.
+    Records X, U and V; kpis() gives the result, arrays() only the samples of
+    the last chunk.
+'''
+class KpiRecorder(rec.ChunkedRecorder):
+    def __init__(self, n_steps, stride=1, chunk_size=65536, params=None, t_start=0., target=None):
+        super().__init__(n_steps, ('X', 'U', 'V'), stride, chunk_size=chunk_size)
+        self.accumulator = Accumulator(params, t_start, target=target)
+
+    def _consume(self, chunk):
+        self.accumulator.add(chunk['time'], chunk['X'], rec.unpack_switches(chunk['U']), chunk['V'])
+
+    def kpis(self):
+        self.flush()
+        return self.accumulator.result()
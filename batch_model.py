@@ -0,0 +1,272 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import numpy as np
+
+import utils
+import dyn_model  as dm
+import control    as ctl
+import foc
+import params     as prm
+import integrator
+import config
+
+'''
+Batched model
+@brief:
+    Same equations as dyn_model / control but for N motors at once.
+    States are (N, N_STATE_VARS) arrays, switches (N, N_SWITCHES) arrays and
+    every parameter is an (N,) array, so a parameter sweep over L, R, Kv, VDC,
+    PWM_duty... advances all variants in one vectorized call.
+'''
+
+# Parameters that can differ per motor, defaults taken from `base` (params.SimConfig, config preset when None)
+param_names = ['Inertia', 'B', 'Kv', 'L', 'M', 'R', 'VDC', 'V_DF', 'NbPoles', 'T_fstatic', 'T_load',
+               'PWM_freq', 'PWM_duty']
+
+def make_params(n, base=None, **overrides):
+    base = base or prm.SimConfig()
+    defaults = base.as_dict()
+    P = {}
+    for name in param_names:
+        default = defaults[name]
+        P[name] = np.broadcast_to(np.asarray(overrides.pop(name, default), dtype=float), (n,)).copy()
+    if overrides:
+        raise ValueError(f"ERR: unknown parameters {sorted(overrides)}")
+    # Diode freewheeling (INVERTER_MODEL) and PWM_MODE of base are the same for the whole batch
+    P['diodes'] = np.full(n, base.inverter.diodes)
+    P['averaged'] = np.full(n, base.inverter.averaged)
+    # So is the back-emf table
+    P['bemf_lut'] = base.motor.bemf_lut
+    return P
+
+# (N, N_STATE_VARS) copies of X0, base.X0 (params.SimConfig, config preset when None) when not given
+def initial_state(n, X0=None, base=None):
+    if X0 is None:
+        X0 = (base or prm.SimConfig()).X0
+    return np.tile(np.asarray(X0, dtype=float), (n, 1))
+
+# Switch indices ordered by phase (u, v, w)
+iv_high = [dm.iv_hu, dm.iv_hv, dm.iv_hw]
+iv_low = [dm.iv_lu, dm.iv_lv, dm.iv_lw]
+
+# (N, 3) phase back-emf
+def get_emf(X, P):
+    max_bemf = (utils.VEL_RADS2RPM * X[:,dm.sv_omega]) / P['Kv']
+    elec = X[:,dm.sv_theta] * (P['NbPoles'] / 2.)
+    angles = elec[:,None] + dm.ph_offsets
+    return max_bemf[:,None] * utils.bemf_shape(angles, P['bemf_lut'])
+
+def _star(V_term, emf, conducting):
+    n_en = conducting.sum(axis=1)
+    return np.sum(np.where(conducting, V_term - emf, 0.), axis=1) / np.maximum(n_en, 1), n_en
+
+'''
+Phase voltages for N motors
+@brief:
+    Returns (N, ph_size) voltages (u, v, w, star) with the leg states of
+    dyn_model.solve_inverter as masks: the star voltage is the mean over
+    conducting legs (switch on or diode freewheeling) of (terminal voltage - emf),
+    open phases sit at star + emf unless that leaves the diode band.
+    No conducting leg gives all zeros.
+'''
+def get_phase_voltages(X, U, P, emf=None):
+    if emf is None:
+        emf = get_emf(X, P)
+    # Averaged complementary legs (both switches hold a duty) sit at U_high * VDC
+    comp = P['averaged'][:,None] & (U[:,iv_high] > 0) & (U[:,iv_low] > 0)
+    V = _solve_legs(X, U > 0, P, emf, comp, U[:,iv_high])
+    # Averaged PWM: duty weighted mean with the PWM'd switch off (dyn_model.solve_inverter)
+    pwm = P['averaged'][:,None] & (U > 0) & (U < 1) & ~np.repeat(comp, 2, axis=1)
+    if np.any(pwm):
+        duty = np.where(pwm.any(axis=1), np.max(np.where(pwm, U, 0.), axis=1), 1.)
+        V_off = _solve_legs(X, (U > 0) & ~pwm, P, emf, comp, U[:,iv_high])
+        V = (duty[:,None] * V) + ((1. - duty)[:,None] * V_off)
+    return V
+
+def _solve_legs(X, on, P, emf, comp, duty):
+    high = on[:,iv_high]
+    low = on[:,iv_low]
+    i_ph = X[:,dm.sv_iu:dm.sv_iw+1]
+    off = ~high & ~low & P['diodes'][:,None]
+    VDC, V_DF = P['VDC'][:,None], P['V_DF'][:,None]
+    d_low = off & (i_ph > dm.I_ZERO)
+    d_high = off & (i_ph < -dm.I_ZERO)
+    V_term = np.where(comp, duty * VDC,
+                      np.where(high, VDC, np.where(d_low, -V_DF, np.where(d_high, VDC + V_DF, 0.))))
+    conducting = high | low | d_low | d_high
+    star, n_en = _star(V_term, emf, conducting)
+
+    # Open phases leaving the diode band start conducting
+    v_open = emf + star[:,None]
+    band = off & ~conducting & (n_en > 0)[:,None]
+    up = band & (v_open > VDC + V_DF)
+    down = band & (v_open < -V_DF)
+    if np.any(up | down):
+        V_term = np.where(up, VDC + V_DF, np.where(down, -V_DF, V_term))
+        conducting = conducting | up | down
+        star, n_en = _star(V_term, emf, conducting)
+
+    V = np.zeros((X.shape[0], dm.ph_size))
+    V[:,dm.ph_star] = star
+    V[:,:3] = np.where(conducting, V_term, emf + star[:,None])
+    V[n_en == 0,:] = 0.
+    return V
+
+# Freewheeling currents that crossed zero over the last step are held at zero (dyn_model.clamp_currents)
+def clamp_currents(X, X_prev, U, P):
+    i_ph = X[:,dm.sv_iu:dm.sv_iw+1]
+    off = (U[:,iv_high] == 0) & (U[:,iv_low] == 0) & P['diodes'][:,None]
+    crossed = off & (i_ph * X_prev[:,dm.sv_iu:dm.sv_iw+1] < 0)
+    if not np.any(crossed):
+        return
+    rest = np.sum(np.where(crossed, i_ph, 0.), axis=1)
+    i_ph[crossed] = 0.
+    others = i_ph != 0
+    i_ph += np.where(others, rest[:,None] / np.maximum(others.sum(axis=1), 1)[:,None], 0.)
+
+def output(X, U, P):
+    V = get_phase_voltages(X, U, P)
+    Y = np.empty((X.shape[0], dm.ov_size))
+    Y[:,dm.ov_iu:dm.ov_iw+1] = X[:,dm.sv_iu:dm.sv_iw+1]
+    Y[:,dm.ov_vu:dm.ov_vw+1] = V[:,:3]
+    Y[:,dm.ov_theta] = X[:,dm.sv_theta]
+    Y[:,dm.ov_omega] = X[:,dm.sv_omega]
+    return Y
+
+def dyn_debug(X, t, U, P):
+    emf = get_emf(X, P)
+
+    # Energy equation: torque =  (EM-energy) / omega
+    etorque = np.sum(emf * X[:,dm.sv_iu:dm.sv_iw+1], axis=1) / X[:,dm.sv_omega]
+    mtorque = (etorque * (P['NbPoles'] / 2)) - (P['B'] * X[:,dm.sv_omega]) - P['T_load']
+
+    # Static friction: dead band of +-T_fstatic, shifted by T_fstatic outside of it
+    mtorque = np.sign(mtorque) * np.maximum(np.abs(mtorque) - P['T_fstatic'], 0.)
+
+    V = get_phase_voltages(X, U, P, emf)
+
+    Xd = np.empty_like(X)
+    Xd[:,dm.sv_theta] = X[:,dm.sv_omega]
+    Xd[:,dm.sv_omega] = mtorque / P['Inertia']
+    Xd[:,dm.sv_iu:dm.sv_iw+1] = (V[:,:3] - (P['R'][:,None] * X[:,dm.sv_iu:dm.sv_iw+1]) - emf
+                                 - V[:,dm.ph_star,None]) / (P['L'] - P['M'])[:,None]
+
+    Xdebug = np.concatenate((emf, V), axis=1)
+    return Xd, Xdebug
+
+def dyn(X, t, U, P):
+    return dyn_debug(X, t, U, P)[0]
+
+'''
+Six step controller (control.run_hpwm_l_on_bipol) for N motors
+@brief:
+    Vectorized lookup in the commutation table, the high side switch is on for
+    the first PWM_duty part of each PWM cycle, or at PWM_duty with averaged PWM.
+'''
+def control(X, t, P, table=ctl.commutation_table):
+    elec = X[:,dm.sv_theta] * (P['NbPoles'] / 2.)
+    cycle_time = 1. / P['PWM_freq']
+    pwm_on = np.fmod(t, cycle_time) <= (cycle_time * P['PWM_duty'])
+    high = np.where(P['averaged'], P['PWM_duty'], pwm_on)
+    sector = table.sector_v(elec)
+    return table.U[0, sector] + high[:,None] * table.H[sector]
+
+'''
+FOC controller (control.FocController) for N motors
+@brief:
+    The same foc.FocLoop kernels on (N,) arrays, bus voltage, PWM frequency and
+    pole pairs per motor from P, the loop settings from base.control.
+'''
+class FocControl:
+    def __init__(self, P, base=None):
+        base = base or prm.SimConfig()
+        self.loop = foc.FocLoop(base.control, P['L'].shape)
+
+    def __call__(self, X, t, P):
+        cycle_time = 1. / P['PWM_freq']
+        duty = self.loop.update(t, X[:,dm.sv_iu:dm.sv_iw+1], X[:,dm.sv_theta] * (P['NbPoles'] / 2.),
+                                X[:,dm.sv_omega], P['VDC'], cycle_time)
+        return foc.leg_switches(duty, t, cycle_time, P['averaged'])
+
+# (N, 1) rate R/(L-M) of the phase currents
+def _rl_rate(P):
+    return (P['R'] / (P['L'] - P['M']))[:,None]
+
+# integrator.semi_implicit / exponential with the per motor R/(L-M)
+def semi_implicit(f, X, t, dt, args=(), Xd0=None):
+    U, P = args
+    Xd = f(X, t, U, P) if Xd0 is None else Xd0
+    return integrator.semi_implicit_update(X, Xd, dt, _rl_rate(P))
+
+def exponential(f, X, t, dt, args=(), Xd0=None):
+    U, P = args
+    Xd = f(X, t, U, P) if Xd0 is None else Xd0
+    a = _rl_rate(P)
+    return integrator.exponential_update(X, Xd, dt, a, np.exp(-a * dt))
+
+# Steppers of a batched run
+methods = {
+    'euler': integrator.euler,
+    'heun': integrator.heun,
+    'rk4': integrator.rk4,
+    'semi_implicit': semi_implicit,
+    'exponential': exponential,
+}
+
+'''
+Batched simulation
+@brief:
+    Runs N motors with the fixed step loop of sim_1.simulate. Only every
+    record_every-th step is kept, so memory scales with the recorded size.
+    controller is called as U = controller(X, t, P), control() (six step) by default.
+    method is one of `methods`; averaged PWM with large steps needs
+    exponential or semi_implicit like the single motor run. X0, sim_time and
+    sim_step not given come from base (params.SimConfig, config preset when
+    None), the parameters P was made from.
+    Returns time (T,), X (T, N, N_STATE_VARS) and U (T, N, N_SWITCHES).
+'''
+def simulate(P, X0=None, method='rk4', sim_time=None, sim_step=None, record_every=1, controller=control,
+             base=None):
+    if method not in methods:
+        raise ValueError(f"ERR: batched simulation supports {sorted(methods)}, not {method}")
+    step = methods[method]
+    base = base or prm.SimConfig()
+    sim_time = base.SIM_TIME if sim_time is None else sim_time
+    sim_step = base.SIM_STEP if sim_step is None else sim_step
+    n = P['L'].size
+
+    time = np.arange(0.0, sim_time, sim_step)
+    n_rec = (time.size + record_every - 1) // record_every
+    X_rec = np.zeros((n_rec, n, config.N_STATE_VARS))
+    U_rec = np.zeros((n_rec, n, config.N_SWITCHES))
+
+    X = initial_state(n, X0, base)
+    for i in range(time.size):
+        U = controller(X, time[i], P)
+        if i % record_every == 0:
+            X_rec[i // record_every] = X
+            U_rec[i // record_every] = U
+        X_prev = X
+        X = step(dyn, X, time[i], sim_step, (U, P))
+        clamp_currents(X, X_prev, U, P)
+        X[:,dm.sv_theta] = np.mod(X[:,dm.sv_theta], 2 * math.pi)
+
+    return time[::record_every], X_rec, U_rec
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import math
+import time as tm
+import argparse
+import numpy as np
+
+import utils
+import dyn_model  as dm
+import config
+import sim_1
+import integrator
+import event_sim
+import multirate
+import batch_model
+import jit_kernel
+import params     as prm
+import recorder   as rec
+
+'''
+Integrator benchmark
+@brief:
+    Runs the same simulation with every integrator and compares wall time and
+    the final state / trajectory against the per-step odeint loop.
+'''
+def bench_integrator(sim_time=1e-3):
+    results = {}
+    for method in ['odeint'] + [m for m in integrator.methods if m != 'odeint']:
+        t0 = tm.perf_counter()
+        time, X, Y, U, V_arr = sim_1.simulate(method, sim_time=sim_time, progress=False, backend='python')
+        results[method] = (tm.perf_counter() - t0, X)
+
+    ref_wall, ref_X = results['odeint']
+    print(f"{'method':>14} {'wall [s]':>10} {'speedup':>8} {'max |di| [A]':>13} {'max |domega|':>13}")
+    for method, (wall, X) in results.items():
+        di = np.max(np.abs(X[:,dm.sv_iu:dm.sv_iw+1] - ref_X[:,dm.sv_iu:dm.sv_iw+1]))
+        domega = np.max(np.abs(X[:,dm.sv_omega] - ref_X[:,dm.sv_omega]))
+        print(f"{method:>14} {wall:10.3f} {ref_wall/wall:8.1f} {di:13.3e} {domega:13.3e}")
+    return results
+
+'''
+Step size benchmark
+@brief:
+    Error against the odeint loop at SIM_STEP when the step is made larger,
+    for the explicit, the semi-implicit and the exponential (exact RL) steps.
+    Errors are taken on the reference grid points the coarse run lands on.
+'''
+def bench_step_size(sim_time=1e-3, factors=(1, 2, 5, 10), methods=('rk4', 'semi_implicit', 'exponential')):
+    ref_time, ref_X = sim_1.simulate('odeint', sim_time=sim_time, progress=False, backend='python')[:2]
+    print(f"{'method':>14} {'step [us]':>10} {'wall [s]':>10} {'max |di| [A]':>13} {'max |domega|':>13}")
+    for method in methods:
+        for factor in factors:
+            sim_step = factor * config.SIM_STEP
+            t0 = tm.perf_counter()
+            time, X = sim_1.simulate(method, sim_time=sim_time, sim_step=sim_step, progress=False,
+                                     backend='python')[:2]
+            wall = tm.perf_counter() - t0
+            idx = np.rint(time / config.SIM_STEP).astype(int)
+            keep = idx < ref_time.size
+            dX = X[keep] - ref_X[idx[keep]]
+            di = np.max(np.abs(dX[:,dm.sv_iu:dm.sv_iw+1]))
+            domega = np.max(np.abs(dX[:,dm.sv_omega]))
+            print(f"{method:>14} {1e6 * sim_step:10.1f} {wall:10.3f} {di:13.3e} {domega:13.3e}")
+
+'''
+Event driven benchmark
+@brief:
+    Compares controller calls, solver restarts and wall time of the event driven
+    mode against the fixed step loop (rk4) on the same output grid.
+'''
+def bench_event(sim_time=1e-3):
+    t0 = tm.perf_counter()
+    ref = sim_1.simulate('rk4', sim_time=sim_time, progress=False, backend='python')
+    ref_wall = tm.perf_counter() - t0
+    t0 = tm.perf_counter()
+    time, X, Y, U, V_arr, stats = event_sim.simulate(sim_time=sim_time)
+    wall = tm.perf_counter() - t0
+
+    di = np.max(np.abs(X[:,dm.sv_iu:dm.sv_iw+1] - ref[1][:,dm.sv_iu:dm.sv_iw+1]))
+    domega = np.max(np.abs(X[:,dm.sv_omega] - ref[1][:,dm.sv_omega]))
+    print(f"fixed step: {time.size-1} controller calls / solver steps, {ref_wall:.3f} s")
+    print(f"event: {stats['controller_calls']} controller calls, {stats['intervals']} solver restarts "
+          f"({stats['pwm_events']} pwm, {stats['commutation_events']} commutation), {wall:.3f} s")
+    print(f"max |di| {di:.3e} A, max |domega| {domega:.3e} rad/s")
+    return stats
+
+'''
+Inverter model benchmark
+@brief:
+    Wall time of the fixed step loop (rk4) with the ideal and the diode inverter
+    model, Python and compiled, and how often a diode conducts.
+'''
+def bench_inverter(sim_time=1e-3):
+    n = int(math.ceil(sim_time / config.SIM_STEP))
+    backends = ['python'] + (['jit'] if jit_kernel.available else [])
+    print(f"{'model':>6} " + ' '.join(f"{b + ' [s]':>11}" for b in backends) + f" {'diode samples':>14}")
+    walls = {}
+    for model in ('ideal', 'diode'):
+        params = prm.SimConfig(INVERTER_MODEL=model)
+        row = []
+        for backend in backends:
+            sim_1.simulate('rk4', sim_time=2*config.SIM_STEP, progress=False, backend=backend, params=params) # compile
+            recorder = rec.TraceRecorder(n, channels=('D',))
+            t0 = tm.perf_counter()
+            sim_1.simulate('rk4', sim_time=sim_time, progress=False, backend=backend, recorder=recorder,
+                           params=params)
+            row.append(tm.perf_counter() - t0)
+        walls[model] = row
+        print(f"{model:>6} " + ' '.join(f"{w:11.3f}" for w in row) +
+              f" {np.count_nonzero(recorder['D'].any(axis=1)):14d}")
+    print("diode / ideal: " + ', '.join(f"{b} {d / i:.2f}" for b, d, i in zip(backends, walls['diode'], walls['ideal'])))
+
+'''
+Multi-rate benchmark
+@brief:
+    Accuracy report of multirate.simulate against the single rate rk4 loop.
+'''
+def bench_multirate(sim_time=1e-3):
+    report = multirate.accuracy_report(sim_time)
+    multirate.print_report(report)
+    return report
+
+'''
+Batched benchmark
+@brief:
+    Checks the single motor batched run against sim_1.simulate and reports the
+    cost per motor step for growing batch sizes.
+'''
+def bench_batch(sim_time=1e-3, sizes=(1, 16, 256, 4096)):
+    ref = sim_1.simulate('rk4', sim_time=sim_time, progress=False, backend='python')
+    time, X, U = batch_model.simulate(batch_model.make_params(1), sim_time=sim_time)
+    print(f"N=1 vs sim_1: max |dX| {np.max(np.abs(X[:,0,:] - ref[1])):.3e}")
+
+    print(f"{'N':>6} {'wall [s]':>10} {'us / motor step':>16}")
+    for n in sizes:
+        P = batch_model.make_params(n, VDC=np.linspace(50., 150., n))
+        t0 = tm.perf_counter()
+        time, X, U = batch_model.simulate(P, sim_time=sim_time, record_every=100)
+        wall = tm.perf_counter() - t0
+        print(f"{n:6d} {wall:10.3f} {1e6 * wall * config.SIM_STEP / (n * sim_time):16.3f}")
+
+'''
+Back-emf kernel microbenchmark
+@brief:
+    Cost of evaluating the three phase back-emf shapes with the scalar
+    angle_2pi / trapezoid wrappers, one bemf_shape() array call and the
+    bemf_phases() per step path of the model, per RHS evaluation and per
+    simulated millisecond, then per element on large arrays.
+'''
+def bench_kernels(sim_time=1e-3, n_calls=20000, n_elems=1000000):
+    theta = 1.234
+    offsets = dm.ph_offsets
+    motor = prm.default().motor
+
+    def scalar():
+        return [utils.trapezoid(utils.angle_2pi(theta + offset)) for offset in offsets]
+    def vector():
+        return utils.bemf_shape(theta + offsets, motor.bemf_lut)
+    def phases():
+        return utils.bemf_phases(theta, motor.bemf_table)
+
+    # The emf is evaluated once per RHS evaluation (dyn_model.evaluate)
+    evals_per_ms = (1e-3 / config.SIM_STEP) * integrator.rhs_calls[config.SIM_INTEGRATOR]
+    print(f"{'3 phase emf':>14} {'us / call':>10} {'ms / sim ms':>12}")
+    for name, f in (('scalar', scalar), ('bemf_shape', vector), ('bemf_phases', phases)):
+        t0 = tm.perf_counter()
+        for i in range(n_calls):
+            f()
+        per_call = (tm.perf_counter() - t0) / n_calls
+        print(f"{name:>14} {1e6 * per_call:10.3f} {1e3 * per_call * evals_per_ms:12.3f}")
+
+    angles = np.random.default_rng(0).uniform(0., 2 * math.pi, n_elems)
+    print(f"{'array kernel':>14} {'ns / elem':>10}")
+    t0 = tm.perf_counter()
+    for a in angles[:n_calls]:
+        utils.trapezoid(a)
+    print(f"{'trapezoid':>14} {1e9 * (tm.perf_counter() - t0) / n_calls:10.3f}")
+    for name, f in (('trapezoid_v', utils.trapezoid_v),
+                    ('lut 12', lambda a: utils.bemf_shape(a, utils.make_bemf_lut(12))),
+                    ('lut 256', lambda a: utils.bemf_shape(a, utils.make_bemf_lut(256)))):
+        t0 = tm.perf_counter()
+        f(angles)
+        print(f"{name:>14} {1e9 * (tm.perf_counter() - t0) / n_elems:10.3f}")
+
+'''
+Compiled kernel parity and speed
+@brief:
+    Runs every method with the Python model and the compiled kernel and checks
+    that all recorded trajectories match within tol. Returns False on mismatch.
+'''
+def bench_jit(sim_time=1e-3, tol=1e-9):
+    if not jit_kernel.available:
+        print("numba not installed, compiled kernel unavailable")
+        return True
+    names = ['X', 'Y', 'U', 'V_arr']
+    ok = True
+    print(f"{'method':>14} {'python [s]':>11} {'jit [s]':>9} {'speedup':>8} {'max rel err':>12}")
+    for method in jit_kernel.methods:
+        t0 = tm.perf_counter()
+        ref = sim_1.simulate(method, sim_time=sim_time, progress=False, backend='python')
+        py_wall = tm.perf_counter() - t0
+        sim_1.simulate(method, sim_time=2*config.SIM_STEP, backend='jit') # compile outside of the timing
+        t0 = tm.perf_counter()
+        res = sim_1.simulate(method, sim_time=sim_time, backend='jit')
+        jit_wall = tm.perf_counter() - t0
+        err = 0.
+        for name, a, b in zip(names, ref[1:], res[1:]):
+            e = np.max(np.abs(a - b) / (1. + np.abs(a)))
+            if e > tol:
+                print(f"mismatch in {name}: {e:.3e}")
+                ok = False
+            err = max(err, e)
+        print(f"{method:>14} {py_wall:11.3f} {jit_wall:9.4f} {py_wall/jit_wall:8.1f} {err:12.3e}")
+    return ok
+
+
+benches = {
+    'integrator': bench_integrator,
+    'step_size': bench_step_size,
+    'event': bench_event,
+    'multirate': bench_multirate,
+    'inverter': bench_inverter,
+    'batch': bench_batch,
+    'kernels': bench_kernels,
+    'jit': bench_jit,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Open-BLDC pysim benchmarks')
+    parser.add_argument('bench', nargs='*', help=f'benchmarks to run, any of {list(benches)} (default: all)')
+    parser.add_argument('--sim-time', type=float, default=1e-3, help='simulated time in s')
+    args = parser.parse_args(argv)
+    for name in args.bench:
+        if name not in benches:
+            parser.error(f"unknown benchmark {name}")
+    ok = True
+    for name in (args.bench or list(benches)):
+        print(f"### {name}")
+        ok &= benches[name](sim_time=args.sim_time) is not False
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import math
+import platform
+import argparse
+import subprocess
+import multiprocessing
+import time as tm
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import dyn_model  as dm
+import params     as prm
+import recorder   as rec
+import integrator
+import batch_model
+import jit_kernel
+import sim_1
+
+'''
+Benchmark suite
+@brief:
+    Canonical scenarios run the same way every time, so a speed or accuracy
+    regression of dyn_model, control or the kernels shows up as numbers:
+    - steps / s (motor steps for a batch) and simulated / wall time ratio
+    - model (RHS) evaluations per simulated second (integrator.rhs_calls per
+      fixed step, the first one being the dyn_debug evaluation)
+    - peak resident memory of the process running the scenario (each scenario
+      runs in a fresh process)
+    - trajectory error against the golden trace of the scenario (bench_golden/,
+      written with --update-golden), on the golden sample grid; a run on
+      another grid fails
+    Every run appends one JSON line per scenario to the results file (with the
+    commit and library versions) and is compared with the previous line of the
+    same scenario there.
+'''
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_golden')
+RESULTS_FILE = 'bench_results.jsonl'
+# Samples kept in a golden trace
+GOLDEN_SAMPLES = 1000
+# Motors of a batch kept in its golden trace
+GOLDEN_MOTORS = (0, 127, 255)
+
+'''
+Scenarios
+@brief:
+    name -> sim_time, integration method, sim_step (None: SIM_STEP), backend,
+    params overrides on the config preset, and for a batch the number of
+    motors (VDC spread over 50..150 V).
+'''
+scenarios = {
+    'spinup_10ms': dict(sim_time=1e-2, method='rk4', sim_step=None, backend='python', overrides={}),
+    'steady_1s': dict(sim_time=1., method='exponential', sim_step=2e-5, backend='python',
+                      overrides={'PWM_MODE': 'averaged'}),
+    'loaded_10ms': dict(sim_time=1e-2, method='rk4', sim_step=None, backend='python',
+                        overrides={'T_load': 0.05}),
+    'batch_256': dict(sim_time=2e-3, method='rk4', sim_step=None, backend='batch', overrides={}, motors=256),
+}
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / (1024. ** 2) if sys.platform == 'darwin' else rss / 1024.
+
+'''
+Run one scenario
+@brief:
+    In the calling process. Returns the metrics and the (time, X) of the
+    golden grid, X (N, 5) or (N, motors, 5) for a batch.
+'''
+def run_scenario(name, backend=None):
+    sc = scenarios[name]
+    params = prm.SimConfig(**sc['overrides'])
+    sim_time = sc['sim_time']
+    sim_step = params.SIM_STEP if sc['sim_step'] is None else sc['sim_step']
+    method = sc['method']
+    # The override is for the single motor scenarios
+    backend = sc['backend'] if sc['backend'] == 'batch' else (backend or sc['backend'])
+    n_steps = np.arange(0.0, sim_time, sim_step).size
+    stride = max(1, n_steps // GOLDEN_SAMPLES)
+    result = {'scenario': name, 'backend': backend, 'method': method, 'sim_time': sim_time,
+              'sim_step': sim_step, 'motors': sc.get('motors', 1)}
+
+    if backend == 'batch':
+        n = sc['motors']
+        P = batch_model.make_params(n, params, VDC=np.linspace(50., 150., n))
+        t0 = tm.perf_counter()
+        time, X, U = batch_model.simulate(P, method=method, sim_time=sim_time, sim_step=sim_step,
+                                          record_every=stride, base=params)
+        wall = tm.perf_counter() - t0
+        X = X[:, [m for m in GOLDEN_MOTORS if m < n]]
+        rhs = integrator.rhs_calls[method] * n_steps * n
+    else:
+        if backend == 'jit':
+            # Compile outside of the timing
+            sim_1.simulate(method, 2 * sim_step, sim_step, progress=False, backend='jit', params=params)
+        recorder = rec.TraceRecorder(n_steps, ('X',), stride)
+        t0 = tm.perf_counter()
+        time, X = sim_1.simulate(method, sim_time, sim_step, progress=False, backend=backend,
+                                 recorder=recorder, params=params)[:2]
+        wall = tm.perf_counter() - t0
+        rhs = integrator.rhs_calls[method] * n_steps
+
+    motor_steps = n_steps * result['motors']
+    result.update({
+        'steps': motor_steps,
+        'wall_time': wall,
+        'steps_per_s': motor_steps / wall,
+        'sim_wall_ratio': result['motors'] * sim_time / wall,
+        'rhs_per_sim_s': rhs / (result['motors'] * sim_time),
+        'peak_rss_mb': _peak_rss_mb(),
+    })
+    return result, np.asarray(time), np.array(X)
+
+'''
+Trajectory error
+@brief:
+    Against the golden (time, X): max |d omega| (rad/s), max |d theta| (rad,
+    wrapped), max |d i| (A) and that over the golden phase current RMS.
+    The errors need the same sample grid, a run with another length or other
+    sample times (e.g. a changed SIM_STEP or stride) only gets grid_match False,
+    which counts as a regression.
+'''
+def trajectory_error(time, X, golden_time, golden_X):
+    if (time.shape != golden_time.shape or X.shape != golden_X.shape
+            or not np.allclose(time, golden_time, rtol=1e-12, atol=0.)):
+        return {'grid_match': False}
+    i_ph = slice(dm.sv_iu, dm.sv_iw+1)
+    di = float(np.max(np.abs(X[..., i_ph] - golden_X[..., i_ph])))
+    i_rms = float(np.sqrt(np.mean(golden_X[..., i_ph] ** 2)))
+    dtheta = np.mod(X[..., dm.sv_theta] - golden_X[..., dm.sv_theta] + math.pi, 2 * math.pi) - math.pi
+    return {
+        'grid_match': True,
+        'omega_err': float(np.max(np.abs(X[..., dm.sv_omega] - golden_X[..., dm.sv_omega]))),
+        'theta_err': float(np.max(np.abs(dtheta))),
+        'i_err': di,
+        'i_rel_err': di / i_rms if i_rms > 0 else 0.,
+    }
+
+def golden_path(name, golden_dir=GOLDEN_DIR):
+    return os.path.join(golden_dir, name + '.npz')
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'numba': numba_version,
+        'machine': platform.machine(),
+        'jit': jit_kernel.available,
+    }
+
+def last_results(path):
+    last = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    row = json.loads(line)
+                    last[(row['scenario'], row['backend'])] = row
+    return last
+
+'''
+Run the suite
+@brief:
+    Runs `names` (all scenarios when empty), each in its own process, compares
+    with the golden traces (or writes them with update_golden) and appends the
+    rows to `out`. Returns the rows; each has 'speedup' (steps / s over the
+    previous row of the scenario in `out`) when there is one.
+'''
+def run(names=(), out=RESULTS_FILE, golden_dir=GOLDEN_DIR, update_golden=False, backend=None):
+    names = list(names) or list(scenarios)
+    for name in names:
+        if name not in scenarios:
+            raise ValueError(f"ERR: unknown scenario {name}, expected one of {list(scenarios)}")
+    previous = last_results(out)
+    env = environment()
+    stamp = tm.strftime('%Y-%m-%dT%H:%M:%S')
+    rows = []
+    for name in names:
+        # Fresh process per scenario, the peak memory is its own
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result, time, X = pool.submit(run_scenario, name, backend).result()
+        path = golden_path(name, golden_dir)
+        if update_golden:
+            os.makedirs(golden_dir, exist_ok=True)
+            np.savez_compressed(path, time=time, X=X)
+        if os.path.exists(path):
+            with np.load(path) as golden:
+                result.update(trajectory_error(time, X, golden['time'], golden['X']))
+        prev = previous.get((name, result['backend']))
+        if prev is not None:
+            result['speedup'] = result['steps_per_s'] / prev['steps_per_s']
+        row = dict(result, time=stamp, **env)
+        with open(out, 'a') as f:
+            f.write(json.dumps(row) + '\n')
+        rows.append(row)
+    return rows
+
+def print_rows(rows):
+    print(f"{'scenario':>12} {'backend':>8} {'wall [s]':>9} {'steps/s':>10} {'sim/wall':>9} {'rhs/sim s':>10} "
+          f"{'rss [MB]':>9} {'omega err':>10} {'i rel err':>10} {'speedup':>8}")
+    for r in rows:
+        rss = r['peak_rss_mb']
+        print(f"{r['scenario']:>12} {r['backend']:>8} {r['wall_time']:9.3f} {r['steps_per_s']:10.4g} "
+              f"{r['sim_wall_ratio']:9.3g} {r['rhs_per_sim_s']:10.4g} "
+              f"{rss if rss is not None else math.nan:9.1f} {r.get('omega_err', math.nan):10.3g} "
+              f"{r.get('i_rel_err', math.nan):10.3g} {r.get('speedup', math.nan):8.3f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Open-BLDC pysim benchmark suite')
+    parser.add_argument('scenarios', nargs='*', help=f'any of {list(scenarios)} (default: all)')
+    parser.add_argument('--out', default=RESULTS_FILE, help='results file, one JSON line per scenario run')
+    parser.add_argument('--golden-dir', default=GOLDEN_DIR)
+    parser.add_argument('--update-golden', action='store_true', help='store this run as the golden traces')
+    parser.add_argument('--backend', default=None, help='run the single motor scenarios on this backend')
+    parser.add_argument('--max-slowdown', type=float, default=None,
+                        help='fail when steps/s drops below this fraction of the previous run')
+    parser.add_argument('--max-error', type=float, default=None,
+                        help='fail when the relative current error to the golden trace is above this')
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"unknown scenario {name}")
+
+    rows = run(args.scenarios, args.out, args.golden_dir, args.update_golden, args.backend)
+    print_rows(rows)
+    ok = True
+    for r in rows:
+        if r.get('grid_match') is False:
+            print(f"{r['scenario']}: samples not on the time grid of the golden trace")
+            ok = False
+        if args.max_slowdown is not None and r.get('speedup', 1.) < args.max_slowdown:
+            print(f"{r['scenario']}: {r['speedup']:.3f} of the previous speed")
+            ok = False
+        if args.max_error is not None and r.get('i_rel_err', 0.) > args.max_error:
+            print(f"{r['scenario']}: current error {r['i_rel_err']:.3g} to the golden trace")
+            ok = False
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,171 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import copy
+import pickle
+import time as tm
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import params     as prm
+import recorder   as rec
+import analysis
+import sim_1
+import config
+
+'''
+Simulation checkpoints
+@brief:
+    A Snapshot is everything sim_1.simulate needs to go on from a step: the
+    step index on the time grid, the state vector X, the switches U of the
+    last step (the output of the next step is computed with them), the
+    controller (a stateful controller object carries its own state) and the
+    numpy RNG state. PWM needs nothing more, it is a function of the time,
+    which follows from the step index.
+    Pass it as simulate(state=...) and the run starts where the snapshot is
+    and leaves it at the step after its last one, so
+        s = Snapshot(params); simulate(..., sim_time=a, state=s); simulate(..., sim_time=b, state=s)
+    gives the same steps as one run of a + b (bit for bit, both backends).
+    Recording is not part of it: every run fills its own recorder, with the
+    strides counted from step 0 of the unbroken run, so the traces of the
+    runs concatenate to the trace of a + b.
+    A snapshot is about 4 kB once saved (mostly the MT19937 RNG state and the
+    params), so a spin-up is simulated once and every scenario starting from
+    the running motor forks off it.
+'''
+FORMAT_VERSION = 2
+
+class Snapshot:
+    def __init__(self, params=None):
+        self.params = params or prm.SimConfig()
+        self.step = 0
+        self.sim_step = None
+        self.X = np.array(self.params.X0, dtype=float)
+        self.U = np.zeros(config.N_SWITCHES)
+        self.controller = None
+        self.rng = None
+
+    # Simulated time of the next step
+    @property
+    def time(self):
+        return self.step * self.sim_step if self.sim_step is not None else 0.
+
+    # Start of a run from here, returns the first step index
+    def begin(self, sim_step):
+        if self.sim_step is not None and sim_step != self.sim_step:
+            raise ValueError(f"ERR: checkpoint taken with sim_step {self.sim_step}, not {sim_step}")
+        self.sim_step = sim_step
+        if self.rng is not None:
+            np.random.set_state(self.rng)
+        return self.step
+
+    # End of a run, `step` is the next step to run
+    def end(self, step, X, U, controller):
+        self.step = int(step)
+        self.X = np.array(X, dtype=float)
+        self.U = np.array(U, dtype=float)
+        self.controller = controller
+        self.rng = np.random.get_state()
+
+    '''
+    Fork
+    @brief:
+        Independent copy to run a variant from, with the params replaced by
+        `overrides` (SimConfig names, see params.py). The time grid stays the
+        same, so SIM_STEP can not be changed.
+    '''
+    def fork(self, **overrides):
+        if 'SIM_STEP' in overrides and self.sim_step is not None and overrides['SIM_STEP'] != self.sim_step:
+            raise ValueError("ERR: a fork runs on the time grid of its checkpoint, SIM_STEP can not change")
+        snapshot = copy.copy(self)
+        snapshot.X, snapshot.U = self.X.copy(), self.U.copy()
+        snapshot.controller = copy.deepcopy(self.controller)
+        snapshot.params = self.params.replace(**overrides) if overrides else self.params
+        return snapshot
+
+    def __getstate__(self):
+        return {'version': FORMAT_VERSION, 'params': self.params.as_dict(), 'step': self.step,
+                'sim_step': self.sim_step, 'X': self.X, 'U': self.U, 'controller': self.controller,
+                'rng': self.rng}
+
+    def __setstate__(self, state):
+        if state.get('version') != FORMAT_VERSION:
+            raise ValueError(f"ERR: checkpoint format {state.get('version')}, expected {FORMAT_VERSION}")
+        self.params = prm.SimConfig(**state['params'])
+        for name in ('step', 'sim_step', 'X', 'U', 'controller', 'rng'):
+            setattr(self, name, state[name])
+
+    def save(self, path):
+        try:
+            data = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise ValueError(f"ERR: checkpoint controller {self.controller!r} can not be saved: {e}")
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+
+def load(path):
+    with gzip.open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+    if not isinstance(snapshot, Snapshot):
+        raise ValueError(f"ERR: {path} is not a simulation checkpoint")
+    return snapshot
+
+'''
+Warm start
+@brief:
+    Runs `sim_time` from the initial state (params.X0) and returns the
+    snapshot at its end, e.g. a spin-up to the operating point.
+'''
+def warm_start(sim_time, params=None, method=None, backend=None):
+    snapshot = Snapshot(params)
+    n_steps = int(np.ceil(sim_time / snapshot.params.SIM_STEP))
+    # Only the end matters, keep a single sample
+    recorder = rec.TraceRecorder(n_steps, ('X',), stride=n_steps)
+    sim_1.simulate(method, sim_time, progress=False, backend=backend, recorder=recorder,
+                   params=snapshot.params, state=snapshot)
+    return snapshot
+
+def run_fork(snapshot, overrides, sim_time, method=None, backend=None, stride=1):
+    state = snapshot.fork(**overrides)
+    params = state.params
+    sim_step = state.sim_step or params.SIM_STEP
+    n_steps = int(np.ceil(sim_time / sim_step))
+    recorder = analysis.KpiRecorder(n_steps, stride, params=params, t_start=state.time + sim_time / 2.)
+    t0 = tm.perf_counter()
+    sim_1.simulate(method, sim_time, sim_step, progress=False, backend=backend, recorder=recorder,
+                   params=params, state=state)
+    result = recorder.kpis()
+    result['wall_time'] = tm.perf_counter() - t0
+    return result
+
+'''
+Fork into variants
+@brief:
+    points: list of override dicts (see sweep.grid()), each run for sim_time
+    from `snapshot` on `workers` processes. KPIs are over the second half of
+    the forked run, like sweep.py. Returns {'index', 'overrides', 'kpis'} rows
+    in order.
+'''
+def fork(snapshot, points, sim_time, method=None, backend=None, workers=None, stride=1):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_fork, snapshot, p, sim_time, method, backend, stride) for p in points]
+        return [{'index': k, 'overrides': p, 'kpis': f.result()}
+                for k, (p, f) in enumerate(zip(points, futures))]
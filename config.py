@@ -10,6 +10,57 @@ N_SWITCHES = 6 # Upper / lower switches x 3
 ### TIME VARS
 SIM_STEP = 1e-6
 SIM_TIME = 1e-2 # 10 ms
+'''
+SIM_INTEGRATOR: Integration method used by sim_1
+@brief:
+    One of 'euler', 'heun', 'rk4', 'semi_implicit', 'exponential' (see integrator.py)
+    or 'odeint' to restart scipy's LSODA on every step (slow, reference only)
+'''
+SIM_INTEGRATOR = 'rk4'
+'''
+SIM_MODE: 'fixed' steps every SIM_STEP, 'event' integrates adaptively between
+    PWM / commutation edges and resamples on SIM_STEP (see event_sim.py),
+    'multirate' runs the electrical, mechanical and control parts at their own rates (see multirate.py)
+    Both of these only run the six step angle controller (CONTROLLER = 'six_step', no SPEED_LOOP)
+'''
+SIM_MODE = 'fixed'
+'''
+SIM_MECH_STEP, SIM_CONTROL_STEP: Steps of the mechanical subsystem and of the control task
+    in multirate mode, both multiples of SIM_STEP (the electrical step).
+    The control step mirrors the MCU commutation ISR (20 kHz here).
+'''
+SIM_MECH_STEP = 1e-5
+SIM_CONTROL_STEP = 5e-5
+'''
+SIM_BACKEND: 'auto' uses the numba compiled kernel when numba is installed
+    (see jit_kernel.py), 'jit' requires it, 'python' always runs the Python model
+'''
+SIM_BACKEND = 'auto'
+'''
+SIM_TRACE_FILE: When set sim_1 streams the trace to disk while running (see trace_io.py)
+    a path ending in .h5 / .hdf5 writes HDF5, anything else a directory of .npy files
+'''
+SIM_TRACE_FILE = None
+'''
+PLOT_OUTPUT: When set sim_1 plots without a display (Agg) and saves every figure
+    to this path with the figure name appended, e.g. 'run.png' -> run_output.png,
+    run_torque.png; the extension picks the format (.png, .svg, .pdf)
+'''
+PLOT_OUTPUT = None
+'''
+SIM_PROFILE: When set sim_1 times every stage of the step (see profiler.py):
+    'table' prints the summary at the end of the run, a path ending in .json writes it there
+'''
+SIM_PROFILE = None
+'''
+SIM_CACHE: Directory of the result cache (see result_cache.py), e.g. '.pysim_cache', off when None.
+    sim_1 and sweep.py take KPIs and traces of a run already made with the same
+    parameters, settings and model code from there instead of simulating again.
+    Runs that are profiled or stream their trace (SIM_TRACE_FILE) are not cached
+SIM_CACHE_MB: Size cap of the cache, least recently used results are removed first
+'''
+SIM_CACHE = None
+SIM_CACHE_MB = 512
 ### STATE VARS
 
 '''
@@ -43,6 +94,18 @@ NbPoles: Number of pole pairs
     Indicates relation between mechanical and electrical angle
 '''
 NbPoles = 4.                  #
+'''
+BEMF_LUT_SIZE: Entries of the back-emf table over one electrical turn
+@brief:
+    The shape is interpolated from a table like the firmware does (see utils.make_bemf_lut).
+    Multiples of 12 give the exact trapezoid, 256 matches a byte indexed table.
+'''
+BEMF_LUT_SIZE = 12
+'''
+BEMF_SHAPE: 'trapezoidal' (BLDC) or 'sinusoidal' (PMSM) back-emf, set BEMF_LUT_SIZE to 360
+    or more with 'sinusoidal'
+'''
+BEMF_SHAPE = 'trapezoidal'
 T_fstatic = 1 # Static friction in Nm
 T_load = 0   # Load torque (Write a fr)
 
@@ -54,6 +117,106 @@ T_load = 0   # Load torque (Write a fr)
 V_DF: Diode forward voltage
 '''
 V_DF = 1.3 # IRFZ44N: Diode forward voltage
+'''
+PWM_freq, PWM_duty: PWM carrier frequency in Hz and duty cycle (0..1) of the high side switch
+'''
+PWM_freq = 16000.
+PWM_duty = 0.6
+'''
+INVERTER_MODEL: 'diode' lets the current of a switched off phase freewheel through the
+    diodes (V_DF drop) until it reaches zero, 'ideal' leaves every switched off phase floating
+    (see dyn_model.solve_inverter)
+'''
+INVERTER_MODEL = 'diode'
+'''
+PWM_MODE: 'switched' resolves every PWM edge, 'averaged' applies duty * VDC on the PWM'd
+    high side for the whole cycle (no ripple, steps of ~50 us are fine, for controller tuning)
+'''
+PWM_MODE = 'switched'
+
+####################
+## CONTROL PARAMS ##
+####################
+'''
+CONTROLLER: 'six_step' commutates on the measured rotor angle (control.run_hpwm_l_on_bipol),
+    'sensorless' on the back-emf zero crossings of the floating phase (control.SensorlessController),
+    'foc' drives sinusoidal currents with field oriented control (control.FocController),
+    'cosim' runs compiled controller code over the co-simulation bridge (see cosim.py)
+'''
+CONTROLLER = 'six_step'
+'''
+ADC_freq: Sample rate of the floating phase voltage in Hz
+@brief:
+    Samples are taken at the middle of the PWM on-time like a PWM triggered ADC,
+    samples falling into the off-time are dropped.
+'''
+ADC_freq = 16000.
+'''
+ZC_FILTER: Consecutive samples past the virtual neutral before a zero crossing is accepted
+ZC_BLANKING: Part of the last step period ignored after a commutation
+    (the switched off phase freewheels through a diode and sits at a rail meanwhile)
+ZC_LOCK: Consecutive detected zero crossings needed to leave the open loop startup
+'''
+ZC_FILTER = 2
+ZC_BLANKING = 0.25
+ZC_LOCK = 6
+'''
+STARTUP_ALIGN_TIME, STARTUP_RAMP_TIME: Open loop startup, the rotor is first aligned to
+    commutation step 0, then the steps are forced with a period going from
+    STARTUP_STEP_START to STARTUP_STEP_END over the ramp time (periods in s)
+    The startup is restarted when it has not locked 2 * STARTUP_RAMP_TIME after the
+    ramp began, so that window has to hold ZC_LOCK steps at the speed the rotor reaches
+    on the ramp: 2 * STARTUP_RAMP_TIME >= ZC_LOCK * step time. A step takes about 7 ms
+    here (the rotor lags the forced period), 60 ms hold the 6 steps with a margin and
+    the default startup locks after about 42 ms.
+'''
+STARTUP_ALIGN_TIME = 2e-3
+STARTUP_RAMP_TIME = 30e-3
+STARTUP_STEP_START = 6e-3
+STARTUP_STEP_END = 5.5e-3
+'''
+SPEED_LOOP: When True a PI loop sets the duty cycle from the speed error every LOOP_PERIOD,
+    PWM_duty is then only the startup duty. SPEED_REF is the speed magnitude in rad/s,
+    the direction is the one of the commutation sequence (speed taken in that direction,
+    a rotor turning backwards is a larger error).
+    The gains were checked with CONTROLLER = 'sensorless': from the 75 rad/s the startup
+    locks at, the speed is within 1 % of SPEED_REF = 80, 100 or 120 rad/s 140 ms into
+    the run, with less than 1 % overshoot. The loop can only raise the torque and
+    the static friction (T_fstatic) holds the speed once the torque drops below it, so a
+    reference below the current speed ends where the torque gives way.
+    The 'six_step' angle controller gives a torque changing sign over the electrical turn
+    (see six_step_pattern in control.py), no gains make it hold a speed.
+CURRENT_LOOP: Inner PI loop, the speed loop then sets a current reference (up to
+    CURRENT_MAX, in A) and the current loop the duty. The current is the one leaving
+    through the low side switch (control.low_side_current), averaged over LOOP_PERIOD.
+    SPEED_KP / SPEED_KI are then in A and need retuning, with 0.01 / 0.1 the sensorless
+    controller is at 98 rad/s (SPEED_REF = 100) 280 ms into the run.
+'''
+SPEED_LOOP = False
+SPEED_REF = 80.
+SPEED_KP = 0.003       # duty (or A) per rad/s
+SPEED_KI = 0.2         # duty (or A) per rad
+CURRENT_LOOP = False
+CURRENT_MAX = 5.
+CURRENT_KP = 0.02      # duty per A
+CURRENT_KI = 100.      # duty per A.s
+LOOP_PERIOD = 1e-4
+'''
+FOC_MODULATION: 'svpwm' or 'sinusoidal' duty generation of the FOC controller (see foc.modulate)
+FOC_KP, FOC_KI: Gains of the d / q current PI loops, run once per PWM cycle
+FOC_IQ_REF: q axis (torque) current reference in A without SPEED_LOOP, i_d is held at 0.
+    With SPEED_LOOP the speed PI sets it (SPEED_KP / SPEED_KI in A, see foc.FocLoop)
+'''
+FOC_MODULATION = 'svpwm'
+FOC_KP = 8.            # V per A
+FOC_KI = 35000.        # V per A.s
+FOC_IQ_REF = 1.5
+'''
+COSIM_TARGET: Controller of CONTROLLER = 'cosim', a shared library (.so) called in process
+    or an executable started with the name of the shared memory ring as argument.
+    None builds and loads the six step stub (cosim_stub.c, needs a C compiler).
+'''
+COSIM_TARGET = None
 
 '''
 1. DIODE OPEN VS CLOSED
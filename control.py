@@ -21,119 +21,455 @@ import numpy as np
 import math
 
 import dyn_model  as dm
+import params     as prm
 import utils
+import foc
+import cosim
 import config
 
-PWM_freq = 16000.
-PWM_cycle_time = (1./PWM_freq)
-PWM_duty = 0.6
-PWM_duty_time = PWM_cycle_time * PWM_duty
-
+# PWM frequency and duty cycle are inverter parameters (config.PWM_freq / PWM_duty,
+# params.InverterParams), the controllers take them from the params they are given
 debug = False
 
+'''
+Commutation table
+@brief:
+    Six step pattern (see docs/control_strategies.md): one low side switch and one
+    PWM'd high side switch per 60 degree sector, sector 0 starting at -pi/6.
+    The table is built once, the sector of an electrical angle is
+        k = floor((angle + pi/6) / (pi/3)) mod 6
+    so a lookup is a single index. Switch states are kept both as U vectors and
+    as bitmasks (bit i set when switch i is on), per sector for the PWM on and
+    off parts of the cycle. switches_v() looks up arrays of angles for batched runs.
+    apply() sets the high side switch to any value, 0 / 1 on PWM edges or the
+    duty cycle itself with averaged PWM (see high_side()).
+'''
+SECTOR = math.pi / 3.
+SECTOR_OFFSET = math.pi / 6.
+# Sign of omega the six step sequences drive with the phase order of dyn_model (backwards)
+COMMUTATION_DIRECTION = -1.
+
+# (low side, high side PWM) switch per sector
+#? This is the pattern the controller has always applied, it pairs the switches
+#? differently from the list in docs/control_strategies.md (e.g. lw, hu instead of lv, hu
+#? for [PI/6->3PI/6]), so each pair is held for 120 degrees.
+six_step_pattern = [
+    (dm.iv_lv, dm.iv_hw),
+    (dm.iv_lw, dm.iv_hu),
+    (dm.iv_lw, dm.iv_hu),
+    (dm.iv_lu, dm.iv_hv),
+    (dm.iv_lu, dm.iv_hv),
+    (dm.iv_lv, dm.iv_hw),
+]
+
+class CommutationTable:
+    def __init__(self, pattern):
+        self.low = np.array([low for low, high in pattern])
+        self.high = np.array([high for low, high in pattern])
+        n = len(pattern)
+        # U[pwm_on, sector, :]
+        self.U = np.zeros((2, n, config.N_SWITCHES))
+        self.U[:, np.arange(n), self.low] = 1
+        self.U[1, np.arange(n), self.high] = 1
+        self.masks = np.packbits(self.U.astype(np.uint8), axis=2, bitorder='little')[:,:,0]
+        self.H = self.U[1] - self.U[0]   # high side switch per sector
+
+    def sector(self, elec_angle):
+        return int(math.floor((elec_angle + SECTOR_OFFSET) / SECTOR)) % 6
+
+    def sector_v(self, elec_angle):
+        return np.floor((elec_angle + SECTOR_OFFSET) / SECTOR).astype(np.intp) % 6
+
+    def switches(self, elec_angle, pwm_on):
+        return self.U[int(pwm_on), self.sector(elec_angle)].copy()
+
+    def switches_v(self, elec_angle, pwm_on):
+        return self.U[np.asarray(pwm_on, dtype=np.intp), self.sector_v(elec_angle)]
+
+    def mask(self, elec_angle, pwm_on):
+        return self.masks[int(pwm_on), self.sector(elec_angle)]
+
+    # Switches of a sector with the high side switch at `high`
+    def apply(self, sector, high):
+        return self.U[0, sector] + high * self.H[sector]
+
+commutation_table = CommutationTable(six_step_pattern)
+
+# High side on at t, for the duty cycle of params when not given
+def pwm_on(t, params=None, duty=None):
+    inverter = (params or prm.default()).inverter
+    duty_time = inverter.PWM_duty_time if duty is None else inverter.PWM_cycle_time * duty
+    return math.fmod(t, inverter.PWM_cycle_time) <= duty_time
+
+# Value of the PWM'd high side switch: 1 / 0 on the PWM edges, the duty itself with averaged PWM
+def high_side(t, duty, params):
+    if params.inverter.averaged:
+        return duty
+    return 1. if pwm_on(t, params, duty) else 0.
+
+'''
+Speed and current loops
+@brief:
+    PI controllers run every LOOP_PERIOD (like the MCU control ISR) and hold the
+    duty cycle in between. The speed loop sets the duty from the speed error,
+    or with CURRENT_LOOP the reference of the current loop which then sets the
+    duty. Outputs are clamped and so is the integral (anti windup). The loops
+    start from PWM_duty and the measured current so switching them on does not
+    kick the motor.
+    The speed is taken in the direction of the commutation sequence, a rotor
+    turning the other way is a larger error than a standing one.
+'''
+class PI:
+    def __init__(self, kp, ki, period, out_min, out_max, out=0.):
+        self.kp = kp
+        self.ki_period = ki * period
+        self.out_min = out_min
+        self.out_max = out_max
+        self.integral = out
+
+    def update(self, error):
+        self.integral = min(max(self.integral + self.ki_period * error, self.out_min), self.out_max)
+        return min(max(self.kp * error + self.integral, self.out_min), self.out_max)
+
+class DutyLoop:
+    def __init__(self, params):
+        control = params.control
+        self.params = params
+        self.duty = params.inverter.PWM_duty
+        if control.CURRENT_LOOP:
+            self.speed_pi = PI(control.SPEED_KP, control.SPEED_KI, control.LOOP_PERIOD, 0., control.CURRENT_MAX)
+            self.current_pi = PI(control.CURRENT_KP, control.CURRENT_KI, control.LOOP_PERIOD, 0., 1., self.duty)
+        else:
+            self.speed_pi = PI(control.SPEED_KP, control.SPEED_KI, control.LOOP_PERIOD, 0., 1., self.duty)
+            self.current_pi = None
+        self.i_ref = 0.
+        self.next_update = -math.inf
+        # Current samples since the last update, the loop runs on their mean
+        self.i_sum = 0.
+        self.i_count = 0
+
+    # Duty cycle at t, speed (rad/s, positive in the commutation direction) measured or estimated
+    # by the caller, current from low_side_current
+    def update(self, t, speed, current):
+        self.i_sum += current
+        self.i_count += 1
+        if t < self.next_update:
+            return self.duty
+        control = self.params.control
+        current = self.i_sum / self.i_count
+        self.i_sum, self.i_count = 0., 0
+        if self.next_update == -math.inf:
+            self.next_update = t
+            if self.current_pi is not None:
+                self.speed_pi.integral = min(max(current, 0.), control.CURRENT_MAX)
+        self.next_update += control.LOOP_PERIOD * (math.floor((t - self.next_update) / control.LOOP_PERIOD) + 1)
+        out = self.speed_pi.update(abs(control.SPEED_REF) - speed)
+        if self.current_pi is None:
+            self.duty = out
+        else:
+            self.i_ref = out
+            self.duty = self.current_pi.update(self.i_ref - current)
+        return self.duty
+
+'''
+Motor current seen by the current loop
+@brief:
+    Current leaving the motor through the phase(s) whose low side switch is on
+    in U, like a low side shunt measures it. The low side stays on for the
+    whole sector with H-PWM L-ON, so the value does not depend on the PWM
+    state; it is negative when the back-emf drives current into the supply.
+'''
+def low_side_current(Y, U):
+    return -sum(Y[dm.ov_iu + p] for p in range(3) if U[2 * p] > 0)
+
 '''  Switching angle based on actual mechanical (And thus electrical / (nPoles/2)) angle measurement
 The switching pattern below uses the electrical angle to set the right switches at the right time.
 The on-time depends on the duty cycle and the pwm-frequency. 
 The startup is not handled, apparently the power is large enough to make the motor simply start running.
 
 '''
-def run_hpwm_l_on_bipol(Y, t):
-    
+def run_hpwm_l_on_bipol(Y, t, params=None):
+    params = params or prm.default()
+
     # Get the electrical angle
-    elec_angle = utils.angle_2pi(Y[dm.ov_theta] * config.NbPoles/2)
+    elec_angle = Y[dm.ov_theta] * params.motor.pole_pairs
+    step = commutation_table.sector(elec_angle)
 
     # Switch states
-    U = np.zeros(config.N_SWITCHES)
-
-    step = "none"
-
-    # Switching pattern based on the "encoder"
-    upper_b_arr = (math.pi/6.)*np.array([1., 3., 5., 7., 9., 11., 12.], dtype=np.float64)
-    upper_sw_arr = np.array([dm.iv_hw, dm.iv_hu, dm.iv_hu, dm.iv_hv, dm.iv_hv, dm.iv_hw, dm.iv_hw])
-    lower_b_arr = upper_b_arr - np.pi/6 # first and last step in steps of pi/6
-    lower_b_arr[1:6] -= np.pi/6 # Everything between 1 and 6 in steps of pi/3
-    lower_sw_arr = np.array([dm.iv_lv, dm.iv_lw, dm.iv_lw, dm.iv_lu, dm.iv_lu, dm.iv_lv, dm.iv_lv])
-
-    # print(lower_b_arr)
-    for step in range(len(upper_b_arr)+1):
-        #print(f"lower: {lower_b_arr[step]} < {elec_angle} < {upper_b_arr[step]}")
-        if lower_b_arr[step] <= np.float(elec_angle) <= upper_b_arr[step]: # second half of step 1
-            # print(f"Step: {step}, angle: {elec_angle}")
-            U[lower_sw_arr[step]] = 1
-            if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-                U[upper_sw_arr[step]] = 1
-            break
-
-    #? Why are v and w phases here switched in order to make it work?
-    #? Something to do with switching rotation direction
-    # hv = U[dm.iv_hv]
-    # lv = U[dm.iv_lv]
-    # hw = U[dm.iv_hw]
-    # lw = U[dm.iv_lw]
-
-    # U[dm.iv_hv] = hw
-    # U[dm.iv_lv] = lw
-    # U[dm.iv_hw] = hv
-    # U[dm.iv_lw] = lv
+    U = commutation_table.apply(step, high_side(t, params.inverter.PWM_duty, params))
 
     if debug:
-        print(f'time {t} step {step} eangle {utils.ANGLE_DEG2RAD * elec_angle} switches {U}')
+        print(f'time {t} step {step} eangle {utils.ANGLE_DEG2RAD * utils.angle_2pi(elec_angle)} switches {U}')
 
     return U
 
+'''
+Six step controller with speed / current loops
+@brief:
+    run_hpwm_l_on_bipol with the duty cycle of a DutyLoop instead of PWM_duty.
+'''
+class SixStepController:
+    def __init__(self, params=None, table=commutation_table):
+        self.params = params or prm.SimConfig()
+        self.table = table
+        self.loop = DutyLoop(self.params)
+
+    def __call__(self, Y, t, params=None):
+        step = self.table.sector(Y[dm.ov_theta] * self.params.motor.pole_pairs)
+        duty = self.loop.update(t, COMMUTATION_DIRECTION * Y[dm.ov_omega], low_side_current(Y, self.table.apply(step, 0.)))
+        return self.table.apply(step, high_side(t, duty, self.params))
+
 ###
 ### Sensorless control
 ###
-# Enable 2 phases at a time
-# Get the non-excited phase
-# Get the phase voltage there
-# If this phase voltage crosses zero compared to the neutral point: change switching sequence
+'''
+Sensorless six step commutation
+@brief:
+    Two phases are driven at a time, the third one floats and shows its back-emf.
+    The steps follow docs/control_strategies.md, each pair is held for 60 degrees
+    so every step has a floating phase. Its back-emf crosses the neutral 30
+    degrees into the step when the rotor is in phase with the commutation.
+    With the phase order of dyn_model the sequence turns the rotor backwards,
+    like the angle controller does.
+    Like the firmware the controller only sees the terminal voltages of the
+    output vector Y:
+    - ADC: the floating phase is sampled every params.control.ADC_period at the
+      middle of the PWM on-time (samples falling into the off-time are dropped)
+      and compared against the virtual neutral (vu + vv + vw) / 3.
+    - zero crossing: after the blanking time following a commutation, ZC_FILTER
+      consecutive samples past the neutral confirm a crossing, its time is
+      interpolated between the last two samples (the end of the blanking when the
+      phase is already past the neutral, the rotor is then ahead). Samples with the
+      phase at a rail (diode freewheeling) are skipped.
+    - timer: the time between crossings (60 degrees) is low pass filtered, the
+      commutation timer is set to the crossing + half of it (30 degrees) and
+      fires on the first call at or after that time. Without a crossing for two
+      periods the step is forced and counts as a period that long.
+    - startup: the rotor is aligned on step 0 for STARTUP_ALIGN_TIME, then the
+      steps are forced with a period ramping from STARTUP_STEP_START to
+      STARTUP_STEP_END. A step with a crossing already ends on the timer, so
+      the commutation waits for a lagging rotor. After ZC_LOCK consecutive steps
+      with a crossing the ramp is left for good. The startup is started over when the ramp has not
+      locked after twice its time, or after ZC_LOCK forced steps in a row.
+    With SPEED_LOOP the duty cycle comes from a DutyLoop once the timer has
+    taken over, fed with the speed estimated from the filtered period.
+    Every call is O(1) with a fixed set of state variables, no sample history.
+    Call it like run(): U = controller(Y, t), one call per simulation step.
+'''
+sensorless_pattern = [
+    (dm.iv_lv, dm.iv_hw),
+    (dm.iv_lv, dm.iv_hu),
+    (dm.iv_lw, dm.iv_hu),
+    (dm.iv_lw, dm.iv_hv),
+    (dm.iv_lu, dm.iv_hv),
+    (dm.iv_lu, dm.iv_hw),
+]
 
-def sensorless(Y, t):
-    
-    # Get the electrical angle
-    elec_angle = utils.angle_2pi(Y[dm.ov_theta] * config.NbPoles/2)
+sensorless_table = CommutationTable(sensorless_pattern)
 
-    # Switch states
-    U = np.zeros(config.N_SWITCHES)
-
-    step = "none"
-
-    # Switching pattern based on the "encoder"
-    upper_b_arr = (math.pi/6.)*np.array([1., 3., 5., 7., 9., 11., 12.], dtype=np.float64)
-    upper_sw_arr = np.array([dm.iv_hw, dm.iv_hu, dm.iv_hu, dm.iv_hv, dm.iv_hv, dm.iv_hw, dm.iv_hw])
-    lower_b_arr = upper_b_arr - np.pi/6 # first and last step in steps of pi/6
-    lower_b_arr[1:6] -= np.pi/6 # Everything between 1 and 6 in steps of pi/3
-    lower_sw_arr = np.array([dm.iv_lv, dm.iv_lw, dm.iv_lw, dm.iv_lu, dm.iv_lu, dm.iv_lv, dm.iv_lv])
-
-    # print(lower_b_arr)
-    for step in range(len(upper_b_arr)+1):
-        #print(f"lower: {lower_b_arr[step]} < {elec_angle} < {upper_b_arr[step]}")
-        if lower_b_arr[step] <= np.float(elec_angle) <= upper_b_arr[step]: # second half of step 1
-            # print(f"Step: {step}, angle: {elec_angle}")
-            U[lower_sw_arr[step]] = 1
-            if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-                U[upper_sw_arr[step]] = 1
-            break
-
-    hv = U[dm.iv_hv]
-    lv = U[dm.iv_lv]
-    hw = U[dm.iv_hw]
-    lw = U[dm.iv_lw]
-
-    U[dm.iv_hv] = hw
-    U[dm.iv_lv] = lw
-    U[dm.iv_hw] = hv
-    U[dm.iv_lw] = lv
+# Controller modes
+mode_align = 0
+mode_ramp = 1
+mode_closed = 2
 
-    if debug:
-        print(f'time {t} step {step} eangle {utils.ANGLE_DEG2RAD * elec_angle} switches {U}')
+# Period low pass filter gain, new = old + (measured - old) * ZC_PERIOD_GAIN
+ZC_PERIOD_GAIN = 0.25
 
-    return U
+class SensorlessController:
+    def __init__(self, params=None, table=sensorless_table):
+        self.params = params or prm.SimConfig()
+        self.table = table
+        phases = [{low // 2, high // 2} for low, high in zip(table.low, table.high)]
+        n = len(phases)
+        # Floating phase per step, and whether its back-emf rises through the neutral
+        # (the phase was driven low in the step before)
+        self.floating = [({0, 1, 2} - p).pop() for p in phases]
+        self.rising = [self.floating[k] == table.low[k-1] // 2 for k in range(n)]
+        self.reset()
+
+    def reset(self, t=0.):
+        self.stats = {'commutations': 0, 'zero_crossings': 0, 'forced': 0, 'missed': 0, 'restarts': 0,
+                      'lock_time': None}
+        self.restart(t)
+
+    # Back to the startup alignment
+    def restart(self, t):
+        control = self.params.control
+        self.loop = DutyLoop(self.params) if control.SPEED_LOOP else None
+        self.mode = mode_align
+        self.step = 0
+        self.t_step = t                                # last commutation
+        self.t_ramp = t + control.STARTUP_ALIGN_TIME   # start of the forced ramp
+        self.t_commutate = math.inf                    # commutation timer compare value
+        self.step_period = control.STARTUP_STEP_START  # filtered 60 degree period
+        self.t_zc = -math.inf                          # last zero crossing
+        self.zc_step = False                           # crossing seen in this step
+        self.n_lock = 0                                # consecutive steps with a crossing
+        self.n_missed = 0                              # consecutive forced steps in closed loop
+        self.n_past = 0                                # consecutive samples past the neutral
+        self.seen_before = False                       # sample before the neutral in this step
+        self.t_cross = 0.
+        self.t_sample = -math.inf                      # last accepted sample and its distance
+        self.d_sample = 0.                             # to the neutral
+        self.next_sample = t + self.params.inverter.PWM_duty_time / 2.
+
+    def ramp_period(self, t):
+        control = self.params.control
+        x = min(max((t - self.t_ramp) / control.STARTUP_RAMP_TIME, 0.), 1.)
+        return control.STARTUP_STEP_START + x * (control.STARTUP_STEP_END - control.STARTUP_STEP_START)
+
+    def commutate(self, t):
+        self.step = (self.step + 1) % len(self.floating)
+        self.t_step = t
+        self.t_commutate = math.inf
+        self.zc_step = False
+        self.n_past = 0
+        self.seen_before = False
+        self.stats['commutations'] += 1
+
+    def zero_crossing(self, t_zc):
+        measured = t_zc - self.t_zc
+        if measured < 2 * self.step_period:
+            # Crossing of the previous step, 60 degrees ago
+            self.step_period += (measured - self.step_period) * ZC_PERIOD_GAIN
+        self.t_zc = t_zc
+        self.zc_step = True
+        self.n_lock += 1
+        self.n_missed = 0
+        self.stats['zero_crossings'] += 1
+        if self.mode == mode_ramp and self.n_lock >= self.params.control.ZC_LOCK:
+            self.mode = mode_closed
+            self.stats['lock_time'] = t_zc
+        self.t_commutate = t_zc + self.step_period / 2.
+
+    def sample(self, Y, t):
+        control, inverter = self.params.control, self.params.inverter
+        v = Y[dm.ov_vu + self.floating[self.step]]
+        if (t < self.t_step + control.ZC_BLANKING * self.step_period) or v < 0. or v > inverter.VDC:
+            return
+        neutral = (Y[dm.ov_vu] + Y[dm.ov_vv] + Y[dm.ov_vw]) / 3.
+        d = v - neutral if self.rising[self.step] else neutral - v
+        if d > 0.:
+            if self.n_past == 0:
+                # Crossing between the last two samples
+                if self.seen_before:
+                    self.t_cross = self.t_sample + (t - self.t_sample) * (-self.d_sample / (d - self.d_sample))
+                else:
+                    # Already past when the blanking ended, the rotor is ahead
+                    self.t_cross = self.t_step + control.ZC_BLANKING * self.step_period
+            self.n_past += 1
+            if self.n_past >= control.ZC_FILTER:
+                self.zero_crossing(self.t_cross)
+        else:
+            self.n_past = 0
+            self.seen_before = True
+        self.t_sample, self.d_sample = t, d
+
+    def __call__(self, Y, t, params=None):
+        if self.mode == mode_align:
+            if t >= self.t_ramp:
+                self.mode = mode_ramp
+                self.commutate(t)
+        elif self.mode == mode_ramp:
+            if t - self.t_ramp >= 2 * self.params.control.STARTUP_RAMP_TIME:
+                self.stats['restarts'] += 1
+                self.restart(t)
+            elif self.zc_step:
+                if t >= self.t_commutate:
+                    self.commutate(t)
+            elif t - self.t_step >= self.ramp_period(t):
+                self.step_period = self.ramp_period(t)
+                self.n_lock = 0
+                self.stats['forced'] += 1
+                self.commutate(t)
+        elif t >= self.t_commutate:
+            self.commutate(t)
+        elif t - self.t_step >= 2 * self.step_period:
+            # No crossing, keep turning at the estimated speed
+            self.step_period += (t - self.t_step - self.step_period) * ZC_PERIOD_GAIN
+            self.n_lock = 0
+            self.n_missed += 1
+            self.stats['missed'] += 1
+            if self.n_missed >= self.params.control.ZC_LOCK:
+                self.stats['restarts'] += 1
+                self.restart(t)
+            else:
+                self.commutate(t)
+
+        duty = self.params.inverter.PWM_duty
+        if self.loop is not None and self.mode == mode_closed:
+            speed = SECTOR / (self.step_period * self.params.motor.pole_pairs)
+            duty = self.loop.update(t, speed, low_side_current(Y, self.table.apply(self.step, 0.)))
+        high = high_side(t, duty, self.params)
+
+        if t >= self.next_sample:
+            control = self.params.control
+            # Next sample on the ADC grid, several periods may have passed with large steps
+            self.next_sample += control.ADC_period * (math.floor((t - self.next_sample) / control.ADC_period) + 1)
+            if self.mode != mode_align and not self.zc_step and high > 0:
+                self.sample(Y, t)
+
+        U = self.table.apply(self.step, high)
+
+        if debug:
+            print(f'time {t} step {self.step} mode {self.mode} switches {U}')
+
+        return U
+
+###
+### Field oriented control
+###
+'''
+FOC controller
+@brief:
+    Sinusoidal phase currents from the measured rotor angle and phase currents,
+    the d / q loops and modulation of foc.FocLoop, every leg PWM'd complementary
+    (foc.leg_switches). Suits sinusoidal back-emf motors (BEMF_SHAPE), runs
+    trapezoidal ones too with more torque ripple.
+'''
+class FocController:
+    def __init__(self, params=None):
+        self.params = params or prm.SimConfig()
+        self.loop = foc.FocLoop(self.params.control)
+
+    def __call__(self, Y, t, params=None):
+        motor, inverter = self.params.motor, self.params.inverter
+        duty = self.loop.update(t, np.asarray(Y[dm.ov_iu:dm.ov_iw+1]), Y[dm.ov_theta] * motor.pole_pairs,
+                                Y[dm.ov_omega], inverter.VDC, inverter.PWM_cycle_time)
+        U = foc.leg_switches(duty, t, inverter.PWM_cycle_time, inverter.averaged)
+
+        if debug:
+            print(f'time {t} duty {duty} switches {U}')
+
+        return U
+
+'''
+Controller of a run
+@brief:
+    The controller selected by params.control.CONTROLLER (and SPEED_LOOP) as a
+    callable U = controller(Y, t, params). Stateful controllers get a new
+    instance per run; a 'cosim' controller holds a shared memory ring and a
+    controller process, close() it when the run is done.
+'''
+def make_controller(params=None):
+    params = params or prm.SimConfig()
+    if params.control.CONTROLLER == 'sensorless':
+        return SensorlessController(params)
+    if params.control.CONTROLLER == 'foc':
+        return FocController(params)
+    if params.control.CONTROLLER == 'cosim':
+        return cosim.make_controller(params)
+    if params.control.SPEED_LOOP:
+        return SixStepController(params)
+    return run
+
+# True when make_controller gives the stateless six step angle controller (run)
+def is_angle_controller(params):
+    return params.control.CONTROLLER == 'six_step' and not params.control.SPEED_LOOP
 
 #
-# Sp setpoint, Y output
+# Sp setpoint, Y output, params the params.SimConfig of the run (config preset when None)
 #
-def run(Y, t):
+def run(Y, t, params=None):
     #return run_hpwm_l_on(Sp, Y, t)
-    return run_hpwm_l_on_bipol(Y, t)
+    return run_hpwm_l_on_bipol(Y, t, params)
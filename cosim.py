@@ -0,0 +1,283 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import ctypes
+import hashlib
+import platform
+import tempfile
+import subprocess
+import time as tm
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import params     as prm
+import recorder   as rec
+import config
+
+'''
+Co-simulation bridge
+@brief:
+    Runs compiled controller code (the Open-BLDC control code, or the stub in
+    cosim_stub.c) against the model. Every controller call of sim_1 is one
+    control tick: the model writes (t, Y) into the next slot of a shared memory
+    ring and publishes it by bumping y_seq, the controller answers with the
+    switch word (bit i = switch i) in the same slot and bumps u_seq; the model
+    waits for it (lock step). No pipe or socket on the way. The controller is
+    either
+    - a shared library loaded with ctypes, its cosim_tick(ring) called in
+      process right after the sample is published (library_controller), a few
+      microseconds per tick, or
+    - a separate process attached to the ring by its name (process_controller).
+      Both sides poll the sequence counters and yield the CPU after SPINS
+      polls, so the tick stays in the microseconds on separate cores and costs
+      two context switches when they share one.
+    The ring header also carries the motor pole pairs and the PWM timing of the
+    run, the controller does its own PWM like the MCU timers do. The layout is
+    described in cosim_stub.c.
+    Memory ordering: numpy stores and loads carry no barrier. On x86 (TSO)
+    stores are seen in program order, so publishing Y before y_seq and reading
+    u_seq before U is enough. On other machines a controller process could see
+    y_seq before Y, there the model goes through cosim_publish() /
+    cosim_answered() of the stub library (release / acquire atomics).
+'''
+MAGIC = 0x4d49534f
+VERSION = 1
+RING_SLOTS = 64
+# Seconds without an answer before the model gives up on the controller
+TIMEOUT = 5.
+# Polls of u_seq before the waiting model starts yielding the CPU
+SPINS = 64
+
+# Byte offsets, the sequence counters on their own cache lines
+_Y_SEQ, _U_SEQ, _STOP, _PARAMS, _SLOTS = 64, 128, 192, 256, 320
+_SLOT_SIZE = 8 * (config.N_OUTPUT_VARS + 2)
+
+STUB_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cosim_stub.c')
+# Machines whose stores and loads are ordered like the ring needs without barriers
+TSO_MACHINES = ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+
+# U vector of every switch word
+_words = rec.unpack_switches(np.arange(1 << config.N_SWITCHES, dtype=np.uint8))
+
+class Ring:
+    def __init__(self, name=None, slots=RING_SLOTS):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=_SLOTS + (slots * _SLOT_SIZE))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self.header = np.ndarray((4,), np.uint32, buf, 0)
+        if self.owner:
+            self.header[:] = (MAGIC, VERSION, slots, config.N_OUTPUT_VARS)
+        elif self.header[0] != MAGIC or self.header[1] != VERSION:
+            raise ValueError(f"ERR: {name} is not a co-simulation ring of version {VERSION}")
+        self.slots = int(self.header[2])
+        self.y_seq = np.ndarray((1,), np.uint64, buf, _Y_SEQ)
+        self.u_seq = np.ndarray((1,), np.uint64, buf, _U_SEQ)
+        self.stop = np.ndarray((1,), np.uint64, buf, _STOP)
+        self.params = np.ndarray((3,), np.float64, buf, _PARAMS)
+        slot = np.ndarray((self.slots, config.N_OUTPUT_VARS + 2), np.float64, buf, _SLOTS)
+        self.t = slot[:, 0]
+        self.Y = slot[:, 1:1+config.N_OUTPUT_VARS]
+        self.U = slot[:, 1+config.N_OUTPUT_VARS].view(np.uint64)
+        self.address = self.header.ctypes.data
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Run parameters the controller reads from the header
+    def set_params(self, params):
+        self.params[:] = (params.motor.pole_pairs, params.inverter.PWM_cycle_time,
+                          params.inverter.PWM_duty_time)
+
+    def close(self):
+        if self.shm is None:
+            return
+        # The views hold the buffer, drop them first
+        self.header = self.y_seq = self.u_seq = self.stop = self.params = None
+        self.t = self.Y = self.U = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+'''
+Co-simulation controller
+@brief:
+    U = controller(Y, t, params) like the other sim_1 controllers, the answer
+    comes from the other side of the ring. `serve` is called with the ring
+    address after every published sample (in process library), without it the
+    model waits until the controller process answers or `timeout` passes.
+    `atomics` (the stub library, see atomics_library) orders the sequence
+    counters for a controller process on a machine that is not x86.
+    stats() gives the ticks and the mean wall time of one exchange.
+'''
+class CosimController:
+    def __init__(self, ring, params=None, serve=None, process=None, timeout=TIMEOUT, atomics=None):
+        self.ring = ring
+        self.serve = serve
+        self.process = process
+        self.timeout = timeout
+        self.atomics = atomics
+        self.seq = int(ring.y_seq[0])
+        self.exchange_time = 0.
+        ring.set_params(params or prm.SimConfig())
+
+    def __call__(self, Y, t, params=None):
+        ring = self.ring
+        t0 = tm.perf_counter()
+        seq = self.seq
+        k = seq % ring.slots
+        ring.t[k] = t
+        ring.Y[k] = Y
+        atomics = self.atomics
+        if atomics is None:
+            ring.y_seq[0] = seq + 1
+            u_seq = ring.u_seq
+            answered = lambda: u_seq[0]
+        else:
+            atomics.cosim_publish(ring.address, seq + 1)
+            answered = lambda: atomics.cosim_answered(ring.address)
+        if self.serve is not None:
+            self.serve(ring.address)
+        spins = 0
+        while answered() <= seq:
+            spins += 1
+            if spins > SPINS:
+                # Let the controller process run when it shares the core
+                os.sched_yield()
+                if (spins & 0xfff) == 0:
+                    self._check(t0)
+        self.seq = seq + 1
+        U = _words[int(ring.U[k]) & 0x3f].copy()
+        self.exchange_time += tm.perf_counter() - t0
+        return U
+
+    def _check(self, t0):
+        if self.process is not None and self.process.poll() is not None:
+            raise RuntimeError(f"ERR: controller process exited with {self.process.returncode}")
+        if tm.perf_counter() - t0 > self.timeout:
+            raise TimeoutError(f"ERR: no answer from the controller for {self.timeout} s")
+
+    def stats(self):
+        return {
+            'ticks': self.seq,
+            'exchange_time': self.exchange_time,
+            'per_tick': self.exchange_time / self.seq if self.seq else 0.,
+        }
+
+    def close(self):
+        if self.ring is None:
+            return
+        self.ring.stop[0] = 1
+        if self.process is not None:
+            try:
+                self.process.wait(self.timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.ring.close()
+        self.ring = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+'''
+Build the stub controller
+@brief:
+    Compiles cosim_stub.c (or `source`, same interface) with the C compiler
+    `cc` into out_dir as a shared library and an executable. Returns (library
+    path, executable path). Without out_dir the build goes to a directory of
+    the temporary directory named after the hash of the source and the
+    compiler, and is reused while those do not change, so runs do not compile
+    (or leave behind) a copy each.
+'''
+def build_stub(out_dir=None, source=STUB_SOURCE, cc='cc'):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    if out_dir is None:
+        with open(source, 'rb') as f:
+            digest = hashlib.sha256(f.read() + b'\0' + cc.encode()).hexdigest()[:16]
+        out_dir = os.path.join(tempfile.gettempdir(), f"pysim_{stem}_{digest}")
+        lib, exe = os.path.join(out_dir, f"lib{stem}.so"), os.path.join(out_dir, stem)
+        if os.path.exists(lib) and os.path.exists(exe):
+            return lib, exe
+    os.makedirs(out_dir, exist_ok=True)
+    lib = os.path.join(out_dir, f"lib{stem}.so")
+    exe = os.path.join(out_dir, stem)
+    # Built next to the target and renamed, a concurrent run never loads half a file
+    tmp = f".{os.getpid()}"
+    try:
+        subprocess.run([cc, '-O2', '-shared', '-fPIC', source, '-o', lib + tmp, '-lm'], check=True)
+        subprocess.run([cc, '-O2', '-DCOSIM_MAIN', source, '-o', exe + tmp, '-lm', '-lrt'], check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"ERR: building {source} failed: {e}")
+    os.replace(lib + tmp, lib)
+    os.replace(exe + tmp, exe)
+    return lib, exe
+
+# Stub library with the sequence counter atomics, None on x86 where they are not needed
+def atomics_library():
+    if platform.machine().lower() in TSO_MACHINES:
+        return None
+    lib = ctypes.CDLL(build_stub()[0])
+    lib.cosim_publish.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
+    lib.cosim_publish.restype = None
+    lib.cosim_answered.argtypes = [ctypes.c_void_p]
+    lib.cosim_answered.restype = ctypes.c_uint64
+    return lib
+
+# Controller running cosim_tick() of a shared library in process
+def library_controller(path, params=None, slots=RING_SLOTS):
+    lib = ctypes.CDLL(os.path.abspath(path))
+    lib.cosim_tick.argtypes = [ctypes.c_void_p]
+    lib.cosim_tick.restype = ctypes.c_int
+    controller = CosimController(Ring(slots=slots), params, serve=lib.cosim_tick)
+    controller.lib = lib
+    return controller
+
+# Controller in a separate process, started as `command` + [ring name]
+def process_controller(command, params=None, slots=RING_SLOTS, timeout=TIMEOUT):
+    ring = Ring(slots=slots)
+    command = [command] if isinstance(command, str) else list(command)
+    atomics = atomics_library()
+    process = subprocess.Popen(command + [ring.name])
+    return CosimController(ring, params, process=process, timeout=timeout, atomics=atomics)
+
+'''
+Controller of COSIM_TARGET
+@brief:
+    For CONTROLLER = 'cosim': a shared library (.so / .dylib / .dll) runs in
+    process, anything else is started as the controller process. Without a
+    target the stub is built and loaded.
+'''
+def make_controller(params=None):
+    params = params or prm.SimConfig()
+    target = params.control.COSIM_TARGET
+    if target is None:
+        target = build_stub()[0]
+    if os.path.splitext(target)[1] in ('.so', '.dylib', '.dll'):
+        return library_controller(target, params)
+    return process_controller(target, params)
@@ -0,0 +1,160 @@
+/*
+ * Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+ * Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+ * Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * Stub controller for the co-simulation bridge (cosim.py)
+ *
+ * The six step H-PWM-L-ON pattern of control.run_hpwm_l_on_bipol, written
+ * against the shared memory ring of cosim.py like firmware control code
+ * would be. Built two ways:
+ *   cc -O2 -shared -fPIC cosim_stub.c -o libcosim_stub.so -lm
+ *       cosim_tick() is called in process through ctypes
+ *   cc -O2 -DCOSIM_MAIN cosim_stub.c -o cosim_stub -lm -lrt
+ *       a separate process: cosim_stub <shared memory name>
+ * Ring layout (little endian, offsets in bytes, see cosim.py):
+ *   0    magic, version, slots, y size (uint32)
+ *   64   y_seq  samples published by the model (uint64)
+ *   128  u_seq  samples answered by the controller (uint64)
+ *   192  stop   set by the model when done (uint64)
+ *   256  pole pairs, PWM cycle time, PWM duty time (double)
+ *   320  slots: t, Y[y size] (double), U switch word (uint64, bit i = switch i)
+ */
+
+#include <stdint.h>
+#include <math.h>
+
+#define COSIM_MAGIC     0x4d49534fu
+#define COSIM_Y_SEQ     64
+#define COSIM_U_SEQ     128
+#define COSIM_STOP      192
+#define COSIM_PARAMS    256
+#define COSIM_SLOTS     320
+
+/* Polls of an idle ring before yielding the CPU */
+#define COSIM_SPINS     64
+
+/* Output vector index of the rotor angle (dyn_model.ov_theta) */
+#define OV_THETA        6
+
+/* Switch bits (dyn_model.iv_*) */
+#define LU  (1u << 0)
+#define HU  (1u << 1)
+#define LV  (1u << 2)
+#define HV  (1u << 3)
+#define LW  (1u << 4)
+#define HW  (1u << 5)
+
+#define SECTOR          (M_PI / 3.)
+#define SECTOR_OFFSET   (M_PI / 6.)
+
+/* (low side, PWM'd high side) per sector, control.six_step_pattern */
+static const uint64_t pattern_low[6] = { LV, LW, LW, LU, LU, LV };
+static const uint64_t pattern_high[6] = { HW, HU, HU, HV, HV, HW };
+
+/* Switch word for the output vector y at time t */
+uint64_t cosim_switches(const double *params, double t, const double *y)
+{
+	double elec_angle = y[OV_THETA] * params[0];
+	int sector = ((int)floor((elec_angle + SECTOR_OFFSET) / SECTOR) % 6 + 6) % 6;
+	uint64_t u = pattern_low[sector];
+
+	if (fmod(t, params[1]) <= params[2])
+		u |= pattern_high[sector];
+	return u;
+}
+
+/* Answer the next published sample if there is one, returns 1 when one was answered */
+int cosim_tick(void *ring)
+{
+	char *base = ring;
+	const uint32_t *header = (const uint32_t *)base;
+	uint64_t *y_seq = (uint64_t *)(base + COSIM_Y_SEQ);
+	uint64_t *u_seq = (uint64_t *)(base + COSIM_U_SEQ);
+	uint64_t seq = __atomic_load_n(u_seq, __ATOMIC_RELAXED);
+	uint32_t slots = header[2];
+	uint32_t y_size = header[3];
+	double *slot;
+
+	if (header[0] != COSIM_MAGIC || __atomic_load_n(y_seq, __ATOMIC_ACQUIRE) <= seq)
+		return 0;
+	slot = (double *)(base + COSIM_SLOTS) + (seq % slots) * (y_size + 2);
+	((uint64_t *)slot)[y_size + 1] = cosim_switches((const double *)(base + COSIM_PARAMS), slot[0], slot + 1);
+	__atomic_store_n(u_seq, seq + 1, __ATOMIC_RELEASE);
+	return 1;
+}
+
+/* Model side sequence counters with release / acquire ordering, used by
+ * cosim.py where plain stores and loads are not ordered (not x86) */
+void cosim_publish(void *ring, uint64_t seq)
+{
+	__atomic_store_n((uint64_t *)((char *)ring + COSIM_Y_SEQ), seq, __ATOMIC_RELEASE);
+}
+
+uint64_t cosim_answered(void *ring)
+{
+	return __atomic_load_n((uint64_t *)((char *)ring + COSIM_U_SEQ), __ATOMIC_ACQUIRE);
+}
+
+#ifdef COSIM_MAIN
+#include <stdio.h>
+#include <fcntl.h>
+#include <sched.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+int main(int argc, char **argv)
+{
+	char name[256];
+	struct stat st;
+	char *ring;
+	uint64_t *stop;
+	unsigned long idle = 0;
+	int fd;
+
+	if (argc != 2) {
+		fprintf(stderr, "usage: %s <shared memory name>\n", argv[0]);
+		return 2;
+	}
+	snprintf(name, sizeof(name), "%s%s", argv[1][0] == '/' ? "" : "/", argv[1]);
+	fd = shm_open(name, O_RDWR, 0);
+	if (fd < 0 || fstat(fd, &st) < 0) {
+		perror("shm_open");
+		return 1;
+	}
+	ring = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+	close(fd);
+	if (ring == MAP_FAILED) {
+		perror("mmap");
+		return 1;
+	}
+	stop = (uint64_t *)(ring + COSIM_STOP);
+
+	/* Lock step with the model: spin on y_seq, yield the CPU (the model may be
+	 * waiting for it on the same core) once it goes quiet */
+	while (!__atomic_load_n(stop, __ATOMIC_ACQUIRE)) {
+		if (cosim_tick(ring))
+			idle = 0;
+		else if (++idle > COSIM_SPINS)
+			sched_yield();
+	}
+	munmap(ring, st.st_size);
+	return 0;
+}
+#endif
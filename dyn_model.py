@@ -20,7 +20,9 @@
 
 import numpy as np
 import math
+import threading
 import utils
+import params as prm
 import config
 
 # Components of the state vector
@@ -75,167 +77,324 @@ dv_ph_star = 6
 # Used to calculate the phase backemf aka. 'e'
 #
 
-# Calculate phase voltages
-# Returns a vector of phase voltages in reference to the star point
-def get_phase_voltages(X, U):
-    emf = np.zeros(3, dtype=float)
-    max_bemf = (utils.VEL_RADS2RPM * X[sv_omega]) / config.Kv
-    for phase in range(3):
-        # Mechanical -> Electrical angle (x poles / 2)
-        angle = utils.angle_2pi((X[sv_theta] * (config.NbPoles / 2.)) + phase*2*math.pi/3)
-        emf[phase] = max_bemf * utils.trapezoid(angle)
-
-    X_currents = np.array([X[sv_iu], X[sv_iv], X[sv_iw]])
-
-    ### Check which diodes are enabled
-    #? How do we determine the neutral voltage when it is only calculable after knowing which switches are open or closed?
-    #? Perhaps we can take the previous value of the voltage vm and assume it doesn't change that quickly?
-    # D_arr = np.zeros(6)
-    # for phase in range(3):
-    #     if not (U[i*2+1] or U[i*2]):
-    #         if (X[sv_iu+i] < 0) or (emf[i]+vm > config.VDC+config.V_DF):
-    #             D_arr[i*2+1] = 1
-    #         elif (X[sv_iu+i] < 0) or (emf[i]+vm+config.V_DF < 0):
-    #             D_arr[i*2] = 1
-
-
-    ### Check which phases are excited
-    ph_en_arr = np.array([(U[iv_hu] == 1) or (U[iv_lu] == 1),
-                        (U[iv_hv] == 1) or (U[iv_lv] == 1), 
-                        (U[iv_hw] == 1) or (U[iv_lw] == 1)])
-
-    ### Diodes: u, v, w, m
-    V_arr = np.zeros(4)
-    if (not np.any(ph_en_arr)):
-        return V_arr # Voltage is zero when nothing is yet enabled
-    
-    # Case where 3/6 switches are switched (lower OR upper, can't be switched at the same time)
-    if np.all(ph_en_arr):
-        for i in range(3):
-            if (U[i*2+1] == 1):
-                V_arr[i] = config.VDC
-            else:
-                V_arr[i] = 0.
-
-        #? What happens to the voltage drops over the resistor and inductor
-        V_arr[3] = (np.sum(V_arr[:3]) - np.sum(emf)) / 3.
-        return V_arr
-
-    # Case where 2/6 switches are switched
-    for i in range(3):
-        j, k = (i+1)%3, (i+2)%3
-        # The 2 enabled phases are equal to -V_DC or +V_DC depending on the upper / lower switch setting
-        if ph_en_arr[j] and ph_en_arr[k]:
-            for i_set in [j, k]:
-                if (U[i_set*2+1] == 1):
-                    V_arr[i_set] = config.VDC
+# Phase offsets of u, v, w in electrical angle
+ph_offsets = np.arange(3) * 2 * math.pi / 3
+
+#
+# params (params.SimConfig) defaults to the config preset (params.default()) in all the functions below
+#
+def get_emf(X, params=None):
+    motor = (params or prm.default()).motor
+    max_bemf = motor.bemf_gain * X[sv_omega]
+    # Mechanical -> Electrical angle (x poles / 2)
+    # BACK-EMF IS OF TRAPEZOIDAL (OR SINUSOIDAL) SHAPE
+    return max_bemf * np.array(utils.bemf_phases(X[sv_theta] * motor.pole_pairs, motor.bemf_table))
+
+'''
+Inverter model
+@brief:
+    Every leg (phase) of the inverter is in one of five states:
+    - high / low: that switch is on, the phase sits at VDC / 0
+    - diode_low / diode_high: both switches off while current still flows, it
+      freewheels through the low side diode (positive current, phase at -V_DF)
+      or the high side diode (negative current, phase at VDC + V_DF)
+    - open: both switches off and no current, the phase floats at star + emf
+    The state follows from (switch bitmask, sign of each phase current) alone and
+    is read from leg_table, built once at import. The star voltage is the mean of
+    (terminal voltage - emf) over the conducting legs. The only thing the table
+    can not know is the emf band of an open phase: when star + emf leaves
+    [-V_DF, VDC + V_DF] that diode starts conducting, which is checked once.
+    With INVERTER_MODEL = 'ideal' the currents are not looked at (every floating
+    phase is open), which is the original model without diodes.
+    With PWM_MODE = 'averaged' the PWM'd switch holds the duty cycle instead of
+    0 / 1 and the voltages are the duty weighted mean of the inverter solved
+    with that switch on and off, so the PWM'd leg sits at about duty * VDC and
+    open phase diodes only conduct for the part of the cycle they would.
+    A leg with both switches holding a duty is PWM'd complementary (FOC, see
+    foc.leg_switches): one of its switches or diodes always conducts, so it sits
+    at U_high * VDC.
+'''
+leg_open = 0
+leg_low = 1
+leg_high = 2
+leg_diode_low = 3
+leg_diode_high = 4
+
+# Components of the diode vector (same order as the switches they are across)
+dd_lu = 0
+dd_hu = 1
+dd_lv = 2
+dd_hv = 3
+dd_lw = 4
+dd_hw = 5
+dd_size = 6
+
+def _make_leg_table():
+    # leg_table[switch mask][sign code] -> (leg u, leg v, leg w)
+    # sign code = sum(s_p * 3**p) with s_p 0: zero, 1: positive, 2: negative current in phase p
+    table = []
+    for mask in range(1 << config.N_SWITCHES):
+        row = []
+        for code in range(27):
+            legs = []
+            for p in range(3):
+                sign = (code // (3 ** p)) % 3
+                if mask & (1 << (2*p+1)):
+                    legs.append(leg_high)
+                elif mask & (1 << (2*p)):
+                    legs.append(leg_low)
+                elif sign == 1:
+                    legs.append(leg_diode_low)
+                elif sign == 2:
+                    legs.append(leg_diode_high)
                 else:
-                    V_arr[i_set] = 0.
-
-            # The star voltage is the (2 array voltages - the 2 remaining emfs) / 2
-            V_arr[3] = (V_arr[j] + V_arr[k] - emf[j] - emf[k]) / 2
-            # The remaining phase voltage is the star voltage + the EMF
-            V_arr[i] = emf[i] + V_arr[3]
-            # if (X_currents[i] != 0):
-                # raise ValueError("Current i is nonzero")
-            # if np.any(V_arr[i] > config.VDC) or np.any(V_arr[i] < 0):
-            #     raise ValueError("Freewheeling diodes conducting")
-            '''
-            Depending on the state of this 3rd voltage
-            * > config.VDC + VDIODE: upper switch freewheeling diode will conduct
-            * < -VDIODE: lower switch freewheeling diode will conduct
-            '''
-
-            return V_arr
-
-    # Case where 1/6 switch is switched
-    for i in range(3):
-        if ph_en_arr[i]:
-            if (U[i*2+1] == 1):
-                V_arr[i] = config.VDC
-            else:
-                V_arr[i] = 0.
-            V_arr[3] = V_arr[i] - emf[i]
-            j, k = (i+1)%3, (i+2)%3
-            V_arr[j] = V_arr[3] + emf[j]
-            V_arr[k] = V_arr[3] + emf[k]
-            
-            # if (X_currents[j] != 0 or X_currents[k] != 0):
-                # raise ValueError("Current i is nonzero")
-            
-            # if np.any(V_arr[i] > config.VDC) or np.any(V_arr[i] < 0):
-            #     raise ValueError("Freewheeling diodes conducting")
-            return V_arr
-    
-    raise ValueError("ERR: None of the switches enabled")
-
-
-def output(X, U):
-
-    V = get_phase_voltages(X, U)
+                    legs.append(leg_open)
+            row.append(tuple(legs))
+        table.append(row)
+    return table
+
+leg_table = _make_leg_table()
+
+# Currents below this (A) count as zero, an open phase picks up rounding noise of ~1e-19 A
+I_ZERO = 1e-9
+
+# Switches above `level` as a bitmask
+def switch_mask(U, level=0.):
+    mask = 0
+    for i, u in enumerate(U.tolist() if hasattr(U, 'tolist') else U):
+        if u > level:
+            mask |= 1 << i
+    return mask
+
+# Duty cycle of the PWM'd switch with averaged PWM, 1 when every switch is fully on or off
+def pwm_duty(U):
+    duty = 1.
+    for u in (U.tolist() if hasattr(U, 'tolist') else U):
+        if 0. < u < 1.:
+            duty = u
+    return duty
+
+def _sign_code(X):
+    code = 0
+    for p, w in ((0, 1), (1, 3), (2, 9)):
+        i = X[sv_iu+p]
+        if i > I_ZERO:
+            code += w
+        elif i < -I_ZERO:
+            code += 2 * w
+    return code
+
+# Leg states after the emf band check, V_arr (u, v, w, star) filled in place
+# (the legs of the on part of the cycle with averaged PWM)
+def solve_inverter(X, U, emf, V_arr, inverter):
+    if inverter.averaged:
+        comp = [p for p in range(3) if U[2*p] > 0. and U[2*p+1] > 0.]
+        if comp:
+            legs = _solve_legs(X, switch_mask(U), emf, V_arr, inverter)
+            _complementary_legs(U, comp, legs, emf, V_arr, inverter)
+            return legs
+        duty = pwm_duty(U)
+        if duty < 1.:
+            _solve_legs(X, switch_mask(U, duty), emf, V_arr, inverter)
+            V_off = V_arr.copy()
+            legs = _solve_legs(X, switch_mask(U), emf, V_arr, inverter)
+            V_arr[:] = (duty * V_arr) + ((1. - duty) * V_off)
+            return legs
+    return _solve_legs(X, switch_mask(U), emf, V_arr, inverter)
+
+def _solve_legs(X, mask, emf, V_arr, inverter):
+    legs = list(leg_table[mask][_sign_code(X) if inverter.diodes else 0])
+    leg_v = inverter.leg_voltages
+    for check in (inverter.diodes, False):
+        n = 0
+        acc = 0.
+        for p in range(3):
+            if legs[p] != leg_open:
+                acc += leg_v[legs[p]] - emf[p]
+                n += 1
+        if n == 0:
+            # Voltage is zero when nothing is yet enabled
+            V_arr[:] = 0.
+            return legs
+        V_arr[ph_star] = acc / n
+        if not check or n == 3:
+            break
+        # Open phases leaving the diode band start conducting
+        changed = False
+        for p in range(3):
+            if legs[p] == leg_open:
+                v = emf[p] + V_arr[ph_star]
+                if v > leg_v[leg_diode_high]:
+                    legs[p], changed = leg_diode_high, True
+                elif v < leg_v[leg_diode_low]:
+                    legs[p], changed = leg_diode_low, True
+        if not changed:
+            break
+    for p in range(3):
+        V_arr[p] = emf[p] + V_arr[ph_star] if legs[p] == leg_open else leg_v[legs[p]]
+    return legs
+
+# Averaged complementary legs `comp` at U_high * VDC, star and open phases updated
+def _complementary_legs(U, comp, legs, emf, V_arr, inverter):
+    for p in comp:
+        V_arr[p] = U[2*p+1] * inverter.VDC
+    n = 0
+    acc = 0.
+    for p in range(3):
+        if legs[p] != leg_open:
+            acc += V_arr[p] - emf[p]
+            n += 1
+    V_arr[ph_star] = acc / n
+    for p in range(3):
+        if legs[p] == leg_open:
+            V_arr[p] = emf[p] + V_arr[ph_star]
+
+# Calculate phase voltages
+# Returns a vector of phase voltages (u, v, w) and the star voltage
+# emf can be passed when already known, V_arr is filled in place when given
+def get_phase_voltages(X, U, emf=None, V_arr=None, params=None):
+    params = params or prm.default()
+    if emf is None:
+        emf = get_emf(X, params)
+    if V_arr is None:
+        V_arr = np.zeros(ph_size)
+    solve_inverter(X, U, emf, V_arr, params.inverter)
+    return V_arr
+
+# Conducting diodes as a bitmask (bit dd_* set when that diode conducts)
+def diode_mask(X, U, params=None):
+    params = params or prm.default()
+    legs = solve_inverter(X, U, get_emf(X, params), np.zeros(ph_size), params.inverter)
+    mask = 0
+    for p in range(3):
+        if legs[p] == leg_diode_low:
+            mask |= 1 << (2*p)
+        elif legs[p] == leg_diode_high:
+            mask |= 1 << (2*p+1)
+    return mask
+
+'''
+Diode current zero crossing
+@brief:
+    A freewheeling current decays to zero and the diode blocks, it can not
+    reverse. A fixed step overshoots the zero, so after every step the phases
+    with both switches off whose current changed sign are set back to zero;
+    the overshoot is moved to the other conducting phases so the currents
+    still sum to zero. Works in place on X, returns True when something was clamped.
+'''
+def clamp_currents(X, X_prev, U, params=None):
+    if not (params or prm.default()).inverter.diodes:
+        return False
+    clamped = False
+    for p in range(3):
+        # Sign change first, it is rare
+        if X[sv_iu+p] * X_prev[sv_iu+p] < 0 and U[2*p] == 0 and U[2*p+1] == 0:
+            zero_phase_current(X, p)
+            clamped = True
+    return clamped
+
+# Set the current of phase p to zero, the rest goes to the other conducting phases
+def zero_phase_current(X, p):
+    rest = X[sv_iu+p]
+    X[sv_iu+p] = 0.
+    others = [q for q in range(3) if q != p and X[sv_iu+q] != 0]
+    for q in others:
+        X[sv_iu+q] += rest / len(others)
+
+
+def output(X, U, params=None):
+
+    V = get_phase_voltages(X, U, params=params)
     Y = [X[sv_iu], X[sv_iv], X[sv_iw],
          V[ph_U], V[ph_V], V[ph_W],
          X[sv_theta], X[sv_omega]]
     return Y
 
-#
-# Dynamic model
-#
-# X state, t time, U input, W perturbation
-#
+'''
+Model workspace
+@brief:
+    Holds the results of one model evaluation: electrical angle, emf, phase
+    voltages, state derivative and debug vector. evaluate() computes all of
+    them in a single pass into preallocated arrays, so the emf is computed once
+    per RHS evaluation and the debug vector comes for free with the derivative.
+'''
+class Workspace:
+    def __init__(self):
+        self.elec_angle = 0.
+        self.emf = np.zeros(3)
+        self.V = np.zeros(ph_size)
+        self.Xd = np.zeros(config.N_STATE_VARS)
+        self.Xdebug = np.zeros(config.N_DEBUG_VARS)
+
+# Torque accelerating the rotor for a given electrical torque (per pole pair) and speed
+def mechanical_torque(etorque, omega, motor):
+    # Mechanical torque (subtracting B and load torque)
+    mtorque = ((etorque * motor.pole_pairs) - (motor.B * omega) - motor.T_load)
 
-def dyn(X, t, U):
-    Xd, Xdebug = dyn_debug(X, t, U)
-    return Xd
+    # Include static friction
+    T_fstatic = motor.T_fstatic
+    if ((mtorque > 0) and (mtorque <= T_fstatic)):
+        mtorque = 0
+    elif (mtorque >= T_fstatic):
+        mtorque = mtorque - T_fstatic
+    elif ((mtorque < 0) and (mtorque >= (-T_fstatic))):
+        mtorque = 0
+    elif (mtorque <= (-T_fstatic)):
+        mtorque = mtorque + T_fstatic
+    return mtorque
+
+# Workspace used by dyn / dyn_debug, one per thread so parallel simulations don't share it
+_local = threading.local()
+
+def workspace():
+    if not hasattr(_local, 'ws'):
+        _local.ws = Workspace()
+    return _local.ws
+
+def evaluate(X, U, ws, params):
+    motor = params.motor
+    ws.elec_angle = X[sv_theta] * motor.pole_pairs
+    max_bemf = motor.bemf_gain * X[sv_omega]
+    # BACK-EMF IS OF TRAPEZOIDAL (OR SINUSOIDAL) SHAPE
+    eu, ev, ew = utils.bemf_phases(ws.elec_angle, motor.bemf_table)
+    emf = ws.emf
+    emf[0], emf[1], emf[2] = max_bemf * eu, max_bemf * ev, max_bemf * ew
+    iu, iv, iw = X[sv_iu], X[sv_iv], X[sv_iw]
 
+    # Energy equation: torque =  (EM-energy) / omega
+    etorque = ((emf[0] * iu) + (emf[1] * iv) + (emf[2] * iw)) / X[sv_omega]
 
-# Dynamic model with debug vector
-def dyn_debug(X, t, U):
-    emf = np.zeros(3, dtype=float)
+    mtorque = mechanical_torque(etorque, X[sv_omega], motor)
+
+    V = ws.V
+    solve_inverter(X, U, emf, V, params.inverter)
 
-    max_bemf = (utils.VEL_RADS2RPM * X[sv_omega]) / config.Kv
+    Xd = ws.Xd
+    Xd[sv_theta] = X[sv_omega]
+    # Acceleration of the rotor
+    Xd[sv_omega] = mtorque / motor.Inertia
+    Xd[sv_iu] = (V[ph_U] - (motor.R * iu) - emf[0] - V[ph_star]) * motor.inv_LM #diu/dt
+    Xd[sv_iv] = (V[ph_V] - (motor.R * iv) - emf[1] - V[ph_star]) * motor.inv_LM #div/dt
+    Xd[sv_iw] = (V[ph_W] - (motor.R * iw) - emf[2] - V[ph_star]) * motor.inv_LM #diw/dt
 
-    for phase in range(3):
-        angle = utils.angle_2pi((X[sv_theta] * (config.NbPoles / 2.)) + phase*2*math.pi/3)
-        # BACK-EMF IS OF TRAPEZOIDAL SHAPE
-        emf[phase] = max_bemf * utils.trapezoid(angle)
+    Xdebug = ws.Xdebug
+    Xdebug[dv_eu:dv_ew+1] = emf
+    Xdebug[dv_ph_U:dv_ph_star+1] = V
+    return ws
 
-    # Energy equation: torque =  (EM-energy) / omega
-    etorque = np.dot(emf, X[sv_iu:sv_iw+1]) / X[sv_omega]
+#
+# Dynamic model
+#
+# X state, t time, U input, W perturbation
+#
+# The returned vectors are copies, integrators keep several stage derivatives around
+#
 
-    # Mechanical torque (subtracting config.B and load torque)
-    mtorque = ((etorque * (config.NbPoles / 2)) - (config.B * X[sv_omega]) - config.T_load)
+def dyn(X, t, U, params=None):
+    return evaluate(X, U, workspace(), params or prm.default()).Xd.copy()
 
-    # Include static friction
-    if ((mtorque > 0) and (mtorque <= config.T_fstatic)):
-        mtorque = 0
-    elif (mtorque >= config.T_fstatic):
-        mtorque = mtorque - config.T_fstatic
-    elif ((mtorque < 0) and (mtorque >= (-config.T_fstatic))):
-	    mtorque = 0
-    elif (mtorque <= (-config.T_fstatic)):
-        mtorque = mtorque + config.T_fstatic
 
-    # Acceleration of the rotor
-    omega_dot = mtorque / config.Inertia
-
-    V = get_phase_voltages(X, U)
-
-    Xd = [X[sv_omega],
-          omega_dot,
-          (V[ph_U] - (config.R * X[sv_iu]) - emf[0] - V[ph_star]) / (config.L - config.M), #diu/dt
-          (V[ph_V] - (config.R * X[sv_iv]) - emf[1] - V[ph_star]) / (config.L - config.M), #div/dt
-          (V[ph_W] - (config.R * X[sv_iw]) - emf[2] - V[ph_star]) / (config.L - config.M)  #diw/dt
-    ]
-
-    Xdebug = [
-        emf[0],
-        emf[1],
-        emf[2],
-        V[ph_U],
-        V[ph_V],
-        V[ph_W],
-        V[ph_star]
-        ]
-
-    return Xd, Xdebug
+# Dynamic model with debug vector
+def dyn_debug(X, t, U, params=None):
+    ws = evaluate(X, U, workspace(), params or prm.default())
+    return ws.Xd.copy(), ws.Xdebug.copy()
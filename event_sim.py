@@ -0,0 +1,181 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import numpy as np
+from scipy import integrate
+
+import utils
+import dyn_model  as dm
+import control    as ctl
+import params     as prm
+import config
+
+'''
+Event driven simulation
+@brief:
+    The six step controller only changes the switches at PWM edges and when the
+    electrical angle crosses a commutation boundary (pi/6 + k*pi/3). Between two
+    such events U is constant, so the model is integrated with an adaptive solver
+    over the whole interval instead of restarting it every SIM_STEP.
+    - PWM edges (n*T and n*T + duty*T) are predicted analytically
+    - commutation crossings are located by the solver's event root-finding
+    - so are the zero crossings of currents freewheeling through a diode, the
+      current is then held at zero (see dyn_model.clamp_currents)
+    The result is resampled onto a uniform time grid.
+    With averaged PWM there are no PWM edges, only the commutations.
+    params (params.SimConfig) defaults to the config preset. Only the six step
+    angle controller switches on these events alone, other CONTROLLER settings
+    (and SPEED_LOOP) are rejected.
+'''
+
+# Width of one commutation sector and offset of the first boundary
+SECTOR = ctl.SECTOR
+SECTOR_OFFSET = ctl.SECTOR_OFFSET
+
+# Electrical angle nudge applied when evaluating the controller exactly on a boundary
+ANGLE_EPS = 1e-9
+
+# Next PWM edge strictly after t, cycle and duty times of the config preset when not given
+def next_pwm_edge(t, cycle_time=None, duty_time=None):
+    if cycle_time is None or duty_time is None:
+        inverter = prm.InverterParams()
+        cycle_time = inverter.PWM_cycle_time if cycle_time is None else cycle_time
+        duty_time = inverter.PWM_duty_time if duty_time is None else duty_time
+    n = math.floor(t / cycle_time)
+    for edge in ((n * cycle_time) + duty_time, (n + 1) * cycle_time, ((n + 1) * cycle_time) + duty_time):
+        # Tolerance keeps floating point noise from returning an edge we are standing on
+        if edge > t + 1e-12 * cycle_time:
+            return edge
+    return (n + 2) * cycle_time
+
+def elec_angle(X, pole_pairs):
+    return X[dm.sv_theta] * pole_pairs
+
+# Index of the commutation sector containing the electrical angle
+def sector_of(angle):
+    return math.floor((angle - SECTOR_OFFSET) / SECTOR)
+
+def sector_bounds(k):
+    lower = SECTOR_OFFSET + k * SECTOR
+    return lower, lower + SECTOR
+
+'''
+Controller evaluation for a constant switch interval
+@brief:
+    The angle is evaluated strictly inside the sector and the time in the middle
+    of the PWM interval so inclusive comparisons in the controller can not pick
+    the state that just ended.
+'''
+def _control(X, U_prev, t, t_edge, k, params):
+    pole_pairs = params.motor.pole_pairs
+    lower, upper = sector_bounds(k)
+    angle = min(max(elec_angle(X, pole_pairs), lower + ANGLE_EPS), upper - ANGLE_EPS)
+    Xc = np.array(X, dtype=float)
+    Xc[dm.sv_theta] = utils.angle_2pi(angle / pole_pairs)
+    return ctl.run(dm.output(Xc, U_prev, params), (t + t_edge) / 2., params)
+
+def simulate(sim_time=None, out_step=None, method='LSODA', rtol=1e-6, atol=1e-9, progress=False, params=None):
+    params = params or prm.SimConfig()
+    if not ctl.is_angle_controller(params):
+        raise ValueError("ERR: event driven simulation only runs the six step angle controller "
+                         "(CONTROLLER = 'six_step' without SPEED_LOOP)")
+    sim_time = params.SIM_TIME if sim_time is None else sim_time
+    out_step = params.SIM_STEP if out_step is None else out_step
+    pole_pairs = params.motor.pole_pairs
+    inverter = params.inverter
+
+    time = np.arange(0.0, sim_time, out_step)
+    X = np.zeros((time.size, config.N_STATE_VARS))
+    Y = np.zeros((time.size, config.N_OUTPUT_VARS))
+    U = np.zeros((time.size, config.N_SWITCHES))
+    V_arr = np.zeros((time.size, config.N_DEBUG_VARS))
+
+    stats = {'intervals': 0, 'pwm_events': 0, 'commutation_events': 0, 'diode_events': 0,
+             'controller_calls': 0}
+
+    t = 0.
+    x = np.array(params.X0, dtype=float)
+    u_prev = np.zeros(config.N_SWITCHES)
+    k = sector_of(elec_angle(x, pole_pairs))
+    i_out = 0
+
+    while t < sim_time and i_out < time.size:
+        t_edge = sim_time if inverter.averaged else min(next_pwm_edge(t, inverter.PWM_cycle_time,
+                                                                      inverter.PWM_duty_time), sim_time)
+        u = _control(x, u_prev, t, t_edge, k, params)
+        stats['controller_calls'] += 1
+
+        lower, upper = sector_bounds(k)
+        ev_upper = lambda tt, xx, *a: elec_angle(xx, pole_pairs) - upper
+        ev_upper.terminal, ev_upper.direction = True, 1
+        ev_lower = lambda tt, xx, *a: elec_angle(xx, pole_pairs) - lower
+        ev_lower.terminal, ev_lower.direction = True, -1
+        events = [ev_upper, ev_lower]
+        diode_phases = [p for p in range(3) if inverter.diodes and u[2*p] == 0 and u[2*p+1] == 0
+                        and x[dm.sv_iu+p] != 0]
+        for p in diode_phases:
+            ev_zero = lambda tt, xx, *a, i=dm.sv_iu+p: xx[i]
+            ev_zero.terminal, ev_zero.direction = True, (-1 if x[dm.sv_iu+p] > 0 else 1)
+            events.append(ev_zero)
+
+        sol = integrate.solve_ivp(lambda tt, xx: dm.dyn(xx, tt, u, params), (t, t_edge), x,
+                                  method=method, rtol=rtol, atol=atol, events=events,
+                                  dense_output=True)
+        if not sol.success:
+            raise RuntimeError(f"ERR: solver failed at t={t}: {sol.message}")
+        stats['intervals'] += 1
+
+        t_end = sol.t[-1]
+        # Resample every grid point covered by this interval (the last one takes the remainder)
+        i_end = i_out
+        while i_end < time.size and (time[i_end] < t_end or t_end >= sim_time):
+            i_end += 1
+        if i_end > i_out:
+            X[i_out:i_end,:] = sol.sol(np.minimum(time[i_out:i_end], t_end)).T
+            U[i_out:i_end,:] = u
+            for n in range(i_out, i_end):
+                Y[n,:] = dm.output(X[n,:], u, params)
+                tmp, V_arr[n,:] = dm.dyn_debug(X[n,:], time[n], u, params)
+            i_out = i_end
+
+        x = sol.y[:,-1].copy()
+        if sol.status == 1 and (sol.t_events[0].size or sol.t_events[1].size):
+            stats['commutation_events'] += 1
+            k += 1 if sol.t_events[0].size else -1
+        elif sol.status == 1:
+            stats['diode_events'] += 1
+            for p, t_ev in zip(diode_phases, sol.t_events[2:]):
+                if t_ev.size:
+                    dm.zero_phase_current(x, p)
+        else:
+            stats['pwm_events'] += 1
+        t = t_end
+        u_prev = u
+
+        # Keep the angle bounded without changing the sector the solver is tracking
+        wrapped = utils.angle_2pi(x[dm.sv_theta])
+        k += int(round((wrapped - x[dm.sv_theta]) * pole_pairs / SECTOR))
+        x[dm.sv_theta] = wrapped
+
+        if progress:
+            print(f"{100. * t / sim_time:.1f}")
+
+    X[:, dm.sv_theta] = np.mod(X[:, dm.sv_theta], 2 * math.pi)
+    return time, X, Y, U, V_arr, stats
@@ -0,0 +1,156 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import numpy as np
+
+'''
+Field oriented control kernels
+@brief:
+    Clarke / Park transforms, modulation and the d/q current loops written as
+    numpy kernels with the phase axis last: a (3,) vector and scalars for one
+    motor (control.FocController in sim_1), (N, 3) and (N,) arrays for a batch
+    of motors (batch_model.FocControl). Same code, no per motor loop.
+    The Clarke transform is amplitude invariant, a balanced set of phase
+    amplitude I is a vector of length I in the alpha / beta plane.
+'''
+SQRT3 = math.sqrt(3.)
+
+# (..., 3) phase values -> alpha, beta
+def clarke(abc):
+    alpha = ((2. * abc[..., 0]) - abc[..., 1] - abc[..., 2]) / 3.
+    beta = (abc[..., 1] - abc[..., 2]) / SQRT3
+    return alpha, beta
+
+# alpha, beta -> (..., 3) phase values
+def inv_clarke(alpha, beta):
+    return np.stack((alpha,
+                     (-0.5 * alpha) + ((SQRT3 / 2.) * beta),
+                     (-0.5 * alpha) - ((SQRT3 / 2.) * beta)), axis=-1)
+
+# alpha, beta -> d, q in the frame at angle theta
+def park(alpha, beta, theta):
+    c, s = np.cos(theta), np.sin(theta)
+    return (alpha * c) + (beta * s), (beta * c) - (alpha * s)
+
+# d, q in the frame at angle theta -> alpha, beta
+def inv_park(d, q, theta):
+    c, s = np.cos(theta), np.sin(theta)
+    return (d * c) - (q * s), (d * s) + (q * c)
+
+'''
+Modulation
+@brief:
+    Phase voltage references (..., 3) around the star point -> leg duty cycles in [0, 1]
+    for a bus of vdc.
+    - 'sinusoidal': the references centered on VDC / 2, linear up to VDC / 2 peak
+    - 'svpwm': min-max zero sequence added first, the same leg duties as space
+      vector PWM with symmetric zero vectors, linear up to VDC / sqrt(3) peak
+    References past the linear range clip.
+'''
+modulations = ('svpwm', 'sinusoidal')
+
+def modulate(v_abc, vdc, modulation='svpwm'):
+    if modulation == 'svpwm':
+        v_abc = v_abc - 0.5 * (np.max(v_abc, axis=-1, keepdims=True) + np.min(v_abc, axis=-1, keepdims=True))
+    return np.clip(0.5 + (v_abc / np.expand_dims(vdc, -1)), 0., 1.)
+
+# Peak phase voltage of the linear range
+def voltage_limit(vdc, modulation='svpwm'):
+    return vdc / SQRT3 if modulation == 'svpwm' else vdc / 2.
+
+'''
+Complementary leg switches
+@brief:
+    Switch vector (..., 6) for leg duty cycles (..., 3). Switched, the high side
+    is on for a pulse of duty * cycle_time centered in the PWM cycle (center
+    aligned like the MCU timers) and the low side for the rest of it. Averaged,
+    the high side switch holds the duty and the low side 1 - duty, which
+    dyn_model.solve_inverter reads as a leg at duty * VDC.
+'''
+def leg_switches(duty, t, cycle_time, averaged):
+    phase = np.fmod(t, cycle_time) / cycle_time
+    pulse = (2. * np.abs(np.expand_dims(phase, -1) - 0.5)) < duty
+    high = np.where(np.expand_dims(averaged, -1), duty, pulse)
+    U = np.empty(high.shape[:-1] + (6,))
+    U[..., 1::2] = high
+    U[..., 0::2] = 1. - high
+    return U
+
+# Clamped PI step on arrays, returns (output, integral)
+def _pi(error, integral, kp, ki_period, limit):
+    integral = np.clip(integral + (ki_period * error), -limit, limit)
+    return np.clip((kp * error) + integral, -limit, limit), integral
+
+'''
+FOC loops
+@brief:
+    Once per PWM cycle (like a PWM synchronous ADC) the phase currents are
+    turned into i_d / i_q, two PI loops set v_d / v_q for i_d = 0 and i_q at its
+    reference, and the inverse transforms plus the modulation give the leg
+    duties, held until the next cycle. The voltage vector is limited to the
+    linear range of the modulation, the integrals per axis (anti windup).
+    The i_q reference is FOC_IQ_REF, or with SPEED_LOOP the output of a speed
+    PI run every LOOP_PERIOD (SPEED_KP / SPEED_KI in A, up to CURRENT_MAX) for
+    a speed of +SPEED_REF.
+    With the phase order of dyn_model (the back-emf of v leads u by 120
+    degrees) a forward turning rotor turns the alpha / beta vector backwards,
+    so the d axis is at minus the electrical angle; i_q > 0 then accelerates
+    the rotor forward.
+    `shape` is () for one motor, (N,) for a batch; update() takes the
+    parameters per motor (bus voltage, PWM cycle) as scalars or (N,) arrays.
+'''
+class FocLoop:
+    def __init__(self, control, shape=()):
+        self.control = control
+        self.v_d_int = np.zeros(shape)
+        self.v_q_int = np.zeros(shape)
+        self.speed_int = np.zeros(shape)
+        self.i_q_ref = np.full(shape, float(control.FOC_IQ_REF))
+        self.next_update = np.zeros(shape)
+        self.next_speed = 0.
+        self.duty = np.full(shape + (3,), 0.5)
+
+    def update(self, t, i_abc, elec_angle, omega, vdc, cycle_time):
+        due = t >= self.next_update
+        if not np.any(due):
+            return self.duty
+        control = self.control
+        self.next_update = np.where(due, self.next_update + cycle_time, self.next_update)
+
+        if control.SPEED_LOOP and t >= self.next_speed:
+            self.next_speed += control.LOOP_PERIOD * (math.floor((t - self.next_speed) / control.LOOP_PERIOD) + 1)
+            self.i_q_ref, self.speed_int = _pi(control.SPEED_REF - omega, self.speed_int, control.SPEED_KP,
+                                               control.SPEED_KI * control.LOOP_PERIOD, control.CURRENT_MAX)
+
+        theta = -elec_angle
+        i_d, i_q = park(*clarke(i_abc), theta)
+        v_max = voltage_limit(vdc, control.FOC_MODULATION)
+        ki_period = control.FOC_KI * cycle_time
+        v_d, v_d_int = _pi(-i_d, self.v_d_int, control.FOC_KP, ki_period, v_max)
+        v_q, v_q_int = _pi(self.i_q_ref - i_q, self.v_q_int, control.FOC_KP, ki_period, v_max)
+        # Keep the vector inside the linear range
+        scale = np.minimum(1., v_max / np.maximum(np.hypot(v_d, v_q), 1e-12))
+        v_abc = inv_clarke(*inv_park(v_d * scale, v_q * scale, theta))
+        duty = modulate(v_abc, vdc, control.FOC_MODULATION)
+
+        self.v_d_int = np.where(due, v_d_int, self.v_d_int)
+        self.v_q_int = np.where(due, v_q_int, self.v_q_int)
+        self.duty = np.where(np.expand_dims(due, -1), duty, self.duty)
+        return self.duty
@@ -0,0 +1,129 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import numpy as np
+from scipy import integrate
+
+import dyn_model as dm
+import params    as prm
+
+'''
+Fixed step integrators
+@brief:
+    All steppers share the signature step(f, X, t, dt, args) -> X(t + dt)
+    where f(X, t, *args) is the right hand side (e.g. dyn_model.dyn).
+    Xd0 optionally gives f(X, t, *args) when the caller already evaluated it
+    (e.g. with dyn_model.dyn_debug to record the debug vector), so the first
+    stage is not computed twice. params (params.SimConfig) is only used by the
+    steppers that need model constants (semi_implicit, exponential), the
+    config preset (params.default()) when None.
+    The switch vector U stays constant over one step, so none of them needs
+    to restart a solver: one step costs a fixed number of RHS evaluations.
+'''
+
+# Number of RHS evaluations per step for each method
+rhs_calls = {
+    'euler': 1,
+    'heun': 2,
+    'rk4': 4,
+    'semi_implicit': 1,
+    'exponential': 1,
+}
+
+def _first_stage(f, X, t, args, Xd0):
+    return np.asarray(f(X, t, *args)) if Xd0 is None else Xd0
+
+def euler(f, X, t, dt, args=(), Xd0=None, params=None):
+    return X + dt * _first_stage(f, X, t, args, Xd0)
+
+def heun(f, X, t, dt, args=(), Xd0=None, params=None):
+    k1 = _first_stage(f, X, t, args, Xd0)
+    k2 = np.asarray(f(X + dt * k1, t + dt, *args))
+    return X + (dt / 2.) * (k1 + k2)
+
+def rk4(f, X, t, dt, args=(), Xd0=None, params=None):
+    k1 = _first_stage(f, X, t, args, Xd0)
+    k2 = np.asarray(f(X + (dt / 2.) * k1, t + dt / 2., *args))
+    k3 = np.asarray(f(X + (dt / 2.) * k2, t + dt / 2., *args))
+    k4 = np.asarray(f(X + dt * k3, t + dt, *args))
+    return X + (dt / 6.) * (k1 + 2. * k2 + 2. * k3 + k4)
+
+'''
+Semi-implicit Euler
+@brief:
+    The phase currents follow di/dt = (V - R*i - e - Vn) / (L-M) which is stiff
+    for small (L-M)/R. The resistive term is taken implicitly:
+        i(n+1) = (i(n) + dt * (di/dt + R/(L-M) * i(n))) / (1 + dt * R/(L-M))
+    so the current update stays stable for any dt. Theta and omega use explicit Euler.
+'''
+def semi_implicit(f, X, t, dt, args=(), Xd0=None, params=None):
+    Xd = _first_stage(f, X, t, args, Xd0)
+    return semi_implicit_update(X, Xd, dt, (params or prm.default()).motor.R_LM)
+
+# Semi-implicit step from the derivative Xd, a = R/(L-M) scalar or (N, 1) for a batch X (N, 5)
+def semi_implicit_update(X, Xd, dt, a):
+    Xn = X + dt * Xd
+    i = slice(dm.sv_iu, dm.sv_iw+1)
+    Xn[..., i] = (X[..., i] + dt * (Xd[..., i] + a * X[..., i])) / (1. + dt * a)
+    return Xn
+
+'''
+Exponential (exact RL) step
+@brief:
+    With U constant over the step the current equations are linear first order
+        di/dt = b - a * i,   a = R/(L-M),   b = (V - e - Vn) / (L-M)
+    Taking b from the start of the step (it only moves with the slow back-emf)
+    the currents are advanced with the closed form solution
+        i(n+1) = i(n) * exp(-a*dt) + (b/a) * (1 - exp(-a*dt))
+    which is exact for any dt, so the step size is set by the PWM / commutation
+    resolution and not by the electrical time constant. Theta and omega use
+    explicit Euler. One RHS evaluation per step.
+'''
+def exponential(f, X, t, dt, args=(), Xd0=None, params=None):
+    Xd = _first_stage(f, X, t, args, Xd0)
+    a = (params or prm.default()).motor.R_LM
+    return exponential_update(X, Xd, dt, a, math.exp(-a * dt))
+
+# Exponential step from the derivative Xd, a and decay = exp(-a*dt) like semi_implicit_update
+def exponential_update(X, Xd, dt, a, decay):
+    Xn = X + dt * Xd
+    i = slice(dm.sv_iu, dm.sv_iw+1)
+    # b / a = (Xd + a*i) / a
+    Xn[..., i] = (X[..., i] * decay) + ((Xd[..., i] / a) + X[..., i]) * (1. - decay)
+    return Xn
+
+# Reference: restart LSODA over the two point span [t, t+dt] (previous sim_1 behaviour)
+def odeint(f, X, t, dt, args=(), Xd0=None, params=None):
+    return integrate.odeint(f, X, [t, t + dt], args=args)[1,:]
+
+methods = {
+    'euler': euler,
+    'heun': heun,
+    'rk4': rk4,
+    'semi_implicit': semi_implicit,
+    'exponential': exponential,
+    'odeint': odeint,
+}
+
+def get(name):
+    try:
+        return methods[name]
+    except KeyError:
+        raise ValueError(f"ERR: unknown integrator {name}, expected one of {sorted(methods)}")
@@ -0,0 +1,339 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import collections
+import numpy as np
+
+import dyn_model  as dm
+import control    as ctl
+import params     as prm
+import config
+
+'''
+Compiled simulation kernel
+@brief:
+    The model RHS (dyn_model.evaluate), the inverter voltage solver and the six
+    step controller (control.run_hpwm_l_on_bipol) fused into one numba compiled
+    loop reproducing sim_1.simulate step by step. numba is optional: when it
+    can not be imported `available` is False and sim_1 keeps using the Python code.
+'''
+try:
+    from numba import njit
+    available = True
+except ImportError:
+    available = False
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+I_ZERO = dm.I_ZERO
+
+# Integration methods of the kernel, same equations as integrator.py
+methods = {'euler': 0, 'heun': 1, 'rk4': 2, 'semi_implicit': 3, 'exponential': 4}
+
+'''
+Kernel parameters
+@brief:
+    Plain float struct (a namedtuple is passed to numba as a tuple) with the
+    values of a params.SimConfig and the derived constants used on every evaluation.
+'''
+Params = collections.namedtuple('Params', [
+    'Inertia', 'B', 'Kv', 'L', 'M', 'R', 'VDC', 'V_DF', 'NbPoles', 'T_fstatic', 'T_load',
+    'PWM_cycle_time', 'PWM_duty_time', 'PWM_duty',
+    'diodes',       # 1. with the diode inverter model, 0. for the ideal one
+    'averaged',     # 1. with averaged PWM, 0. when every edge is switched
+    'inv_LM',       # 1 / (L - M)
+    'pole_pairs',   # NbPoles / 2
+    'bemf_gain',    # VEL_RADS2RPM / Kv
+])
+
+def make_params(params=None):
+    params = params or prm.SimConfig()
+    motor, inverter = params.motor, params.inverter
+    return Params(
+        float(motor.Inertia), float(motor.B), float(motor.Kv), float(motor.L), float(motor.M),
+        float(motor.R), float(inverter.VDC), float(inverter.V_DF), float(motor.NbPoles),
+        float(motor.T_fstatic), float(motor.T_load), float(inverter.PWM_cycle_time),
+        float(inverter.PWM_duty_time), float(inverter.PWM_duty), 1. if inverter.diodes else 0.,
+        1. if inverter.averaged else 0., float(motor.inv_LM), float(motor.pole_pairs), float(motor.bemf_gain))
+
+# Back-emf table values of the params (uniform spacing over one electrical turn, like utils.bemf_phases)
+def make_lut(params):
+    return params.motor.bemf_lut[1]
+
+@njit(cache=True)
+def _bemf(angle, lut):
+    size = lut.size - 1
+    pos = (angle % (2 * math.pi)) * (size / (2 * math.pi))
+    idx = min(int(pos), size - 1)
+    return lut[idx] + (pos - idx) * (lut[idx + 1] - lut[idx])
+
+@njit(cache=True)
+def _leg_voltage(leg, P):
+    if leg == 1:
+        return 0.
+    if leg == 2:
+        return P.VDC
+    if leg == 3:
+        return -P.V_DF
+    return P.VDC + P.V_DF
+
+@njit(cache=True)
+def _solve_legs(emf, U, level, X, P, V, legs):
+    # Leg states of dyn_model.solve_inverter (0 open, 1 low, 2 high, 3 low diode, 4 high diode)
+    # with the switches above `level` on, star voltage is the mean of (terminal voltage - emf)
+    # over the conducting legs, open phases sit at star + emf. Returns the conducting diodes as a bitmask.
+    diodes = P.diodes > 0.
+    for i in range(3):
+        if U[2*i+1] > level:
+            legs[i] = 2
+        elif U[2*i] > level:
+            legs[i] = 1
+        elif diodes and X[2+i] > I_ZERO:
+            legs[i] = 3
+        elif diodes and X[2+i] < -I_ZERO:
+            legs[i] = 4
+        else:
+            legs[i] = 0
+    for check in range(2):
+        n_en = 0
+        acc = 0.
+        for i in range(3):
+            if legs[i] != 0:
+                acc += _leg_voltage(legs[i], P) - emf[i]
+                n_en += 1
+        if n_en == 0:
+            for i in range(4):
+                V[i] = 0.
+            return 0
+        V[3] = acc / n_en
+        if check == 1 or not diodes or n_en == 3:
+            break
+        changed = False
+        for i in range(3):
+            if legs[i] == 0:
+                v = emf[i] + V[3]
+                if v > P.VDC + P.V_DF:
+                    legs[i] = 4
+                    changed = True
+                elif v < -P.V_DF:
+                    legs[i] = 3
+                    changed = True
+        if not changed:
+            break
+    mask = 0
+    for i in range(3):
+        if legs[i] == 0:
+            V[i] = emf[i] + V[3]
+        else:
+            V[i] = _leg_voltage(legs[i], P)
+        if legs[i] == 3:
+            mask |= 1 << (2*i)
+        elif legs[i] == 4:
+            mask |= 1 << (2*i+1)
+    return mask
+
+@njit(cache=True)
+def _phase_voltages(emf, U, X, P, V, legs):
+    # With averaged PWM the duty weighted mean of the PWM'd switch off and on (mask of the on part)
+    duty = 1.
+    if P.averaged > 0.:
+        for i in range(6):
+            if 0. < U[i] < 1.:
+                duty = U[i]
+    if duty < 1.:
+        _solve_legs(emf, U, duty, X, P, V, legs)
+        v0, v1, v2, v3 = V[0], V[1], V[2], V[3]
+        mask = _solve_legs(emf, U, 0., X, P, V, legs)
+        V[0] = (duty * V[0]) + ((1. - duty) * v0)
+        V[1] = (duty * V[1]) + ((1. - duty) * v1)
+        V[2] = (duty * V[2]) + ((1. - duty) * v2)
+        V[3] = (duty * V[3]) + ((1. - duty) * v3)
+        return mask
+    return _solve_legs(emf, U, 0., X, P, V, legs)
+
+@njit(cache=True)
+def _clamp_currents(x, x_prev, U):
+    # dyn_model.clamp_currents
+    for p in range(3):
+        if U[2*p] == 0 and U[2*p+1] == 0 and x[2+p] * x_prev[2+p] < 0:
+            rest = x[2+p]
+            x[2+p] = 0.
+            n = 0
+            for q in range(3):
+                if q != p and x[2+q] != 0:
+                    n += 1
+            for q in range(3):
+                if q != p and x[2+q] != 0:
+                    x[2+q] += rest / n
+
+@njit(cache=True)
+def _emf(X, P, lut, emf):
+    max_bemf = P.bemf_gain * X[1]
+    elec = X[0] * P.pole_pairs
+    for i in range(3):
+        emf[i] = max_bemf * _bemf(elec + i * 2 * math.pi / 3, lut)
+
+@njit(cache=True)
+def _rhs(X, U, P, lut, emf, V, Xd, legs):
+    _emf(X, P, lut, emf)
+    etorque = (emf[0] * X[2] + emf[1] * X[3] + emf[2] * X[4]) / X[1]
+    mtorque = (etorque * P.pole_pairs) - (P.B * X[1]) - P.T_load
+    if mtorque > P.T_fstatic:
+        mtorque -= P.T_fstatic
+    elif mtorque < -P.T_fstatic:
+        mtorque += P.T_fstatic
+    else:
+        mtorque = 0.
+    mask = _phase_voltages(emf, U, X, P, V, legs)
+    Xd[0] = X[1]
+    Xd[1] = mtorque / P.Inertia
+    for i in range(3):
+        Xd[2+i] = (V[i] - (P.R * X[2+i]) - emf[i] - V[3]) * P.inv_LM
+    return mask
+
+@njit(cache=True)
+def _control(theta, t, P, low_sw, high_sw, U):
+    # Sector lookup of control.CommutationTable
+    sector = int(math.floor(((theta * P.pole_pairs) + (math.pi / 6.)) / (math.pi / 3.))) % 6
+    for i in range(6):
+        U[i] = 0.
+    U[low_sw[sector]] = 1.
+    if P.averaged > 0.:
+        U[high_sw[sector]] = P.PWM_duty
+    elif np.fmod(t, P.PWM_cycle_time) <= P.PWM_duty_time:
+        U[high_sw[sector]] = 1.
+
+@njit(cache=True)
+def _run(x, u, n, sim_step, i0, i1, stride, X_rec, Y_rec, U_rec, V_rec, D_rec, P, lut, method, low_sw, high_sw):
+    # Steps i0..i1-1 of n at t = i * sim_step (like np.arange), x and u carry
+    # the state and switches from one call to the next
+    emf = np.zeros(3)
+    V = np.zeros(4)
+    y = np.zeros(8)
+    k1 = np.zeros(5)
+    k2 = np.zeros(5)
+    k3 = np.zeros(5)
+    k4 = np.zeros(5)
+    Xs = np.zeros(5)
+    x_prev = np.zeros(5)
+    legs = np.zeros(3, dtype=np.int64)
+    for i in range(i0, i1):
+        # Output with the switches of the last step, like sim_1.simulate
+        _emf(x, P, lut, emf)
+        _phase_voltages(emf, u, x, P, V, legs)
+        y[0:3] = x[2:5]
+        y[3:6] = V[0:3]
+        y[6] = x[0]
+        y[7] = x[1]
+
+        _control(x[0], i * sim_step, P, low_sw, high_sw, u)
+        mask = _rhs(x, u, P, lut, emf, V, k1, legs)
+
+        if i % stride == 0:
+            # Recorded steps of this call before step i
+            r = i // stride - (i0 + stride - 1) // stride
+            X_rec[r] = x
+            Y_rec[r] = y
+            U_rec[r] = u
+            V_rec[r, 0:3] = emf
+            V_rec[r, 3:7] = V
+            D_rec[r] = mask
+
+        if i + 1 == n:
+            break
+        dt = sim_step
+        x_prev[:] = x
+        if method == 0:
+            x[:] = x + dt * k1
+        elif method == 1:
+            Xs[:] = x + dt * k1
+            _rhs(Xs, u, P, lut, emf, V, k2, legs)
+            x[:] = x + (dt / 2.) * (k1 + k2)
+        elif method == 2:
+            Xs[:] = x + (dt / 2.) * k1
+            _rhs(Xs, u, P, lut, emf, V, k2, legs)
+            Xs[:] = x + (dt / 2.) * k2
+            _rhs(Xs, u, P, lut, emf, V, k3, legs)
+            Xs[:] = x + dt * k3
+            _rhs(Xs, u, P, lut, emf, V, k4, legs)
+            x[:] = x + (dt / 6.) * (k1 + 2. * k2 + 2. * k3 + k4)
+        elif method == 3:
+            a = P.R * P.inv_LM
+            xn = x + dt * k1
+            for j in range(2, 5):
+                xn[j] = (x[j] + dt * (k1[j] + a * x[j])) / (1. + dt * a)
+            x[:] = xn
+        else:
+            a = P.R * P.inv_LM
+            decay = math.exp(-a * dt)
+            xn = x + dt * k1
+            for j in range(2, 5):
+                xn[j] = (x[j] * decay) + ((k1[j] / a) + x[j]) * (1. - decay)
+            x[:] = xn
+
+        if P.diodes > 0.:
+            _clamp_currents(x, x_prev, u)
+        x[0] = x[0] % (2 * math.pi) # normalize the angle in the state
+
+'''
+Compiled equivalent of sim_1.simulate
+@brief:
+    Fills `recorder` (recorder.TraceRecorder) with every recorder.stride-th step
+    and returns it. The kernel runs in blocks of the recorder buffer size so a
+    streaming recorder keeps memory flat. The first call compiles the kernel
+    (cached on disk by numba), later calls run at compiled speed.
+    With a state (checkpoint.Snapshot) the run continues from it and leaves it
+    at the step after its last one, like sim_1.simulate.
+'''
+def simulate(method, sim_time, sim_step, recorder, block_size=65536, params=None, state=None):
+    if method not in methods:
+        raise ValueError(f"ERR: compiled kernel supports {sorted(methods)}, not {method}")
+
+    n = int(math.ceil(sim_time / sim_step))
+    stride = recorder.stride
+    n_rec = min(block_size, recorder.size)
+    X = np.zeros((n_rec, config.N_STATE_VARS))
+    Y = np.zeros((n_rec, config.N_OUTPUT_VARS))
+    U = np.zeros((n_rec, config.N_SWITCHES))
+    V_arr = np.zeros((n_rec, config.N_DEBUG_VARS))
+    D = np.zeros(n_rec, dtype=np.uint8)
+
+    params = params or (state.params if state is not None else prm.SimConfig())
+    x = np.array(params.X0, dtype=float)
+    u = np.zeros(config.N_SWITCHES)
+    first, n_total = 0, n
+    if state is not None:
+        # Steps first..first+n-1 of the unbroken run, all of them advanced
+        first = state.begin(sim_step)
+        n_total = first + n + 1
+        x[:], u[:] = state.X, state.U
+    P, lut = make_params(params), make_lut(params)
+    for i0 in range(first, first + n, n_rec * stride):
+        i1 = min(i0 + n_rec * stride, first + n)
+        _run(x, u, n_total, sim_step, i0, i1, stride, X, Y, U, V_arr, D, P, lut, methods[method],
+             ctl.commutation_table.low, ctl.commutation_table.high)
+        steps = np.arange(-(-i0 // stride) * stride, i1, stride)
+        m = steps.size
+        recorder.record_block(steps * sim_step, X[:m], Y[:m], U[:m], V_arr[:m], D[:m])
+    if state is not None:
+        state.end(first + n, x, u, ctl.run)
+    return recorder
@@ -0,0 +1,222 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import time as tm
+import numpy as np
+
+import utils
+import dyn_model  as dm
+import control    as ctl
+import params     as prm
+import recorder   as rec
+import sim_1
+import config
+
+'''
+Multi-rate simulation
+@brief:
+    Three subsystems, each at its own step (all on the grid of the electrical step):
+    - electrical (SIM_STEP): the PWM is evaluated on every electrical step like
+      in sim_1, the phase currents are advanced with the exact RL solution of
+      integrator.exponential. Between two switch changes the forcing is
+      constant, so a run of identical electrical steps is one closed form update.
+    - mechanical (SIM_MECH_STEP): omega is advanced with the torque integrated
+      over the constant switch segments of the step (static friction applied per
+      segment like the single rate model does per step), theta with the
+      trapezoidal rule. Inside the step speed and angle are extrapolated with
+      the acceleration of the previous step for the back-emf.
+    - control (SIM_CONTROL_STEP): the commutation task, like the MCU ISR it picks
+      the sector of the commutation table from the output vector; the PWM
+      hardware then applies the low / PWM'd high switch of that sector.
+    Samples are recorded once per mechanical step. With averaged PWM the high
+    side switch is held at PWM_duty and only the control ticks split the step.
+    The control task is the six step commutation table, other CONTROLLER
+    settings (and SPEED_LOOP) are rejected.
+'''
+
+def _steps(step, elec_step, name):
+    n = int(round(step / elec_step))
+    if n < 1 or abs(n * elec_step - step) > 1e-9 * step:
+        raise ValueError(f"ERR: {name} {step} is not a multiple of the electrical step {elec_step}")
+    return n
+
+'''
+Multi-rate simulation run
+@brief:
+    Returns (time, X, Y, U, V_arr) of the recorded mechanical steps like
+    sim_1.simulate. Steps not given come from params (params.SimConfig).
+'''
+def simulate(sim_time=None, elec_step=None, mech_step=None, control_step=None, recorder=None,
+             table=ctl.commutation_table, params=None, progress=False):
+    params = params or prm.SimConfig()
+    if not ctl.is_angle_controller(params):
+        raise ValueError("ERR: multirate simulation only runs the six step commutation task "
+                         "(CONTROLLER = 'six_step' without SPEED_LOOP)")
+    sim_time = params.SIM_TIME if sim_time is None else sim_time
+    elec_step = params.SIM_STEP if elec_step is None else elec_step
+    n_mech = _steps(params.SIM_MECH_STEP if mech_step is None else mech_step, elec_step, 'mechanical step')
+    n_ctrl = _steps(params.SIM_CONTROL_STEP if control_step is None else control_step, elec_step, 'control step')
+    motor, inverter = params.motor, params.inverter
+    a = motor.R_LM
+
+    n_elec = int(math.ceil(sim_time / elec_step))
+    n_blocks = (n_elec + n_mech - 1) // n_mech
+    if recorder is None:
+        recorder = rec.TraceRecorder(n_blocks)
+
+    theta, omega = params.X0[dm.sv_theta], params.X0[dm.sv_omega]
+    i_ph = np.array(params.X0[dm.sv_iu:dm.sv_iw+1], dtype=float)
+    X = np.zeros(config.N_STATE_VARS)
+    V = np.zeros(dm.ph_size)
+    Xdebug = np.zeros(config.N_DEBUG_VARS)
+    sector = 0
+    U = np.zeros(config.N_SWITCHES)
+    accel = 0.
+    record_diodes = 'D' in recorder.channels
+    Xn = np.zeros(config.N_STATE_VARS)
+
+    for k in range(n_blocks):
+        j0 = k * n_mech
+        j1 = min(j0 + n_mech, n_elec)
+        idx = np.arange(j0, j1)
+        # Segments of constant switches: PWM edges and control ticks on the electrical grid
+        if inverter.averaged:
+            on = np.ones(idx.size, dtype=bool)
+        else:
+            on = np.fmod(idx * elec_step, inverter.PWM_cycle_time) <= inverter.PWM_duty_time
+        starts = np.empty(idx.size, dtype=bool)
+        starts[0] = True
+        starts[1:] = on[1:] != on[:-1]
+        starts |= (idx % n_ctrl) == 0
+        starts = np.append(np.flatnonzero(starts), idx.size)
+
+        omega_int = 0.
+        for s, s_next in zip(starts[:-1], starts[1:]):
+            ts = s * elec_step
+            X[dm.sv_theta] = theta + ts * (omega + 0.5 * accel * ts)
+            X[dm.sv_omega] = omega + accel * ts
+            X[dm.sv_iu:dm.sv_iw+1] = i_ph
+            if (j0 + s) % n_ctrl == 0:
+                # Control task, output with the switches applied so far
+                Y = dm.output(X, U, params)
+                sector = table.sector(Y[dm.ov_theta] * motor.pole_pairs)
+            U = table.apply(sector, inverter.PWM_duty if inverter.averaged else float(on[s]))
+
+            emf = dm.get_emf(X, params)
+            dm.get_phase_voltages(X, U, emf, V, params)
+            if s == 0:
+                # Sample of this mechanical step
+                Xdebug[dm.dv_eu:dm.dv_ew+1] = emf
+                Xdebug[dm.dv_ph_U:dm.dv_ph_star+1] = V
+                if recorder.wants(k):
+                    Y0 = [i_ph[0], i_ph[1], i_ph[2], V[dm.ph_U], V[dm.ph_V], V[dm.ph_W], theta, omega]
+                    D = dm.diode_mask(X, U, params) if record_diodes else None
+                    recorder.record(j0 * elec_step, X, Y0, U, Xdebug, D)
+
+            # Speed at the middle of the segment for the friction
+            T = (s_next - s) * elec_step
+            omega_mid = X[dm.sv_omega] + accel * (T / 2.)
+
+            # Exact RL update over the segment, i -> c with rate a
+            c = (V[:3] - emf - V[dm.ph_star]) * motor.inv_LM / a
+            decay = math.exp(-a * T)
+            i_int = c * T + (i_ph - c) * ((1. - decay) / a)
+            i_ph = c + (i_ph - c) * decay
+            if inverter.diodes:
+                # Freewheeling currents stop at zero
+                Xn[:] = X
+                Xn[dm.sv_iu:dm.sv_iw+1] = i_ph
+                if dm.clamp_currents(Xn, X, U, params):
+                    i_ph = Xn[dm.sv_iu:dm.sv_iw+1].copy()
+            # Mean electrical torque of the segment, emf / omega does not depend on the speed
+            etorque = np.dot(emf, i_int) / (X[dm.sv_omega] * T) if X[dm.sv_omega] != 0. else 0.
+            omega_int += T * dm.mechanical_torque(etorque, omega_mid, motor) / motor.Inertia
+
+        # Mechanical step
+        dt = (j1 - j0) * elec_step
+        omega_next = omega + omega_int
+        accel = omega_int / dt
+        theta = utils.angle_2pi(theta + dt * (omega + omega_next) / 2.)
+        omega = omega_next
+
+        if progress and (k % 1000) == 0:
+            print(f"{100. * k / n_blocks:.1f}")
+
+    return recorder.arrays()
+
+def _angle_error(a, b):
+    return np.abs(np.mod(a - b + math.pi, 2 * math.pi) - math.pi)
+
+def _errors(X, ref_X, prefix=''):
+    n = min(len(X), len(ref_X))
+    X, ref_X = X[:n], ref_X[:n]
+    i_ph = slice(dm.sv_iu, dm.sv_iw+1)
+    i_rms = np.sqrt(np.mean(ref_X[:,i_ph] ** 2))
+    return {
+        prefix + 'omega_max_err': float(np.max(np.abs(X[:,dm.sv_omega] - ref_X[:,dm.sv_omega]))),
+        prefix + 'omega_final_err': float(X[-1,dm.sv_omega] - ref_X[-1,dm.sv_omega]),
+        prefix + 'theta_max_err': float(np.max(_angle_error(X[:,dm.sv_theta], ref_X[:,dm.sv_theta]))),
+        prefix + 'i_rms_err': float(np.sqrt(np.mean((X[:,i_ph] - ref_X[:,i_ph]) ** 2)) / i_rms) if i_rms > 0 else 0.,
+    }
+
+'''
+Accuracy report
+@brief:
+    Runs the multi-rate simulation and the single rate sim_1 reference
+    (`method` at the electrical step, controller on every step) and compares
+    them on the mechanical step grid: wall times, speed and angle errors,
+    current error relative to the reference RMS current.
+    The multi-rate run is repeated with the control task on every electrical
+    step ('split_' errors): that part is the numerical error of the
+    electrical / mechanical split, the rest comes from sampling the
+    commutation at the ISR rate, which changes the modelled system itself.
+'''
+def accuracy_report(sim_time=None, method='rk4', backend='python', params=None):
+    params = params or prm.SimConfig()
+    sim_time = params.SIM_TIME if sim_time is None else sim_time
+    n_mech = _steps(params.SIM_MECH_STEP, params.SIM_STEP, 'mechanical step')
+
+    t0 = tm.perf_counter()
+    X = simulate(sim_time, params=params)[1]
+    wall = tm.perf_counter() - t0
+    X_split = simulate(sim_time, control_step=params.SIM_STEP, params=params)[1]
+
+    n_steps = int(math.ceil(sim_time / params.SIM_STEP))
+    t0 = tm.perf_counter()
+    ref_X = sim_1.simulate(method, sim_time, params.SIM_STEP, progress=False, backend=backend,
+                           recorder=rec.TraceRecorder(n_steps, ('X',), n_mech), params=params)[1]
+    ref_wall = tm.perf_counter() - t0
+
+    report = {
+        'sim_time': sim_time,
+        'reference': f"{method} ({backend}) every {params.SIM_STEP} s",
+        'rates': f"electrical {params.SIM_STEP} s, mechanical {params.SIM_MECH_STEP} s, "
+                 f"control {params.SIM_CONTROL_STEP} s",
+        'wall_time': wall,
+        'reference_wall_time': ref_wall,
+        'speedup': ref_wall / wall,
+    }
+    report.update(_errors(X, ref_X))
+    report.update(_errors(X_split, ref_X, 'split_'))
+    return report
+
+def print_report(report):
+    for name, value in report.items():
+        print(f"{name:>22}: {value:.4g}" if isinstance(value, float) else f"{name:>22}: {value}")
@@ -17,9 +17,99 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import numpy as np
 import matplotlib.pyplot as plt
 import utils
 import dyn_model  as dm
+import analysis
+
+'''
+Trace plotting
+@brief:
+    Long traces are not handed to matplotlib sample by sample: every line goes
+    through envelope(), which keeps the minimum and the maximum of each of
+    PLOT_BINS bins of samples (about one per horizontal pixel), in the order
+    they occur, so PWM ripple, current spikes and switch edges stay visible
+    whatever the trace length. Switch / diode channels are drawn as steps from
+    their edges only (switch_steps()).
+    headless() switches to the Agg backend and save_figures() writes every
+    open figure to PNG / SVG (the extension picks the format) for batch runs.
+'''
+PLOT_BINS = 2000
+
+'''
+Min / max envelope
+@brief:
+    (time, y) with y (N,) or (N, C) -> (t, y) of at most 2 * n_bins samples
+    (plus the remainder of the last bin) per column: the minimum and the
+    maximum of each bin of ceil(N / n_bins) consecutive samples, in time order.
+    Columns keep their own sample times, t is (M,) or (M, C) like y, both
+    accepted by plt.plot. Short traces are returned as they are.
+'''
+def envelope(time, y, n_bins=PLOT_BINS):
+    time = np.asarray(time)
+    y = np.asarray(y)
+    n = len(time)
+    if n <= 2 * n_bins:
+        return time, y
+    k = -(-n // n_bins)
+    m = (n // k) * k
+    bins = y[:m].reshape((m // k, k) + y.shape[1:])
+    lo = np.argmin(bins, axis=1)
+    hi = np.argmax(bins, axis=1)
+    base = (np.arange(m // k) * k).reshape((-1,) + (1,) * (y.ndim - 1))
+    idx = np.stack((np.minimum(lo, hi) + base, np.maximum(lo, hi) + base), axis=1).reshape((-1,) + y.shape[1:])
+    tail = np.arange(m, n).reshape((-1,) + (1,) * (y.ndim - 1))
+    idx = np.concatenate((idx, np.broadcast_to(tail, (n - m,) + y.shape[1:])))
+    if y.ndim == 1:
+        return time[idx], y[idx]
+    return time[idx], np.take_along_axis(y, idx, axis=0)
+
+'''
+Switch steps
+@brief:
+    (time, u) of a two level channel (N,) -> the samples where it changes plus
+    the first and the last one, drawn exact with plt.step(where='post'). With
+    more edges than 2 * n_bins (PWM over a long run) the min / max envelope is
+    returned instead, a band where the switch toggles.
+'''
+def switch_steps(time, u, n_bins=PLOT_BINS):
+    time = np.asarray(time)
+    u = np.asarray(u)
+    edges = np.flatnonzero(u[1:] != u[:-1]) + 1
+    if edges.size > 2 * n_bins:
+        return envelope(time, u, n_bins)
+    keep = np.concatenate(([0], edges, [len(u) - 1])) if len(u) else edges
+    return time[keep], u[keep]
+
+def plot_lines(time, y, *args, **kwargs):
+    return plt.plot(*envelope(time, y), *args, **kwargs)
+
+def plot_steps(time, u, *args, **kwargs):
+    return plt.step(*switch_steps(time, u), *args, where='post', **kwargs)
+
+# Render without a display, before the first figure
+def headless():
+    plt.switch_backend('Agg')
+
+'''
+Save figures
+@brief:
+    Writes every open figure to `path` with the figure label (or number)
+    appended to the file name, e.g. run.png -> run_output.png, and closes them.
+    Returns the paths written.
+'''
+def save_figures(path, dpi=100):
+    root, ext = os.path.splitext(path)
+    paths = []
+    for num in plt.get_fignums():
+        fig = plt.figure(num)
+        out = f"{root}_{fig.get_label() or num}{ext or '.png'}"
+        fig.savefig(out, dpi=dpi)
+        paths.append(out)
+    plt.close('all')
+    return paths
 
 ang_unit_rad_s = 0
 ang_unit_deg_s = 1
@@ -31,25 +121,25 @@ def plot_output(time, Y, ls):
     # Phase current
     ax = plt.subplot(4, 1, 1)
     ax.yaxis.set_label_text('A', {'color'    : 'k', 'fontsize'   : 15 })
-    plt.plot(time,Y[:,dm.ov_iu], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_iv], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_iw], ls, linewidth=1.5)
+    plot_lines(time,Y[:,dm.ov_iu], ls, linewidth=1.5)
+    plot_lines(time,Y[:,dm.ov_iv], ls, linewidth=1.5)
+    plot_lines(time,Y[:,dm.ov_iw], ls, linewidth=1.5)
     plt.legend(['$i_u$', '$i_v$', '$i_w$'], loc='upper right')
     plt.title('Phase current')
 
     # Phase terminal voltage
     ax = plt.subplot(4, 1, 2)
     ax.yaxis.set_label_text('V', {'color'    : 'k', 'fontsize'   : 15 })
-    plt.plot(time,Y[:,dm.ov_vu], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_vv], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_vw], ls, linewidth=1.5)
+    plot_lines(time,Y[:,dm.ov_vu], ls, linewidth=1.5)
+    plot_lines(time,Y[:,dm.ov_vv], ls, linewidth=1.5)
+    plot_lines(time,Y[:,dm.ov_vw], ls, linewidth=1.5)
     plt.legend(['$v_u$', '$v_v$', '$v_w$'], loc='upper right')
     plt.title('Phase terminal voltage')
 
     # Rotor mechanical position
     ax = plt.subplot(4, 1, 3)
     ax.yaxis.set_label_text('Deg', {'color'    : 'k', 'fontsize'   : 15 })
-    plt.plot(time,utils.ANGLE_DEG2RAD * Y[:,dm.ov_theta], ls, linewidth=1.5)
+    plot_lines(time,utils.ANGLE_DEG2RAD * Y[:,dm.ov_theta], ls, linewidth=1.5)
 #    plt.plot(time, Y[:,dm.ov_theta], ls, linewidth=1.5)
     plt.title('Rotor angular position')
 
@@ -58,41 +148,54 @@ def plot_output(time, Y, ls):
 
     if (ang_unit == ang_unit_rad_s):
         ax.yaxis.set_label_text('Rad/s', {'color'    : 'k', 'fontsize'   : 15 })
-        plt.plot(time,Y[:,dm.ov_omega], ls, linewidth=1.5)
+        plot_lines(time,Y[:,dm.ov_omega], ls, linewidth=1.5)
     elif (ang_unit == ang_unit_deg_s):
         ax.yaxis.set_label_text('Deg/s', {'color'    : 'k', 'fontsize'   : 15 })
-        plt.plot(time, utils.ANGLE_DEG2RAD * Y[:,dm.ov_omega], ls, linewidth=1.5)
+        plot_lines(time, utils.ANGLE_DEG2RAD * Y[:,dm.ov_omega], ls, linewidth=1.5)
     elif (ang_unit == ang_unit_rpm):
         ax.yaxis.set_label_text('RPM', {'color'    : 'k', 'fontsize'   : 15 })
-        plt.plot(time,utils.VEL_RADS2RPM*(Y[:,dm.ov_omega]), ls, linewidth=1.5)
+        plot_lines(time,utils.VEL_RADS2RPM*(Y[:,dm.ov_omega]), ls, linewidth=1.5)
 
     plt.title('Rotor Rotational Velocity')
 
 def plot_debug(time, Xdebug):
     plt.subplot(4, 1, 1)
 
-    plt.plot(time,Xdebug[:,dm.dv_eu], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ev], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ew], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_eu], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_ev], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_ew], linewidth=1.5)
     plt.legend(['$U_{BEMF}$', '$V_{BEMF}$', '$W_{BEMF}$'], loc='upper right')
 
     plt.subplot(4, 1, 2)
 
-    plt.plot(time,Xdebug[:,dm.dv_ph_U], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ph_V], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ph_W], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_ph_U], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_ph_V], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_ph_W], linewidth=1.5)
     plt.legend(['$U$', '$V$', '$W$'], loc='upper right')
 
     plt.subplot(4, 1, 3)
 
-    plt.plot(time,Xdebug[:,dm.dv_ph_star], linewidth=1.5)
+    plot_lines(time,Xdebug[:,dm.dv_ph_star], linewidth=1.5)
     plt.legend(['$star$'], loc='upper right')
 
+# D: conducting diodes (N, dm.dd_size), e.g. recorder['D']
 def plot_diodes(time, D):
 
-    titles_diodes = ['$dhu$', '$dlu$', '$dhv$', '$dlv$', '$dhw$', '$dlw$']
+    titles_diodes = ['$dlu$', '$dhu$', '$dlv$', '$dhv$', '$dlw$', '$dhw$']
 
-    for i in range(0, dm.adc_size):
-        plt.subplot(6, 2, 2*i+1)
-        plt.plot(time,D[:,i], 'r', linewidth=1.5)
+    for i in range(0, dm.dd_size):
+        plt.subplot(6, 1, i+1)
+        plot_steps(time,D[:,i], 'r', linewidth=1.5)
         plt.title(titles_diodes[i])
+
+# Electromagnetic torque and rotor speed, V_arr the debug vector
+def plot_torque(time, X, V_arr, pole_pairs):
+    ax = plt.subplot(2, 1, 1)
+    ax.yaxis.set_label_text('Nm', {'color'    : 'k', 'fontsize'   : 15 })
+    plot_lines(time, analysis.electromagnetic_torque(X, V_arr, pole_pairs), linewidth=1.5)
+    plt.title('Electromagnetic torque')
+
+    ax = plt.subplot(2, 1, 2)
+    ax.yaxis.set_label_text('RPM', {'color'    : 'k', 'fontsize'   : 15 })
+    plot_lines(time, utils.VEL_RADS2RPM * X[:,dm.sv_omega], linewidth=1.5)
+    plt.title('Rotor Rotational Velocity')
@@ -0,0 +1,176 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import utils
+import foc
+import config
+
+'''
+Simulation parameters
+@brief:
+    MotorParams, InverterParams, ControlParams and SimConfig hold one simulation setup, the
+    constants derived from it (1/(L-M), NbPoles/2, VEL_RADS2RPM/Kv, PWM times)
+    are computed once when the object is built instead of on every model
+    evaluation. Every value not given is taken from the config module, so
+    SimConfig() is the config preset as it is right now.
+    The objects are passed to the model, the controller and the simulators
+    instead of reading the modules, so several setups can run side by side in
+    one process. Treat them as read-only, replace() returns a modified copy
+    with the derived constants updated.
+'''
+
+class _Params:
+    names = ()
+
+    def __init__(self, **values):
+        unknown = set(values) - set(self.names)
+        if unknown:
+            raise ValueError(f"ERR: unknown {type(self).__name__} parameters {sorted(unknown)}")
+        for name in self.names:
+            setattr(self, name, values[name] if name in values else getattr(config, name))
+        self._derive(values)
+
+    def _derive(self, values):
+        pass
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.names}
+
+    def replace(self, **changes):
+        return type(self)(**{**self.as_dict(), **changes})
+
+    def __repr__(self):
+        args = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.names)
+        return f"{type(self).__name__}({args})"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+class MotorParams(_Params):
+    names = ('Inertia', 'tau_shaft', 'B', 'Kv', 'L', 'M', 'R', 'NbPoles', 'BEMF_LUT_SIZE',
+             'BEMF_SHAPE', 'T_fstatic', 'T_load')
+
+    def _derive(self, values):
+        if self.BEMF_SHAPE not in utils.bemf_shapes:
+            raise ValueError(f"ERR: BEMF_SHAPE is one of {sorted(utils.bemf_shapes)}, not {self.BEMF_SHAPE}")
+        # B follows Inertia / tau_shaft unless it is given itself, like in config
+        if 'B' not in values and ('Inertia' in values or 'tau_shaft' in values):
+            self.B = self.Inertia / self.tau_shaft
+        self.inv_LM = 1. / (self.L - self.M)          # 1 / (L - M)
+        self.R_LM = self.R * self.inv_LM              # R / (L - M), inverse electrical time constant
+        self.pole_pairs = self.NbPoles / 2.           # mechanical -> electrical angle
+        self.bemf_gain = utils.VEL_RADS2RPM / self.Kv # rad/s -> peak back-emf
+        # Back-emf table (angles, values) of BEMF_LUT_SIZE / BEMF_SHAPE, values as a list for bemf_phases
+        self.bemf_lut = utils.make_bemf_lut(self.BEMF_LUT_SIZE, self.BEMF_SHAPE)
+        self.bemf_table = self.bemf_lut[1].tolist()
+
+    def replace(self, **changes):
+        values = self.as_dict()
+        if 'B' not in changes and ('Inertia' in changes or 'tau_shaft' in changes):
+            del values['B']
+        values.update(changes)
+        return MotorParams(**values)
+
+class InverterParams(_Params):
+    names = ('VDC', 'V_DF', 'PWM_freq', 'PWM_duty', 'INVERTER_MODEL', 'PWM_MODE')
+
+    def _derive(self, values):
+        if self.INVERTER_MODEL not in ('diode', 'ideal'):
+            raise ValueError(f"ERR: INVERTER_MODEL is 'diode' or 'ideal', not {self.INVERTER_MODEL}")
+        if self.PWM_MODE not in ('switched', 'averaged'):
+            raise ValueError(f"ERR: PWM_MODE is 'switched' or 'averaged', not {self.PWM_MODE}")
+        self.averaged = self.PWM_MODE == 'averaged'
+        self.PWM_cycle_time = 1. / self.PWM_freq
+        self.PWM_duty_time = self.PWM_cycle_time * self.PWM_duty
+        self.diodes = self.INVERTER_MODEL == 'diode'
+        # Terminal voltage per leg state (dyn_model.leg_*), open legs float
+        self.leg_voltages = (None, 0., float(self.VDC), -float(self.V_DF), self.VDC + self.V_DF)
+
+class ControlParams(_Params):
+    names = ('CONTROLLER', 'ADC_freq', 'ZC_FILTER', 'ZC_BLANKING', 'ZC_LOCK', 'STARTUP_ALIGN_TIME',
+             'STARTUP_RAMP_TIME', 'STARTUP_STEP_START', 'STARTUP_STEP_END', 'SPEED_LOOP', 'SPEED_REF',
+             'SPEED_KP', 'SPEED_KI', 'CURRENT_LOOP', 'CURRENT_MAX', 'CURRENT_KP', 'CURRENT_KI', 'LOOP_PERIOD',
+             'FOC_MODULATION', 'FOC_KP', 'FOC_KI', 'FOC_IQ_REF', 'COSIM_TARGET')
+
+    def _derive(self, values):
+        if self.CONTROLLER not in ('six_step', 'sensorless', 'foc', 'cosim'):
+            raise ValueError(f"ERR: CONTROLLER is 'six_step', 'sensorless', 'foc' or 'cosim', not {self.CONTROLLER}")
+        if self.FOC_MODULATION not in foc.modulations:
+            raise ValueError(f"ERR: FOC_MODULATION is one of {foc.modulations}, not {self.FOC_MODULATION}")
+        self.ADC_period = 1. / self.ADC_freq
+
+'''
+SimConfig
+@brief:
+    Simulation settings plus a MotorParams (.motor), an InverterParams
+    (.inverter) and a ControlParams (.control). The keyword arguments may name
+    any parameter of the four, e.g. SimConfig(VDC=50., L=0.003, SIM_STEP=5e-7);
+    each goes to the object it belongs to. as_dict() returns all of them in one
+    flat dict.
+'''
+class SimConfig(_Params):
+    names = ('SIM_STEP', 'SIM_TIME', 'X0', 'SIM_INTEGRATOR', 'SIM_MODE', 'SIM_BACKEND', 'SIM_TRACE_FILE',
+             'SIM_MECH_STEP', 'SIM_CONTROL_STEP', 'PLOT_OUTPUT',
+             'SIM_PROFILE', 'SIM_CACHE', 'SIM_CACHE_MB')
+    # Attribute holding each group of parameters
+    groups = (('motor', MotorParams), ('inverter', InverterParams), ('control', ControlParams))
+
+    def __init__(self, motor=None, inverter=None, control=None, **values):
+        given = {'motor': motor, 'inverter': inverter, 'control': control}
+        for attr, cls in self.groups:
+            group_values = {k: values.pop(k) for k in list(values) if k in cls.names}
+            base = given[attr]
+            setattr(self, attr, cls(**group_values) if base is None else base.replace(**group_values))
+        super().__init__(**values)
+        self.X0 = tuple(float(x) for x in self.X0)
+
+    def as_dict(self):
+        values = {name: getattr(self, name) for name in self.names}
+        for attr, cls in self.groups:
+            values.update(getattr(self, attr).as_dict())
+        return values
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.names}
+        values.update(changes)
+        return SimConfig(*(getattr(self, attr) for attr, cls in self.groups), **values)
+
+    def __repr__(self):
+        groups = ''.join(f"{getattr(self, attr)!r}, " for attr, cls in self.groups)
+        return f"SimConfig({groups}" + super().__repr__()[len('SimConfig('):]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+'''
+Config preset
+@brief:
+    The SimConfig of config.py, built once on first use. The per step
+    functions (dyn_model, integrator, control) fall back to it when called
+    without params, so e.g. odeint(dm.dyn, ...) does not rebuild the whole
+    parameter set on every evaluation. Build a SimConfig() instead after
+    changing config at run time.
+'''
+_default = None
+
+def default():
+    global _default
+    if _default is None:
+        _default = SimConfig()
+    return _default
@@ -0,0 +1,158 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import json
+import time as tm
+
+'''
+Run profiling
+@brief:
+    Profiler keeps a cumulative wall time and a call count per stage of the
+    simulation step. The simulation loop calls its stages through local names;
+    with a profiler those are replaced by timed() / counted() wrappers, without
+    one the loop runs the plain functions, so profiling costs nothing when off.
+    Stages of sim_1.simulate: 'controller', 'output' (dyn_model.output),
+    'debug' (derivative plus debug vector, dyn_model.dyn_debug), 'integrator'
+    (with 'rhs' counting the model evaluations it makes), 'clamp'
+    (freewheeling diode clamping) and 'recording'; the compiled kernel is one
+    'kernel' stage.
+    The summary adds the simulated time over the wall time of the run.
+'''
+
+# Minimum wall time between two progress lines (s)
+PROGRESS_INTERVAL = 1.
+# Steps run between two progress checks
+PROGRESS_BLOCK = 1024
+
+class Profiler:
+    def __init__(self):
+        # name -> [time, calls]
+        self.stages = {}
+        self.wall_time = 0.
+        self.sim_time = 0.
+        self.steps = 0
+        self._t0 = None
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, [0., 0])
+
+    # func wrapped to add its wall time and calls to stage `name`
+    def timed(self, name, func):
+        acc = self._stage(name)
+        clock = tm.perf_counter
+        def timed_func(*args, **kwargs):
+            t0 = clock()
+            result = func(*args, **kwargs)
+            acc[0] += clock() - t0
+            acc[1] += 1
+            return result
+        return timed_func
+
+    # func wrapped to count its calls only (called inside a timed stage)
+    def counted(self, name, func):
+        acc = self._stage(name)
+        def counted_func(*args):
+            acc[1] += 1
+            return func(*args)
+        return counted_func
+
+    def start(self):
+        self._t0 = tm.perf_counter()
+
+    def stop(self, sim_time, steps):
+        self.wall_time += tm.perf_counter() - self._t0
+        self.sim_time += sim_time
+        self.steps += steps
+        self._t0 = None
+
+    '''
+    Summary
+    @brief:
+        Dict of the run totals (wall and simulated time, steps, steps per
+        second, simulated / wall time ratio) and per stage the calls, the
+        time, the time per call and the share of the wall time. Stages that
+        are only counted have no time.
+    '''
+    def summary(self):
+        wall = self.wall_time
+        stages = {}
+        for name, (time, calls) in self.stages.items():
+            stages[name] = {
+                'calls': calls,
+                'time': time,
+                'per_call': time / calls if calls else 0.,
+                'share': time / wall if wall > 0 else 0.,
+            }
+        return {
+            'wall_time': wall,
+            'sim_time': self.sim_time,
+            'steps': self.steps,
+            'steps_per_s': self.steps / wall if wall > 0 else 0.,
+            'sim_wall_ratio': self.sim_time / wall if wall > 0 else 0.,
+            'stages': stages,
+        }
+
+    def to_json(self, path=None):
+        text = json.dumps(self.summary(), indent=1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text + '\n')
+        return text
+
+    def table(self):
+        s = self.summary()
+        lines = [f"{'stage':>12} {'calls':>10} {'time [s]':>10} {'per call [us]':>14} {'share':>7}"]
+        for name, st in s['stages'].items():
+            if st['time'] == 0.:
+                # Counted only
+                lines.append(f"{name:>12} {st['calls']:>10} {'-':>10} {'-':>14} {'-':>7}")
+                continue
+            lines.append(f"{name:>12} {st['calls']:>10} {st['time']:>10.4f} {1e6 * st['per_call']:>14.3f} "
+                         f"{100. * st['share']:>6.1f}%")
+        lines.append(f"wall {s['wall_time']:.4g} s, simulated {s['sim_time']:.4g} s, {s['steps']} steps, "
+                     f"{s['steps_per_s']:.4g} steps/s, sim / wall {s['sim_wall_ratio']:.4g}")
+        return '\n'.join(lines)
+
+'''
+Throttled progress
+@brief:
+    update(done, sim_t) is called between blocks of steps (PROGRESS_BLOCK), not
+    from the step itself, and prints at most every `interval` seconds of wall
+    time: percentage, simulated / wall time ratio and the time left.
+'''
+class Progress:
+    def __init__(self, total, sim_time, interval=PROGRESS_INTERVAL, out=None):
+        self.total = total
+        self.sim_time = sim_time
+        self.interval = interval
+        self.out = out or sys.stdout
+        self.t0 = tm.perf_counter()
+        self.last = self.t0
+
+    def update(self, done, sim_t):
+        now = tm.perf_counter()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        wall = now - self.t0
+        ratio = sim_t / wall if wall > 0 else 0.
+        left = (self.sim_time - sim_t) / ratio if ratio > 0 else 0.
+        self.out.write(f"{100. * done / self.total:5.1f} %  sim / wall {ratio:.3g}  {left:.1f} s left\n")
+        self.out.flush()
@@ -0,0 +1,168 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+
+import config
+
+'''
+Trace recorder
+@brief:
+    Keeps every stride-th simulation step of the selected channels in arrays
+    preallocated for the recorded size only, instead of storing every step and
+    decimating afterwards.
+    Channels:
+    - 'X': state vector (N_STATE_VARS)
+    - 'Y': output vector (N_OUTPUT_VARS)
+    - 'U': switches, stored as one uint8 bitmask per sample (bit i = switch i, set
+      for any value above 0, so the duty of averaged PWM is not kept)
+    - 'V': debug vector, emf's and phase voltages (N_DEBUG_VARS)
+    - 'D': conducting freewheeling diodes, uint8 bitmask like 'U' (bit dyn_model.dd_*)
+    Analog channels use `dtype` (e.g. np.float32 to halve the memory), the time
+    vector is always float64.
+'''
+
+channel_sizes = {
+    'X': config.N_STATE_VARS,
+    'Y': config.N_OUTPUT_VARS,
+    'U': config.N_SWITCHES,
+    'V': config.N_DEBUG_VARS,
+    'D': config.N_SWITCHES,
+}
+
+# Channels stored as bitmasks
+mask_channels = ('U', 'D')
+
+def pack_switches(U):
+    return np.packbits(np.asarray(U) > 0, axis=-1, bitorder='little')[...,0]
+
+def unpack_switches(masks):
+    return np.unpackbits(np.asarray(masks, dtype=np.uint8)[...,None], axis=-1, count=config.N_SWITCHES,
+                         bitorder='little').astype(float)
+
+class TraceRecorder:
+    def __init__(self, n_steps, channels=('X', 'Y', 'U', 'V'), stride=1, dtype=np.float64):
+        for name in channels:
+            if name not in channel_sizes:
+                raise ValueError(f"ERR: unknown channel {name}, expected one of {list(channel_sizes)}")
+        self.channels = tuple(channels)
+        self.stride = int(stride)
+        self.dtype = np.dtype(dtype)
+        self.size = (n_steps + self.stride - 1) // self.stride
+        self.pos = 0
+        self.time = np.zeros(self.size)
+        self.data = {}
+        for name in self.channels:
+            if name in mask_channels:
+                self.data[name] = np.zeros(self.size, dtype=np.uint8)
+            else:
+                self.data[name] = np.zeros((self.size, channel_sizes[name]), dtype=self.dtype)
+
+    # True when step i is kept
+    def wants(self, i):
+        return (i % self.stride) == 0
+
+    # Record one step, channels that are not selected are ignored, D is a bitmask
+    def record(self, t, X=None, Y=None, U=None, V=None, D=None):
+        n = self.pos
+        self.time[n] = t
+        for name, value in (('X', X), ('Y', Y), ('V', V)):
+            if name in self.data:
+                self.data[name][n] = value
+        if 'U' in self.data:
+            mask = 0
+            for i in range(config.N_SWITCHES):
+                if U[i]:
+                    mask |= 1 << i
+            self.data['U'][n] = mask
+        if 'D' in self.data:
+            self.data['D'][n] = D
+        self.pos = n + 1
+
+    # Record already decimated samples, U and D given as switch vectors or bitmasks
+    def record_block(self, time, X=None, Y=None, U=None, V=None, D=None):
+        n, m = self.pos, len(time)
+        self.time[n:n+m] = time
+        for name, value in (('X', X), ('Y', Y), ('V', V)):
+            if name in self.data:
+                self.data[name][n:n+m] = value
+        for name, value in (('U', U), ('D', D)):
+            if name in self.data:
+                value = np.asarray(value)
+                self.data[name][n:n+m] = value if value.ndim == 1 else pack_switches(value)
+        self.pos = n + m
+
+    def __getitem__(self, name):
+        if name == 'time':
+            return self.time[:self.pos]
+        if name in mask_channels:
+            return unpack_switches(self.data[name][:self.pos])
+        return self.data[name][:self.pos]
+
+    def nbytes(self):
+        return self.time.nbytes + sum(a.nbytes for a in self.data.values())
+
+    # (time, X, Y, U, V_arr) like sim_1.simulate, None for channels not recorded
+    def arrays(self):
+        return (self['time'],) + tuple(self[name] if name in self.data else None for name in ('X', 'Y', 'U', 'V'))
+
+'''
+Chunked recorder
+@brief:
+    A TraceRecorder whose buffer holds one chunk of chunk_size samples (at
+    most the recorded size of the run); every full chunk, and the rest on
+    flush(), goes to _consume() and the buffer starts over. Subclasses decide
+    where chunks go (trace_io.StreamingRecorder to disk, analysis.KpiRecorder
+    to a KPI accumulator), memory stays one chunk whatever the run length.
+'''
+class ChunkedRecorder(TraceRecorder):
+    def __init__(self, n_steps, channels=('X', 'Y', 'U', 'V'), stride=1, dtype=np.float64, chunk_size=65536):
+        self.total = (n_steps + int(stride) - 1) // int(stride)
+        self.chunk_size = max(1, min(chunk_size, self.total))
+        super().__init__(self.chunk_size * int(stride), channels, stride, dtype)
+        self.written = 0
+
+    # chunk: {'time': (M,), name: (M, ...) as stored, bitmasks for U and D}
+    def _consume(self, chunk):
+        raise NotImplementedError
+
+    def flush(self):
+        if self.pos == 0:
+            return
+        chunk = {'time': self.time[:self.pos]}
+        for name, a in self.data.items():
+            chunk[name] = a[:self.pos]
+        self._consume(chunk)
+        self.written += self.pos
+        self.pos = 0
+
+    def record(self, t, X=None, Y=None, U=None, V=None, D=None):
+        super().record(t, X, Y, U, V, D)
+        if self.pos == self.size:
+            self.flush()
+
+    def record_block(self, time, X=None, Y=None, U=None, V=None, D=None):
+        start = 0
+        while start < len(time):
+            m = min(self.size - self.pos, len(time) - start)
+            part = slice(start, start + m)
+            super().record_block(time[part], *(None if a is None else a[part] for a in (X, Y, U, V, D)))
+            if self.pos == self.size:
+                self.flush()
+            start += m
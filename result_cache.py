@@ -0,0 +1,245 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import hashlib
+import tempfile
+import time as tm
+
+import numpy as np
+
+import control    as ctl
+import params     as prm
+import my_plot    as mp
+import sim_1
+import config
+
+'''
+Result cache
+@brief:
+    Results of finished runs on disk, addressed by the hash of everything the
+    result depends on (run_key): every params.SimConfig value (motor,
+    inverter, control, integrator), the run settings (mode, method, time,
+    step, resolved backend, KPI window) and the model code version, the hash
+    of the sources in MODEL_SOURCES. Changing a parameter or the model code
+    gives another key, so only the runs it affects are computed again; nothing
+    is ever invalidated by hand.
+    An entry is one .npz file: the KPIs (analysis.py) and optionally the trace,
+    reduced to the samples holding the minimum and maximum of every channel in
+    each of TRACE_BINS bins (decimate), so it plots like the full trace does
+    (my_plot.envelope) with a shared time vector. The cache is kept under
+    max_mb; the least recently used entries (file modification time, bumped on
+    every hit) go first. Entries are written to a temporary file and renamed,
+    so processes sharing a directory never read half an entry.
+    Runs with a co-simulation controller are not cached, their code is not
+    part of the key.
+'''
+# Parameters that only choose where the output goes
+OUTPUT_NAMES = ('SIM_TRACE_FILE', 'PLOT_OUTPUT', 'SIM_PROFILE', 'SIM_CACHE', 'SIM_CACHE_MB')
+# The code a cached run goes through, from the parameters to the stored KPIs and
+# trace: the simulation loops of the cached modes (sim_1, jit_kernel, event_sim,
+# multirate) with their integrators, the model, the controllers they can run, the
+# derived parameters, and the recording and reduction to KPIs (recorder, trace_io,
+# analysis). Their hash is the model code version. batch_model and steady_state
+# do not produce cached results, cosim runs are never cached, config.py values
+# are in the key through params already.
+MODEL_SOURCES = ('sim_1.py', 'jit_kernel.py', 'event_sim.py', 'multirate.py', 'integrator.py',
+                 'dyn_model.py', 'utils.py', 'control.py', 'foc.py', 'params.py',
+                 'recorder.py', 'trace_io.py', 'analysis.py')
+# Bins of a cached trace, as many as a plot draws
+TRACE_BINS = mp.PLOT_BINS
+
+_code_version = None
+
+def code_version():
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha256(np.__version__.encode())
+        root = os.path.dirname(os.path.abspath(__file__))
+        for name in MODEL_SOURCES:
+            with open(os.path.join(root, name), 'rb') as f:
+                h.update(name.encode() + b'\0' + f.read())
+        _code_version = h.hexdigest()[:16]
+    return _code_version
+
+def cacheable(params):
+    return params.control.CONTROLLER != 'cosim'
+
+# Backend a fixed step run of these params ends up on
+def resolved_backend(params, method, backend):
+    return 'jit' if ctl.is_angle_controller(params) and sim_1.use_jit(method, backend) else 'python'
+
+'''
+Run key
+@brief:
+    Hex digest of the params (minus OUTPUT_NAMES, numbers as floats), the run
+    settings and the code version. The settings are keyword values (JSON),
+    e.g. mode, method, sim_time, sim_step, backend, stride, t_start.
+'''
+def run_key(params, **settings):
+    # 0 and 0. (config.py vs an override) are the same parameter
+    values = {k: float(v) if isinstance(v, int) and not isinstance(v, bool) else v
+              for k, v in params.as_dict().items() if k not in OUTPUT_NAMES}
+    text = json.dumps({'params': values, 'run': settings, 'code': code_version()}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+'''
+Decimate a trace
+@brief:
+    {name: array (N, ...)} with 'time' -> the samples where any column of any
+    channel has its minimum or maximum within one of n_bins bins of
+    consecutive samples (plus the first, the last and the remainder of the
+    last bin). Peaks and PWM ripple survive, unlike keeping every k-th sample.
+    Unchanged when that would not drop anything.
+'''
+def decimate(trace, n_bins=TRACE_BINS):
+    n = len(trace['time'])
+    k = -(-n // n_bins)
+    if k < 2:
+        return trace
+    m = (n // k) * k
+    base = (np.arange(m // k) * k)[:, None]
+    keep = [np.array([0, n - 1]), np.arange(m, n)]
+    for name, a in trace.items():
+        if name == 'time':
+            continue
+        bins = np.asarray(a)[:m].reshape(m // k, k, -1)
+        keep += [(np.argmin(bins, axis=1) + base).ravel(), (np.argmax(bins, axis=1) + base).ravel()]
+    keep = np.unique(np.concatenate(keep))
+    if keep.size >= n:
+        return trace
+    return {name: np.asarray(a)[keep] for name, a in trace.items()}
+
+class Entry:
+    def __init__(self, key, kpis, trace=None, meta=None):
+        self.key = key
+        self.kpis = kpis
+        self.trace = trace
+        self.meta = meta or {}
+
+class ResultCache:
+    def __init__(self, path, max_mb=config.SIM_CACHE_MB, trace_bins=TRACE_BINS):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.trace_bins = trace_bins
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    '''
+    Look up
+    @brief:
+        The Entry of `key`, or None (a miss). With trace=True an entry stored
+        without its trace is a miss too.
+    '''
+    def get(self, key, trace=False):
+        path = self._file(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                meta = json.loads(str(f['meta']))
+                data = {name: f[name] for name in f.files if name != 'meta'}
+        except (OSError, ValueError, KeyError):
+            # Missing, or removed / truncated by another process
+            self.misses += 1
+            return None
+        if trace and not data:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return Entry(key, meta.pop('kpis'), data or None, meta)
+
+    '''
+    Store
+    @brief:
+        kpis: JSON dict, trace: {name: array} with 'time' (decimated here),
+        meta: JSON dict kept with the entry (e.g. the overrides of a sweep
+        point). Evicts down to the size cap afterwards.
+    '''
+    def put(self, key, kpis, trace=None, meta=None):
+        meta = dict(meta or {}, kpis=kpis, created=tm.strftime('%Y-%m-%dT%H:%M:%S'), code=code_version())
+        arrays = decimate(trace, self.trace_bins) if trace is not None else {}
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, meta=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmp, self._file(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.stores += 1
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for e in os.scandir(self.path):
+            if e.name.endswith('.npz') and not e.name.startswith('tmp'):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    # Least recently used entries removed until the cache fits max_bytes
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.unlink(path)
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+# Cache of SIM_CACHE / SIM_CACHE_MB, None when it is off
+def from_params(params=None):
+    params = params or prm.SimConfig()
+    if not params.SIM_CACHE:
+        return None
+    return ResultCache(params.SIM_CACHE, params.SIM_CACHE_MB)
@@ -18,17 +18,24 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import matplotlib
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import integrate
-from scipy.signal import decimate
 
 import utils
 import dyn_model  as dm
 import control    as ctl
 import my_plot    as mp
 import config
+import params     as prm
+import integrator
+import event_sim
+import multirate
+import jit_kernel
+import recorder   as rec
+import profiler   as prof
+import trace_io
+import analysis
+import result_cache as rc
 
 
 def display_state_and_command(time, X, U):
@@ -36,103 +43,227 @@ def display_state_and_command(time, X, U):
     titles_cmd = ['$u_l$', '$u_h$', '$v_l$', '$v_h$', '$w_l$', '$w_h$']
     for i in range(0, 2):
         plt.subplot(6, 2, 2*i+1)
-        plt.plot(time, utils.ANGLE_DEG2RAD * X[:,i], 'r', linewidth=3.0)
+        mp.plot_lines(time, utils.ANGLE_DEG2RAD * X[:,i], 'r', linewidth=3.0)
         plt.title(titles_state[i])
     for i in range(2, config.N_STATE_VARS):
         plt.subplot(6, 2, 2*i+1)
-        plt.plot(time, X[:,i], 'r', linewidth=3.0)
+        mp.plot_lines(time, X[:,i], 'r', linewidth=3.0)
         plt.title(titles_state[i])
     for i in range(0, 6):
         plt.subplot(6, 2, 2*i+2)
-        plt.plot(time, U[:,i], 'r', linewidth=3.0)
+        mp.plot_steps(time, U[:,i], 'r', linewidth=3.0)
         plt.title(titles_cmd[i])
 
-def print_simulation_progress(count, steps):
-        sim_perc_last = ((count-1)*100) / steps
-        sim_perc = (count*100) / steps
-        if (sim_perc_last != sim_perc):
-            print(f"{sim_perc}")
+def use_jit(method, backend=config.SIM_BACKEND):
+    if backend == 'python':
+        return False
+    if backend == 'jit' and not jit_kernel.available:
+        raise ImportError("ERR: SIM_BACKEND is 'jit' but numba is not installed")
+    return jit_kernel.available and (method in jit_kernel.methods)
 
-def drop_it(a, factor):
-	new = []
-	for n, x in enumerate(a):
-		if ((n % factor) == 0):
-			new.append(x)
-	return np.array(new)
+'''
+Fixed step simulation
+@brief:
+    Every step k: the output is computed with the switches of the previous step,
+    the controller sets U(k) from it, one model evaluation gives the derivative
+    (reused as first integrator stage) and the debug vector, then the state is
+    advanced with U(k) held constant.
+    Steps are recorded in `recorder` (recorder.TraceRecorder), by default every
+    channel of every step. Returns (time, X, Y, U, V_arr) of the recorded steps.
+    params (params.SimConfig, config preset when None) gives the motor, the
+    inverter and the defaults of method, sim_time, sim_step and backend.
+    controller is called as U = controller(Y, t, params), by default the one
+    of params.control.CONTROLLER (control.make_controller). Only the six step
+    angle controller has a compiled kernel.
+    progress prints a line at most every profiler.PROGRESS_INTERVAL seconds,
+    checked between blocks of steps. With a profiler (profiler.Profiler) the
+    stages of every step are timed, see profiler.py.
+    With a state (checkpoint.Snapshot) the run starts where the state is (step,
+    X, switches, controller, RNG; its params when none are given), runs
+    sim_time more and leaves the state at the step after its last one, so runs
+    continued from it line up step for step with one unbroken run.
+'''
+def simulate(method=None, sim_time=None, sim_step=None, progress=True, backend=None, recorder=None,
+             params=None, controller=None, profiler=None, state=None):
+    params = params or (state.params if state is not None else prm.SimConfig())
+    method = params.SIM_INTEGRATOR if method is None else method
+    sim_time = params.SIM_TIME if sim_time is None else sim_time
+    sim_step = params.SIM_STEP if sim_step is None else sim_step
+    backend = params.SIM_BACKEND if backend is None else backend
 
+    # TIME VECTOR
+    time = np.arange(0.0, sim_time, sim_step)
+    n_steps = time.size
+    first = 0
+    if state is not None:
+        # Steps first.. on the grid of the unbroken run, plus the step the state ends at
+        first = state.begin(sim_step)
+        time = np.arange(first, first + n_steps + 1) * sim_step
 
-def compress(a, factor):
-	return drop_it(a, factor)
+    if recorder is None:
+        recorder = rec.TraceRecorder(n_steps)
 
+    # A controller made here is closed here (co-simulation rings and processes)
+    owned = None
+    if controller is None and state is not None:
+        controller = state.controller
+    if controller is None:
+        controller = ctl.make_controller(params)
+        owned = controller if state is None else None
+    plain_controller = controller
+    if controller is not ctl.run:
+        if backend == 'jit':
+            raise ValueError("ERR: the compiled kernel only runs the six step angle controller")
+        backend = 'python'
 
-def main():
+    if use_jit(method, backend):
+        kernel = jit_kernel.simulate
+        if profiler is not None:
+            kernel = profiler.timed('kernel', kernel)
+            profiler.start()
+        kernel(method, sim_time, sim_step, recorder, params=params, state=state)
+        if profiler is not None:
+            profiler.stop(sim_time, n_steps)
+        if state is not None:
+            state.controller = plain_controller
+        return recorder.arrays()
 
-    # TIME VECTOR
-    time = np.arange(0.0, config.SIM_TIME, config.SIM_STEP)
-    
-    # STATE VECTOR
-    X = np.zeros((time.size, config.N_STATE_VARS))
+    step = integrator.get(method)
+    # Stages called through local names, wrapped when profiling
+    output, dyn_debug, rhs, clamp, record = dm.output, dm.dyn_debug, dm.dyn, dm.clamp_currents, recorder.record
+    if profiler is not None:
+        controller = profiler.timed('controller', controller)
+        output = profiler.timed('output', output)
+        dyn_debug = profiler.timed('debug', dyn_debug)
+        step = profiler.timed('integrator', step)
+        rhs = profiler.counted('rhs', rhs)
+        clamp = profiler.timed('clamp', clamp)
+        record = profiler.timed('recording', record)
+        profiler.start()
+    report = prof.Progress(n_steps, sim_time) if progress else None
 
-    # OUTPUT VECTOR
-    Y = np.zeros((time.size, config.N_OUTPUT_VARS))
+    # STATE VECTOR
+    X = np.array(params.X0 if state is None else state.X, dtype=float)
 
     # INPUT VECTOR (which phases are excited)
-    U = np.zeros((time.size, config.N_SWITCHES))
+    U = np.zeros(config.N_SWITCHES) if state is None else np.array(state.U, dtype=float)
+
+    record_diodes = 'D' in recorder.channels
+
+    # Blocks of steps, progress is only looked at in between
+    for start in range(0, n_steps, prof.PROGRESS_BLOCK):
+        for i in range(start, min(start + prof.PROGRESS_BLOCK, n_steps)):
+            # The switch should be a part of the whole equation and integration because you need the EMF for control and you could
+            # just integrate the whole timeseries in that case.
+            # Get phase voltages, angle and rot-speed at t=i with the switches of the last step (used to set the switches accordingly)
+            Y = output(X, U, params)
+
+            U = controller(Y, time[i], params)    # run the controller for this step
+
+            # Derivative and debug data at t=i in one model evaluation, reused as the first integrator stage
+            Xd0, Xdebug = dyn_debug(X, time[i], U, params)
 
-    # EMF's and phase voltages
-    V_arr = np.zeros((time.size, config.N_DEBUG_VARS))
+            if recorder.wants(first + i):
+                D = dm.diode_mask(X, U, params) if record_diodes else None
+                record(time[i], X, Y, U, Xdebug, D)
 
-    X[0,:] = config.X0
+            if i + 1 < time.size:
+                # Advance the state over one step with the switches held constant (see integrator.py)
+                X_prev = X
+                X = step(rhs, X, time[i], time[i+1] - time[i], (U, params), Xd0, params)
+                clamp(X, X_prev, U, params) # freewheeling currents stop at zero
+                X[dm.sv_theta] = utils.angle_2pi( X[dm.sv_theta] ) # normalize the angle in the state
+        if report is not None:
+            report.update(i + 1, time[i] - time[0])
 
-    for i in range(1,time.size):
-        # The switch should be a part of the whole equation and integration because you need the EMF for control and you could
-        # just integrate the whole timeseries in that case.
-        #? Why take the state of the switches at time t=i-2?
-        if i==1:
-            Uim2 = np.zeros(config.N_SWITCHES)
+    if profiler is not None:
+        profiler.stop(sim_time, n_steps)
+    if state is not None:
+        state.end(first + n_steps, X, U, plain_controller)
+    if hasattr(owned, 'close'):
+        owned.close()
+    return recorder.arrays()
+
+
+def main():
+
+    # Every step is kept, the plots decimate to their envelope (my_plot.envelope)
+    compress_factor = 1
+    params = prm.SimConfig()
+    if params.PLOT_OUTPUT:
+        mp.headless()
+
+    # Same parameters, settings and model code as an earlier run: its result from the cache
+    cache = rc.from_params(params)
+    if params.SIM_PROFILE or params.SIM_TRACE_FILE or not rc.cacheable(params):
+        cache = None
+    entry, D = None, None
+    if cache is not None:
+        backend = None
+        if params.SIM_MODE == 'fixed':
+            backend = rc.resolved_backend(params, params.SIM_INTEGRATOR, params.SIM_BACKEND)
+        key = rc.run_key(params, mode=params.SIM_MODE, method=params.SIM_INTEGRATOR, sim_time=params.SIM_TIME,
+                         sim_step=params.SIM_STEP, backend=backend, stride=compress_factor,
+                         t_start=params.SIM_TIME / 2.)
+        entry = cache.get(key, trace=True)
+    if entry is not None:
+        time, X, Y, U, V_arr = (entry.trace[name] for name in ('time', 'X', 'Y', 'U', 'V'))
+        D = entry.trace.get('D')
+        kpis = entry.kpis
+        print(f"result from the cache ({cache.path}/{key[:12]}...)")
+    elif params.SIM_MODE == 'event':
+        time, X, Y, U, V_arr, stats = event_sim.simulate(params=params)
+        print(stats)
+    elif params.SIM_MODE == 'multirate':
+        # One sample per mechanical step already
+        time, X, Y, U, V_arr = multirate.simulate(params=params, progress=True)
+    else:
+        n_steps = np.arange(0.0, params.SIM_TIME, params.SIM_STEP).size
+        channels = ('X', 'Y', 'U', 'V', 'D')
+        if params.SIM_TRACE_FILE:
+            recorder = trace_io.StreamingRecorder(params.SIM_TRACE_FILE, n_steps, channels, compress_factor,
+                                                  params=params)
         else:
-            Uim2 = U[i-2,:]
-
-        # Get phase voltages, angle and rot-speed at t=i-1 (used to set the switches accordingly)
-        Y[i-1,:] = dm.output(X[i-1,:], Uim2)
-        
-        # 
-        U[i-1,:] = ctl.run(Y[i-1,:], time[i-1])            # run the controller for the last step
-
-        '''
-        INPUT:
-        - dyn: function computing the derviative of y at t.
-        - y: initial condition on y to integrate (vector)
-        - t: sequence of time points to be solved (should be monotonically increasing or decreasing)
-        - args: tuple of extra arguments to be passed ot the function
-        RETURN:
-        - y: array containing value of y for each desired time in t
-        '''
-        tmp = integrate.odeint(dm.dyn, X[i-1,:], [time[i-1], time[i]], args=(U[i-1,:],)) # integrate
-        X[i,:] = tmp[1,:] # Copy integration output to the current step
-        X[i, dm.sv_theta] = utils.angle_2pi( X[i, dm.sv_theta] ) # normalize the angle in the state
-        tmp, V_arr[i,:] = dm.dyn_debug(X[i-1,:], time[i-1], U[i-1,:]) # get debug data
-        print_simulation_progress(i, time.size)
-
-    Y[-1,:] = Y[-2,:]
-    U[-1,:] = U[-2,:]
-
-    compress_factor = 3
-    if compress_factor > 1:
-        time = compress(time, compress_factor)
-        Y = compress(Y, compress_factor)
-        X = compress(X, compress_factor)
-        U = compress(U, compress_factor)
-        V_arr = compress(V_arr, compress_factor)
+            recorder = rec.TraceRecorder(n_steps, channels, compress_factor)
+        profiler = prof.Profiler() if params.SIM_PROFILE else None
+        time, X, Y, U, V_arr = simulate(recorder=recorder, params=params, profiler=profiler)
+        if profiler is not None:
+            if params.SIM_PROFILE == 'table':
+                print(profiler.table())
+            else:
+                profiler.to_json(params.SIM_PROFILE)
+        D = recorder['D'] if params.inverter.diodes else None
+
+    if cache is not None and entry is None:
+        kpis = analysis.kpis(time, X, U, V_arr, params, t_start=params.SIM_TIME / 2.)
+        trace = {'time': time, 'X': X, 'Y': Y, 'U': U, 'V': V_arr}
+        if D is not None:
+            trace['D'] = D
+        cache.put(key, kpis, trace)
+    if cache is not None:
+        print(kpis)
+        print(cache.stats())
 
+    if D is not None:
+        plt.figure('diodes', figsize=(10.24, 5.12))
+        mp.plot_diodes(time, D)
+
+    plt.figure('output')
     mp.plot_output(time, Y, '-')
-    plt.figure(figsize=(10.24, 5.12))
+    plt.figure('state', figsize=(10.24, 5.12))
     display_state_and_command(time, X, U)
 
-    plt.figure(figsize=(10.24, 5.12))
+    plt.figure('debug', figsize=(10.24, 5.12))
     mp.plot_debug(time, V_arr)
 
-    plt.show()
+    plt.figure('torque', figsize=(10.24, 5.12))
+    mp.plot_torque(time, X, V_arr, params.motor.pole_pairs)
+
+    if params.PLOT_OUTPUT:
+        for path in mp.save_figures(params.PLOT_OUTPUT):
+            print(path)
+    else:
+        plt.show()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,268 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import numpy as np
+from scipy import optimize
+
+import dyn_model  as dm
+import control    as ctl
+import params     as prm
+import recorder   as rec
+import analysis
+import sim_1
+
+'''
+Periodic steady state
+@brief:
+    At a fixed speed the motor and its controller are periodic over one
+    electrical turn, so instead of simulating the spin-up the phase currents at
+    the start of the turn are solved for the ones they come back to at its end:
+    - 'cycle': the turn is simulated again from where the last one ended until
+      the currents repeat (converges like exp(-turn / (L / R)), fast unless the
+      turn is short against the electrical time constant). Works with any
+      controller, a stateful one (FOC, speed loop) keeps its state from turn to
+      turn.
+    - 'shooting': Newton iterations on the start currents, the Jacobian of one
+      turn by finite differences (two more turns per iteration, currents sum to
+      zero). Needs a controller without state, the six step angle controller.
+    The speed is held by running sim_1.simulate with an infinite rotor inertia
+    (friction B kept for the KPIs), the same code and backends as a transient
+    run. The turn is rounded to a whole number of PWM cycles so the PWM
+    repeats too, the speed actually used is returned.
+'''
+solvers = ('cycle', 'shooting')
+
+# Start currents are perturbed in the plane of currents summing to zero
+_directions = np.array([[1., -1., 0.], [1., 1., -2.]]).T / np.array([math.sqrt(2.), math.sqrt(6.)])
+
+'''
+Electrical turn at a speed
+@brief:
+    Returns (period, n_steps, omega): the turn rounded to whole PWM cycles, so
+    the PWM and the controllers sampling on it repeat too (the smallest number
+    of PWM cycles that is also a whole number of sim_step when there is one
+    below 1000), and the speed of that turn with the sign of omega.
+'''
+def cycle_period(omega, params, sim_step):
+    if omega == 0:
+        raise ValueError("ERR: the periodic steady state needs a speed, got 0")
+    period = 2 * math.pi / (abs(omega) * params.motor.pole_pairs)
+    grid = params.inverter.PWM_cycle_time
+    for k in range(1, 1000):
+        if abs(k * grid / sim_step - round(k * grid / sim_step)) < 1e-6:
+            grid *= k
+            break
+    n_steps = max(1, round(period / grid)) * max(1, int(round(grid / sim_step)))
+    period = n_steps * sim_step
+    return period, n_steps, math.copysign(2 * math.pi / (period * params.motor.pole_pairs), omega)
+
+# Controller seeing the time of the whole run, turns are simulated from t = 0
+class _Shifted:
+    def __init__(self, controller):
+        self.controller = controller
+        self.t0 = 0.
+
+    def __call__(self, Y, t, params=None):
+        return self.controller(Y, self.t0 + t, params)
+
+'''
+Per-cycle KPIs
+@brief:
+    Over the samples of one turn (X, debug vector V_arr): mean electromagnetic
+    torque and its ripple (peak to peak over the mean), shaft torque (minus the
+    viscous and static friction, positive in the direction of the speed), phase
+    current RMS, peak and ripple (peak to peak within a PWM cycle, averaged over
+    the turn, zero with averaged PWM), input power sum(v * i), copper losses, shaft power
+    p_out (shaft torque times the speed) and the efficiency between p_in and p_out
+    (analysis.efficiency, also in generator mode).
+'''
+def cycle_kpis(X, V_arr, params, sim_step):
+    motor = params.motor
+    i_ph = X[:, dm.sv_iu:dm.sv_iw+1]
+    n = max(1, int(round(params.inverter.PWM_cycle_time / sim_step)))
+    k = len(i_ph) // n
+    i_ripple = np.mean(np.max(np.ptp(i_ph[:k*n].reshape(k, n, 3), axis=1), axis=1)) if k else 0.
+    omega = X[0, dm.sv_omega]
+    p_in = np.mean(analysis.powers(X, V_arr)[0])
+    torque = analysis.electromagnetic_torque(X, V_arr, motor.pole_pairs)
+    torque_mean = float(np.mean(torque))
+    shaft = math.copysign(1., omega) * (torque_mean - motor.B * omega)
+    shaft -= math.copysign(min(abs(shaft), motor.T_fstatic), shaft)
+    p_out = shaft * abs(omega)
+    return {
+        'omega': float(omega),
+        'torque_mean': torque_mean,
+        'torque_ripple': float(np.ptp(torque) / abs(torque_mean)) if torque_mean != 0 else 0.,
+        'shaft_torque': float(shaft),
+        'i_rms': float(np.sqrt(np.mean(i_ph ** 2))),
+        'i_peak': float(np.max(np.abs(i_ph))),
+        'i_ripple': float(i_ripple),
+        'p_in': float(p_in),
+        'p_copper': float(np.mean(analysis.copper_losses(X, motor.R))),
+        'p_out': float(p_out),
+        'efficiency': float(analysis.efficiency(p_in, p_out)),
+    }
+
+class _Turn:
+    def __init__(self, params, omega, sim_step, method, backend, controller):
+        self.period, self.n_steps, self.omega = cycle_period(omega, params, sim_step)
+        motor = params.motor
+        self.params = params.replace(Inertia=math.inf, B=motor.B)
+        self.sim_step = sim_step
+        self.method = method
+        self.backend = backend
+        self.controller = controller
+        self.count = 0
+
+    # One turn from the start currents i0, returns (X, V_arr) of its samples and the end currents
+    def run(self, i0):
+        params = self.params.replace(X0=(0., self.omega) + tuple(i0))
+        recorder = rec.TraceRecorder(self.n_steps + 1, ('X', 'V'))
+        # One step more for the state at the end of the turn
+        time, X, Y, U, V_arr = sim_1.simulate(self.method, (self.n_steps + 0.5) * self.sim_step, self.sim_step,
+                                              progress=False, backend=self.backend, recorder=recorder,
+                                              params=params, controller=self.controller)
+        if isinstance(self.controller, _Shifted):
+            self.controller.t0 += self.period
+        self.count += 1
+        return X[:-1], V_arr[:-1], X[-1, dm.sv_iu:dm.sv_iw+1].copy()
+
+'''
+Solve the periodic steady state at a speed
+@brief:
+    omega in rad/s (mechanical, signed: the six step sequences turn backwards).
+    params (params.SimConfig, config preset when None) gives the motor, the
+    inverter, the controller (or pass one) and the defaults of sim_step /
+    method / backend. Stops when the start and end currents of a turn differ by
+    less than tol times the peak current. Returns a dict with the speed used,
+    the turn period, the number of turns simulated, the residual, converged,
+    the samples of the last turn (time, X, V_arr) and its KPIs (cycle_kpis).
+'''
+def solve(omega, params=None, controller=None, sim_step=None, method=None, backend=None, solver=None,
+          tol=1e-6, max_cycles=50, i0=None):
+    params = params or prm.SimConfig()
+    sim_step = params.SIM_STEP if sim_step is None else sim_step
+    method = params.SIM_INTEGRATOR if method is None else method
+    backend = params.SIM_BACKEND if backend is None else backend
+    if controller is None:
+        controller = ctl.make_controller(params)
+    stateless = controller is ctl.run
+    if solver is None:
+        solver = 'shooting' if stateless else 'cycle'
+    if solver not in solvers:
+        raise ValueError(f"ERR: solver is one of {solvers}, not {solver}")
+    if solver == 'shooting' and not stateless:
+        raise ValueError("ERR: shooting needs a controller without state (control.run), use solver='cycle'")
+    if not stateless:
+        controller = _Shifted(controller)
+
+    turn = _Turn(params, omega, sim_step, method, backend, controller)
+    i0 = np.zeros(3) if i0 is None else np.asarray(i0, dtype=float)
+    X, V_arr, i1 = turn.run(i0)
+    residual = i1 - i0
+    while True:
+        scale = max(np.max(np.abs(X[:, dm.sv_iu:dm.sv_iw+1])), 1e-6)
+        if np.max(np.abs(residual)) <= tol * scale or turn.count >= max_cycles:
+            break
+        if solver == 'cycle':
+            i0 = i1
+        else:
+            # Newton on the start currents, J d = -residual with J = dPhi/di0 - I
+            eps = 1e-4 * scale
+            J = np.empty((3, 2))
+            for k in range(2):
+                J[:, k] = (turn.run(i0 + eps * _directions[:, k])[2] - i1) / eps - _directions[:, k]
+            i0 = i0 + _directions @ np.linalg.lstsq(J, -residual, rcond=None)[0]
+        X, V_arr, i1 = turn.run(i0)
+        residual = i1 - i0
+
+    time = np.arange(turn.n_steps) * sim_step
+    return {
+        'omega': turn.omega,
+        'period': turn.period,
+        'cycles': turn.count,
+        'residual': float(np.max(np.abs(residual))),
+        'converged': bool(np.max(np.abs(residual)) <= tol * scale),
+        'i0': i0,
+        'time': time,
+        'X': X,
+        'V_arr': V_arr,
+        'kpis': cycle_kpis(X, V_arr, turn.params, sim_step),
+    }
+
+'''
+Steady state at a load torque
+@brief:
+    The speed where the shaft torque of the periodic solution equals T_load
+    (Nm, in the direction of the speed), searched between omega_min and
+    omega_max (same sign, the shaft torque has to change sign of its error
+    over the range). Returns the solve() result at that speed, exact up to the
+    rounding of the turn to whole PWM cycles.
+'''
+def solve_load(T_load, omega_min, omega_max, params=None, xtol=1e-2, **kwargs):
+    results = {}
+    def error(omega):
+        results[omega] = solve(omega, params, **kwargs)
+        return results[omega]['kpis']['shaft_torque'] - T_load
+    omega = optimize.brentq(error, omega_min, omega_max, xtol=xtol)
+    return results[omega] if omega in results else solve(omega, params, **kwargs)
+
+# Parameter that sets the torque of each controller and its range
+def _knob(params):
+    if params.control.CONTROLLER == 'foc':
+        return 'FOC_IQ_REF', (0., params.control.CURRENT_MAX)
+    return 'PWM_duty', (0., 1.)
+
+'''
+Efficiency map
+@brief:
+    Speed x torque grid of periodic steady states. At every speed the torque
+    setting of the controller (PWM_duty for six step, FOC_IQ_REF for FOC, or
+    `knob` = (name, (low, high))) is searched for the shaft torque of each
+    point of `torques`. Returns a dict of (len(speeds), len(torques)) arrays:
+    the knob value, efficiency, input power, torque ripple and phase current
+    RMS, NaN where the torque can not be reached at that speed.
+'''
+def efficiency_map(speeds, torques, params=None, knob=None, xtol=1e-4, **kwargs):
+    params = params or prm.SimConfig()
+    name, (low, high) = knob or _knob(params)
+    shape = (len(speeds), len(torques))
+    out = {key: np.full(shape, np.nan) for key in (name, 'efficiency', 'p_in', 'torque_ripple', 'i_rms')}
+    out['omega'] = np.asarray(speeds, dtype=float)
+    out['torque'] = np.asarray(torques, dtype=float)
+
+    for a, omega in enumerate(speeds):
+        cache = {}
+        def point(value):
+            if value not in cache:
+                cache[value] = solve(omega, params.replace(**{name: value}), **kwargs)
+            return cache[value]
+        def shaft(value):
+            return point(value)['kpis']['shaft_torque']
+        t_low, t_high = shaft(low), shaft(high)
+        for b, torque in enumerate(torques):
+            if not (min(t_low, t_high) <= torque <= max(t_low, t_high)):
+                continue
+            value = optimize.brentq(lambda v: shaft(v) - torque, low, high, xtol=xtol)
+            kpis = point(value)['kpis']
+            out[name][a, b] = value
+            for key in ('efficiency', 'p_in', 'torque_ripple', 'i_rms'):
+                out[key][a, b] = kpis[key]
+    return out
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import argparse
+import itertools
+import time as tm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import params     as prm
+import analysis
+import trace_io
+import result_cache as rc
+import sim_1
+import config
+
+'''
+Parameter sweep
+@brief:
+    Runs one simulation per point of a parameter grid (or list of overrides) in
+    a process pool. A point is a dict of parameter names to values,
+    e.g. {'VDC': 50., 'PWM_duty': 0.3}, applied on top of the config preset as a
+    params.SimConfig passed to the simulation, so nothing leaks from one point
+    to the next.
+    Finished points are appended to a JSON lines file as they complete; running
+    the same sweep again skips the points already in it.
+'''
+
+def grid(**axes):
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(axes[n] for n in names))]
+
+def point_key(overrides):
+    return json.dumps(overrides, sort_keys=True)
+
+'''
+Run one sweep point
+@brief:
+    Simulates `overrides` for sim_time and returns the analysis KPIs over the
+    last half of the run (speed, phase currents, input and electromagnetic
+    power, efficiency, torque and its ripple, commutation timing) plus the
+    rise time, all in SI units. Six step and FOC runs compare
+    on these, e.g. a sweep over CONTROLLER.
+    The worker keeps no trace: the KPIs are reduced chunk by chunk while the
+    simulation runs (analysis.KpiRecorder), or read back in chunks from the
+    trace it streams to trace_path, so only the KPI row goes back to the pool.
+'''
+def run_point(overrides, sim_time, method, backend, stride=1, trace_path=None):
+    params = prm.SimConfig(**overrides)
+    n_steps = int(np.ceil(sim_time / params.SIM_STEP))
+    if trace_path is not None:
+        recorder = trace_io.StreamingRecorder(trace_path, n_steps, stride=stride, params=params,
+                                              overrides=overrides)
+    else:
+        recorder = analysis.KpiRecorder(n_steps, stride, params=params, t_start=sim_time / 2.)
+    t0 = tm.perf_counter()
+    sim_1.simulate(method, sim_time, params.SIM_STEP, progress=False, backend=backend, recorder=recorder,
+                   params=params)
+    wall = tm.perf_counter() - t0
+    if trace_path is not None:
+        recorder.close()
+        result = analysis.trace_kpis(trace_path, params, t_start=sim_time / 2.)
+    else:
+        result = recorder.kpis()
+    result['wall_time'] = wall
+    return result
+
+def load_done(out):
+    done = {}
+    if os.path.exists(out):
+        with open(out) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    row = json.loads(line)
+                    done[point_key(row['overrides'])] = row
+    return done
+
+'''
+Run a sweep
+@brief:
+    points: list of override dicts (see grid()). Results are appended to `out`
+    as {'index', 'overrides', 'kpis'} lines, points already present are not run
+    again. With trace_dir every point also streams its trace to
+    trace_dir/point_<index>. Points run before with the same parameters and
+    settings are taken from the result cache in cache_dir (result_cache.py,
+    None: off) instead, unless their traces are wanted.
+    Returns the rows of every point in order.
+'''
+def run(points, out, sim_time=config.SIM_TIME, method=config.SIM_INTEGRATOR, backend=config.SIM_BACKEND,
+        workers=None, stride=1, trace_dir=None, progress=True, cache_dir=config.SIM_CACHE):
+    done = load_done(out)
+    todo = [(i, p) for i, p in enumerate(points) if point_key(p) not in done]
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+
+    cache = rc.ResultCache(cache_dir) if cache_dir else None
+    keys = {}
+    if cache is not None:
+        for i, p in todo:
+            params = prm.SimConfig(**p)
+            if rc.cacheable(params):
+                keys[i] = rc.run_key(params, mode='fixed', method=method, sim_time=sim_time, sim_step=params.SIM_STEP,
+                                     backend=rc.resolved_backend(params, method, backend), stride=stride,
+                                     t_start=sim_time / 2.)
+
+    with open(out, 'a') as f, ProcessPoolExecutor(max_workers=workers) as pool:
+        def finish(i, p, kpis):
+            row = {'index': i, 'overrides': p, 'kpis': kpis}
+            f.write(json.dumps(row) + '\n')
+            f.flush()
+            done[point_key(p)] = row
+
+        futures = {}
+        for i, p in todo:
+            entry = cache.get(keys[i]) if i in keys and trace_dir is None else None
+            if entry is not None:
+                finish(i, p, entry.kpis)
+                continue
+            trace_path = None if trace_dir is None else os.path.join(trace_dir, f"point_{i}")
+            futures[pool.submit(run_point, p, sim_time, method, backend, stride, trace_path)] = (i, p)
+        if progress:
+            print(f"{len(points)} points, {len(points) - len(todo)} already done, "
+                  f"{len(todo) - len(futures)} from the cache, {len(futures)} to run")
+        for n, future in enumerate(as_completed(futures)):
+            i, p = futures[future]
+            kpis = future.result()
+            finish(i, p, kpis)
+            if i in keys:
+                cache.put(keys[i], kpis, meta={'overrides': p})
+            if progress:
+                print(f"[{n+1}/{len(futures)}] {p} {kpis}")
+
+    if progress and cache is not None:
+        print(cache.stats())
+    return [done[point_key(p)] for p in points]
+
+def _parse_axis(text):
+    name, values = text.split('=', 1)
+    return name, [json.loads(v) for v in values.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Open-BLDC pysim parameter sweep')
+    parser.add_argument('axes', nargs='+', help='NAME=v1,v2,... grid axes over params.SimConfig values')
+    parser.add_argument('--out', default='sweep.jsonl', help='results file (resumed when it exists)')
+    parser.add_argument('--sim-time', type=float, default=config.SIM_TIME)
+    parser.add_argument('--method', default=config.SIM_INTEGRATOR)
+    parser.add_argument('--backend', default=config.SIM_BACKEND)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--stride', type=int, default=1, help='trace decimation')
+    parser.add_argument('--trace-dir', default=None, help='stream every point trace to this directory')
+    parser.add_argument('--cache-dir', default=config.SIM_CACHE,
+                        help='result cache directory (default SIM_CACHE, no cache when not set)')
+    parser.add_argument('--no-cache', action='store_true', help='run every point, do not use the result cache')
+    args = parser.parse_args(argv)
+
+    points = grid(**dict(_parse_axis(a) for a in args.axes))
+    run(points, args.out, args.sim_time, args.method, args.backend, args.workers, args.stride, args.trace_dir,
+        cache_dir=None if args.no_cache else args.cache_dir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,69 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import pytest
+import numpy as np
+
+import dyn_model  as dm
+import integrator
+import sim_1
+
+'''
+Integrator accuracy
+@brief:
+    The accuracy bench.py bench_integrator prints, asserted: 1 ms of the default
+    simulation with each fixed step method against the per-step odeint loop,
+    and the exponential step against the closed form of the RL current
+    equations it is built on.
+'''
+SIM_TIME = 1e-3
+# Max |di| (A) and |domega| (rad/s) against odeint, two to three times what the methods make now
+TOL = {
+    'euler': (6e-3, 0.3),
+    'rk4': (1e-5, 5e-4),
+    'heun': (2e-5, 2e-3),
+    'exponential': (5e-3, 0.3),
+    'semi_implicit': (6e-3, 0.3),
+}
+
+@pytest.fixture(scope='module')
+def reference():
+    return sim_1.simulate('odeint', SIM_TIME, progress=False, backend='python')[1]
+
+@pytest.mark.parametrize('method', list(TOL))
+def test_against_odeint(method, reference):
+    X = sim_1.simulate(method, SIM_TIME, progress=False, backend='python')[1]
+    tol_i, tol_omega = TOL[method]
+    di = np.max(np.abs(X[:, dm.sv_iu:dm.sv_iw+1] - reference[:, dm.sv_iu:dm.sv_iw+1]))
+    domega = np.max(np.abs(X[:, dm.sv_omega] - reference[:, dm.sv_omega]))
+    assert di < tol_i
+    assert domega < tol_omega
+
+# di/dt = b - a * i with b constant: one exponential step of any length is the exact solution
+@pytest.mark.parametrize('dt', [1e-6, 1e-4, 1e-2])
+def test_exponential_exact_rl(dt):
+    a = 4311.6
+    b = np.array([0., 0., 500., -250., -250.])
+    X = np.array([0., 0., 0.1, -0.3, 0.2])
+    i0 = X[dm.sv_iu:dm.sv_iw+1]
+    Xd = b - a * np.r_[0., 0., i0]
+    Xn = integrator.exponential_update(X, Xd, dt, a, math.exp(-a * dt))
+    exact = b[dm.sv_iu:] / a + (i0 - b[dm.sv_iu:] / a) * math.exp(-a * dt)
+    np.testing.assert_allclose(Xn[dm.sv_iu:dm.sv_iw+1], exact, rtol=1e-12, atol=1e-15)
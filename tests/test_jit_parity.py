@@ -0,0 +1,48 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+import numpy as np
+
+pytest.importorskip('numba')
+
+import jit_kernel
+import params     as prm
+import sim_1
+
+'''
+Compiled kernel parity
+@brief:
+    The compiled kernel runs the same steps as the Python loop: every recorded
+    channel of a short run matches within TOL (relative, like bench.bench_jit)
+    for every method with the ideal and the diode inverter.
+'''
+TOL = 1e-9
+SIM_TIME = 2e-4
+
+@pytest.mark.parametrize('model', ['ideal', 'diode'])
+@pytest.mark.parametrize('method', list(jit_kernel.methods))
+def test_jit_matches_python(method, model):
+    params = prm.SimConfig(INVERTER_MODEL=model)
+    ref = sim_1.simulate(method, SIM_TIME, progress=False, backend='python', params=params)
+    res = sim_1.simulate(method, SIM_TIME, progress=False, backend='jit', params=params)
+    np.testing.assert_array_equal(res[0], ref[0])
+    for name, a, b in zip(('X', 'Y', 'U', 'V_arr'), ref[1:], res[1:]):
+        err = np.max(np.abs(a - b) / (1. + np.abs(a)))
+        assert err <= TOL, f"{method} / {model}: {name} differs by {err:.3e}"
@@ -0,0 +1,223 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import numpy as np
+
+import control    as ctl
+import params     as prm
+import recorder   as rec
+import config
+
+'''
+Streaming trace output
+@brief:
+    StreamingRecorder is a recorder.ChunkedRecorder, every full chunk is
+    written to disk while the simulation runs, so RAM use
+    stays flat whatever the simulated time. Two on-disk formats:
+    - a directory with one .npy file per channel plus meta.json, written through
+      np.memmap and reloaded with mmap_mode='r' (zero copy)
+    - a chunked HDF5 file (needs h5py), metadata in the file attributes
+    Switches stay packed (uint8 bitmask) on disk, see recorder.unpack_switches.
+'''
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+META_FILE = 'meta.json'
+
+def _is_param(name, value):
+    return (not name.startswith('_')) and isinstance(value, (bool, int, float, str, list, tuple))
+
+'''
+Run metadata
+@brief:
+    Every plain value (numbers, strings, lists) of the config and control
+    modules, with the values of `params` (params.SimConfig, config preset when
+    None) in 'config', plus the extra keyword arguments.
+'''
+def run_metadata(params=None, **extra):
+    meta = {
+        'config': {k: v for k, v in vars(config).items() if _is_param(k, v)},
+        'control': {k: v for k, v in vars(ctl).items() if _is_param(k, v)},
+    }
+    meta['config'].update((params or prm.SimConfig()).as_dict())
+    meta.update(extra)
+    # Round trip through json so tuples become lists like they will on reload
+    return json.loads(json.dumps(meta))
+
+def _is_hdf5(path):
+    return os.path.splitext(str(path))[1] in ('.h5', '.hdf5')
+
+class NpyTraceWriter:
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+
+    def open(self, layout, meta):
+        os.makedirs(self.path, exist_ok=True)
+        for name, (shape, dtype) in layout.items():
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'),
+                                                          mode='w+', dtype=dtype, shape=shape)
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+    def write(self, name, start, data):
+        self.arrays[name][start:start+len(data)] = data
+
+    def close(self, n):
+        for a in self.arrays.values():
+            a.flush()
+        # Samples actually written, the files are sized for the planned run
+        meta_path = os.path.join(self.path, META_FILE)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['n_samples'] = n
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=1)
+        self.arrays = {}
+
+class Hdf5TraceWriter:
+    def __init__(self, path, compression=None):
+        if h5py is None:
+            raise ImportError("ERR: h5py is required to write HDF5 traces")
+        self.path = path
+        self.compression = compression
+        self.file = None
+
+    def open(self, layout, meta, chunk_size):
+        self.file = h5py.File(self.path, 'w')
+        for name, (shape, dtype) in layout.items():
+            self.file.create_dataset(name, shape=shape, dtype=dtype, compression=self.compression,
+                                     chunks=(min(chunk_size, shape[0]),) + shape[1:])
+        self.file.attrs['meta'] = json.dumps(meta)
+
+    def write(self, name, start, data):
+        self.file[name][start:start+len(data)] = data
+
+    def close(self, n):
+        meta = json.loads(self.file.attrs['meta'])
+        meta['n_samples'] = n
+        self.file.attrs['meta'] = json.dumps(meta)
+        self.file.close()
+        self.file = None
+
+def make_writer(path):
+    return Hdf5TraceWriter(path) if _is_hdf5(path) else NpyTraceWriter(path)
+
+class StreamingRecorder(rec.ChunkedRecorder):
+    def __init__(self, path, n_steps, channels=('X', 'Y', 'U', 'V'), stride=1, dtype=np.float64,
+                 chunk_size=65536, params=None, **meta):
+        super().__init__(n_steps, channels, stride, dtype, chunk_size)
+        self.path = path
+        self.writer = make_writer(path)
+
+        layout = {'time': ((self.total,), np.float64)}
+        for name in self.channels:
+            a = self.data[name]
+            layout[name] = ((self.total,) + a.shape[1:], a.dtype)
+        meta = run_metadata(params, channels=list(self.channels), stride=self.stride, n_steps=n_steps,
+                            switch_encoding='uint8 bitmask, bit i = switch i', **meta)
+        if isinstance(self.writer, Hdf5TraceWriter):
+            self.writer.open(layout, meta, self.chunk_size)
+        else:
+            self.writer.open(layout, meta)
+
+    def _consume(self, chunk):
+        for name, a in chunk.items():
+            self.writer.write(name, self.written, a)
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.flush()
+        self.writer.close(self.written)
+        self.writer = None
+
+    # Once closed channels are read back from the trace
+    def __getitem__(self, name):
+        if self.writer is not None:
+            return super().__getitem__(name)
+        trace = load(self.path)
+        value = trace[name]
+        trace.close()
+        return value
+
+    # Reload what was written (memory mapped / lazily read)
+    def arrays(self):
+        self.close()
+        trace = load(self.path)
+        arrays = (trace['time'],) + tuple(trace[name] if name in self.channels else None
+                                          for name in ('X', 'Y', 'U', 'V'))
+        # HDF5 channels have been read into memory by now, release the file
+        trace.close()
+        return arrays
+
+'''
+Trace reader
+@brief:
+    trace = load(path); trace.meta is the metadata dict, trace['X'] etc. the
+    channels limited to the samples written. .npy channels are read-only
+    memory maps, HDF5 channels are read when indexed. trace['U'] unpacks the
+    switch bitmasks (same for the diodes 'D'), trace.raw('U') keeps them packed.
+'''
+class Trace:
+    def __init__(self, path):
+        self.path = path
+        if _is_hdf5(path):
+            if h5py is None:
+                raise ImportError("ERR: h5py is required to read HDF5 traces")
+            self.file = h5py.File(path, 'r')
+            self.meta = json.loads(self.file.attrs['meta'])
+            self._channels = {name: self.file[name] for name in self.file}
+        else:
+            self.file = None
+            with open(os.path.join(path, META_FILE)) as f:
+                self.meta = json.load(f)
+            self._channels = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                              for name in ['time'] + self.meta['channels']}
+        self.n = self.meta.get('n_samples', len(self._channels['time']))
+
+    def raw(self, name):
+        return self._channels[name][:self.n]
+
+    def __getitem__(self, name):
+        if name in rec.mask_channels:
+            return rec.unpack_switches(self.raw(name))
+        return self.raw(name)
+
+    def __contains__(self, name):
+        return name in self._channels
+
+    # Iterate over (start, {channel: block}) of at most chunk_size samples
+    def chunks(self, chunk_size=65536, channels=None):
+        channels = ['time'] + self.meta['channels'] if channels is None else channels
+        for start in range(0, self.n, chunk_size):
+            stop = min(start + chunk_size, self.n)
+            yield start, {name: self._channels[name][start:stop] for name in channels}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def load(path):
+    return Trace(path)
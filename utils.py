@@ -18,6 +18,7 @@
 #
 
 import math
+import numpy as np
 
 ### CONSTANTS
 # velocity in rad/s to RPM
@@ -36,21 +37,92 @@ def angle_2pi(alpha):
         alpha_n = (2 * math.pi) + alpha_n
     return alpha_n
 
+# Array version of angle_2pi
+def angle_2pi_v(alpha):
+    return np.mod(alpha, 2 * math.pi)
+
 
 ###############
 ## FUNCTIONS ##
 ###############
 
+'''
+Trapezoidal back-emf shape
+@brief:
+    Ramps 0 -> 1 over [0, pi/6], stays at 1 up to 5pi/6, ramps to -1 at 7pi/6,
+    stays at -1 up to 11pi/6 and ramps back to 0 at 2pi.
+    Written without branches as a triangle wave of amplitude 3 clipped to +-1,
+    with the angle a in units of pi/6:
+        trapezoid = clip(3 - |((a + 3) mod 12) - 6|, -1, 1)
+    trapezoid() is the scalar wrapper, trapezoid_v() takes arrays of any angle
+    (the modulo does the normalization).
+'''
+ANGLE_RAD2SECTOR = 6 / math.pi
+
 def trapezoid(angle):
-    if 0. <= angle <= (math.pi / 6):
-        return (1 / (math.pi /6 )) * angle
-    elif (math.pi / 6) < angle <= (math.pi * (5 / 6)):
-        return 1
-    elif (math.pi * (5 / 6)) < angle <= (math.pi * (7 / 6)):
-        return -((1/(math.pi/6.))* (angle - math.pi))
-    elif (math.pi * (7 / 6)) < angle <= (math.pi * (11 /6)):
-        return -1
-    elif (math.pi * (11 / 6)) < angle <= (2 * math.pi):
-        return (1 / (math.pi / 6)) * (angle - (2 * math.pi))
-    else:
-        raise ValueError("ERROR: angle out of bounds can not calculate bemf %d", angle)
+    if not (0. <= angle <= (2 * math.pi)):
+        raise ValueError(f"ERROR: angle out of bounds can not calculate bemf {angle}")
+    tri = 3. - abs(math.fmod((angle * ANGLE_RAD2SECTOR) + 3., 12.) - 6.)
+    return min(max(tri, -1.), 1.)
+
+def trapezoid_v(angle):
+    tri = 3. - np.abs(np.mod((angle * ANGLE_RAD2SECTOR) + 3., 12.) - 6.)
+    return np.minimum(np.maximum(tri, -1.), 1.)
+
+'''
+Back-emf lookup table
+@brief:
+    The firmware stores the back-emf shape as a table over one electrical turn
+    indexed by the angle. make_bemf_lut(size, shape) samples the shape at size
+    points plus the wrap-around entry (params.MotorParams builds its table once,
+    bemf_lut) and the shape is interpolated linearly between entries. Sizes that are a multiple of 12
+    hit every corner of the trapezoid and reproduce it exactly, power of two
+    sizes (e.g. 256) round the corners like the firmware table does.
+    The 'sinusoidal' shape is sin(angle), same zero crossings and sign as the
+    trapezoid; it needs a finer table (360 entries stay within 4e-5 of the sine).
+'''
+bemf_shapes = {
+    'trapezoidal': trapezoid_v,
+    'sinusoidal': np.sin,
+}
+
+def make_bemf_lut(size, shape='trapezoidal'):
+    if size < 1:
+        raise ValueError(f"ERR: bemf lut size must be positive, got {size}")
+    if shape not in bemf_shapes:
+        raise ValueError(f"ERR: bemf shape is one of {sorted(bemf_shapes)}, not {shape}")
+    angles = np.linspace(0., 2 * math.pi, size + 1)
+    return angles, bemf_shapes[shape](angles)
+
+def trapezoid_lut(angle, lut):
+    return np.interp(np.mod(angle, 2 * math.pi), lut[0], lut[1])
+
+# Back-emf shape for an array of electrical angles (any range) from a make_bemf_lut table (batches)
+def bemf_shape(angle, lut):
+    return trapezoid_lut(angle, lut)
+
+# Electrical angle of phases u, v, w (like dyn_model.ph_offsets)
+PHASE_OFFSETS = tuple(2 * k * math.pi / 3 for k in range(3))
+
+'''
+Three phase back-emf shape
+@brief:
+    Shape of phases u, v, w at one electrical angle, from the table values as
+    a list (params.MotorParams.bemf_table). This is the per step path of the
+    model: float arithmetic, no array built for three values, about 1.1 us
+    against 4.5 us for bemf_shape() and 3.8 us for three trapezoid() calls
+    (bench.py kernels). Interpolates like jit_kernel._bemf.
+'''
+def bemf_phases(elec_angle, table):
+    turn = 2 * math.pi
+    size = len(table) - 1
+    scale = size / turn
+    shape = []
+    for offset in PHASE_OFFSETS:
+        pos = ((elec_angle + offset) % turn) * scale
+        i = int(pos)
+        if i >= size:
+            i = size - 1
+        a = table[i]
+        shape.append(a + (pos - i) * (table[i + 1] - a))
+    return shape